@@ -0,0 +1,114 @@
+#!/usr/bin/python
+
+"""Analysis of parsed statements using numpy. Everything here
+works on the columns of a money.TransactionTable so it never has
+to touch individual record objects, and returns the results rather
+than printing them"""
+
+import numpy as np
+
+
+# 1970-01-01 was a thursday, shifting by this makes weeks start on monday
+WEEK_OFFSET = 3
+
+
+def _column(values):
+    """wraps one of the tables arrays as a numpy array without
+    copying it. The dtype comes from the arrays typecode, the size of
+    a C long isnt the same everywhere"""
+
+    dtype = np.dtype(values.typecode)
+    if not len(values):
+        return np.zeros(0, dtype=dtype)
+    return np.frombuffer(values, dtype=dtype)
+
+
+def place_totals(table):
+    """Sums the amounts for every place in table. Returns a list of
+    (place, total) tuples sorted by total, so the biggest spend
+    (most negative) comes first"""
+
+    codes = _column(table.place_codes)
+    amounts = _column(table.amounts)
+    totals = np.bincount(codes, weights=amounts, minlength=len(table.places))
+
+    order = np.argsort(totals, kind='mergesort')
+    return [(table.places[code], float(totals[code])) for code in order]
+
+
+def category_totals(table, categoriser):
+    """Sums the amounts for every category in table, categoriser is
+    a categories.Categoriser. Only the tables unique places are
+    categorised, the records just go through a lookup array. Returns
+    a list of (category, total) tuples sorted like place_totals"""
+
+    categories = categoriser.categorise_places(table.places)
+    names = sorted(set(categories))
+    lookup = np.array([names.index(category) for category in categories]
+                      or [0], dtype=np.int32)
+
+    codes = lookup[_column(table.place_codes)]
+    amounts = _column(table.amounts)
+    totals = np.bincount(codes, weights=amounts, minlength=len(names))
+
+    order = np.argsort(totals, kind='mergesort')
+    return [(names[code], float(totals[code])) for code in order]
+
+
+def income_outgoing(table):
+    """returns a dict with the total "incoming" and "outgoing" for
+    table, outgoing is positive"""
+
+    amounts = _column(table.amounts)
+
+    incoming = np.maximum(amounts, 0).sum()
+    return {"incoming" : float(incoming),
+            "outgoing" : float(incoming - amounts.sum())}
+
+
+def _period_index(days, period):
+    """turns days since 1970 into the first day of the day, week
+    or month they fall in, still as days since 1970"""
+
+    if period == 'day':
+        return days
+
+    elif period == 'week':
+        return days - (days + WEEK_OFFSET) % 7
+
+    elif period == 'month':
+        months = days.astype('datetime64[D]').astype('datetime64[M]')
+        return months.astype('datetime64[D]').astype(np.int64)
+
+    raise ValueError("period should be day, week or month not {}".format(period))
+
+
+def period_totals(table, period='day'):
+    """Groups table by day, week or month. Returns a tuple of
+    numpy arrays (starts, incoming, outgoing) where starts are the
+    first day of each period (as datetime64) that has a transaction
+    in it, sorted oldest first"""
+
+    days = _column(table.days)
+    amounts = _column(table.amounts)
+
+    if not len(days):
+        return np.zeros(0, dtype='datetime64[D]'), np.zeros(0), np.zeros(0)
+
+    # dates only span a few thousand days so one bincount over the
+    # offset from the first day does the heavy lifting, weeks and
+    # months are then built from the much smaller per day arrays
+    first = days.min()
+    offset = days - first
+    counts = np.bincount(offset)
+    totals = np.bincount(offset, weights=amounts)
+    incoming = np.bincount(offset, weights=np.maximum(amounts, 0))
+    outgoing = incoming - totals
+
+    used = np.flatnonzero(counts)
+    index = _period_index(used + first, period)
+    starts, group = np.unique(index, return_inverse=True)
+
+    return (starts.astype('datetime64[D]'),
+            np.bincount(group, weights=incoming[used]),
+            np.bincount(group, weights=outgoing[used]))
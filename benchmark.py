@@ -0,0 +1,416 @@
+#!/usr/bin/python
+
+"""Benchmarks for the statement parser and everything after it.
+Builds a synthetic santander statement that looks like a real one,
+a realistic mix of transaction types, a few merchants getting most
+of the custom and running balances that add up, then times parsing,
+the aggregations and loading the database. Results are printed as
+JSON so runs can be compared"""
+
+import re
+import os
+import gc
+import sys
+import json
+import time
+import random
+import bisect
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import resource
+import traceback
+from itertools import islice
+
+import analytics
+import timeseries
+from money import Santander, TransactionTable, RECORD_SEPARATOR
+from categories import Categoriser
+from database import TransactionStore
+
+
+# how often each kind of record turns up, roughly what a current
+# account sees. Standing orders and cheques are left out as their
+# patterns dont match anything at the moment
+TRANS_MIX = (('Card Payment', 55),
+             ('Direct Debit', 10),
+             ('Bill Payment', 8),
+             ('Cash Withdrawal', 7),
+             ('Faster Payments', 6),
+             ('Bank Giro Credit', 5),
+             ('Credit', 3),
+             ('Withdrawal', 2),
+             ('Rejected Bill Payment', 1),
+             ('Interest', 1),
+             ('Bank Charge', 2))
+
+# most popular first, picked with a zipf distribution so the top few
+# get most of the records like they do in real statements. Store
+# numbers are filled in with a random one
+MERCHANTS = ("TESCO STORES-{}", "SAINSBURYS S/MKT", "TFL.GOV.UK/CP", "COSTA COFFEE {}",
+             "AMAZON UK MARKETPLACE", "TESCO UPT {}", "PRET A MANGER", "GREGGS PLC",
+             "BOOTS {}", "WAITROSE {}", "MARKS&SPENCER PLC", "SHELL {}", "TRAINLINE",
+             "PETS AT HOME LTD", "ARGOS LTD", "NANDOS {}", "THE RED LION", "ODEON CINEMAS",
+             "SPOTIFY", "NETFLIX.COM", "ALDI {}", "LIDL GB {}", "CO-OP GROUP {}",
+             "JOHN LEWIS", "SUPERDRUG {}", "DELIVEROO", "UBER BV", "STARBUCKS {}",
+             "WH SMITH {}", "EBAY", "JOES CORNER CAFE", "KINGS ARMS", "HALFORDS {}")
+ZIPF_EXPONENT = 1.1
+
+PEOPLE = ("MISS CM SMITH", "MR J BLOGGS", "YOUR MOTHER", "A LANDLORD", "MR P JONES")
+BILLERS = ("BRITISH GAS", "THAMES WATER", "BT GROUP PLC", "VIRGIN MEDIA", "COUNCIL TAX",
+           "EDF ENERGY", "VODAFONE LTD", "AVIVA INSURANCE")
+PAYERS = ("ACME LTD", "HMRC", "MR J BLOGGS", "PAYPAL", "YOUR MOTHER")
+ATMS = ("TESCO PERSONAL FINANCE ATM TESCO MILTON, MILTON, CAMBRID",
+        "SANTANDER BANK CAMBRIDGE", "NOTEMACHINE ATM KINGS CROSS")
+
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+
+# roughly how many years a statement covers, bigger ones get more
+# records a day rather than going back further
+STATEMENT_YEARS = 5
+
+# balance after the newest record, in pence
+CLOSING_BALANCE = 250000
+
+
+def _pence(pence):
+    """formats pence like the statement does, eg -1200 is -12.00"""
+
+    sign = '-' if pence < 0 else ''
+    return "{}{}.{:02d}".format(sign, abs(pence) // 100, abs(pence) % 100)
+
+
+class _Chooser(object):
+    """Picks from weighted choices quickly, random.choices is
+    python 3 only"""
+
+    def __init__(self, rng, choices, weights):
+        self._rng = rng
+        self._choices = choices
+        self._totals = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self._totals.append(total)
+
+    def __call__(self):
+        index = bisect.bisect(self._totals, self._rng.random() * self._totals[-1])
+        return self._choices[index]
+
+
+def _record(rng, trans_type, merchant, date):
+    """returns a (description, amount in pence) for a record of
+    trans_type on date"""
+
+    on = date.strftime("%d-%m-%Y")
+
+    if trans_type == 'Card Payment':
+        pence = -int(rng.lognormvariate(6.9, 0.9))
+        if rng.random() < 0.2:
+            description = "CARD PAYMENT TO {},{} GBP, RATE 1.00/GBP ON {}".format(
+                merchant, _pence(-pence), on)
+        else:
+            description = "CARD PAYMENT TO {}, ON {}".format(merchant, on)
+
+    elif trans_type == 'Direct Debit':
+        pence = -rng.randint(1500, 15000)
+        description = "DIRECT DEBIT PAYMENT TO {} REF {}, MANDATE NO {}".format(
+            rng.choice(BILLERS), rng.randint(1000, 9999), rng.randint(1, 99))
+
+    elif trans_type == 'Bill Payment':
+        pence = -rng.randint(1000, 60000)
+        description = "BILL PAYMENT VIA FASTER PAYMENT TO {} REFERENCE {} , MANDATE NO {}".format(
+            rng.choice(PEOPLE), rng.choice(("RENT", "IOU", "DINNER")), rng.randint(1, 99))
+
+    elif trans_type == 'Cash Withdrawal':
+        pence = -rng.choice((1000, 2000, 3000, 5000, 10000))
+        description = "CASH WITHDRAWAL AT {},{} GBP , ON {}".format(
+            rng.choice(ATMS), _pence(-pence), on)
+
+    elif trans_type == 'Faster Payments':
+        pence = rng.randint(2000, 100000)
+        description = "FASTER PAYMENTS RECEIPT REF {} FROM {}".format(
+            rng.choice(("PAYBACK", "SALARY", "GIFT")), rng.choice(PAYERS))
+
+    elif trans_type == 'Bank Giro Credit':
+        pence = rng.randint(150000, 300000)
+        description = "BANK GIRO CREDIT REF {}, {}".format(rng.choice(PAYERS),
+                                                           rng.randint(100000, 999999))
+
+    elif trans_type == 'Credit':
+        pence = rng.randint(100, 10000)
+        description = "CREDIT FROM {} ON {:02d}-{}".format(rng.choice(PAYERS), date.day,
+                                                           MONTHS[date.month - 1])
+
+    elif trans_type == 'Withdrawal':
+        pence = -rng.randint(2000, 20000)
+        description = "WITHDRAWAL CASH AT SANTANDER BRANCH {}".format(rng.randint(1, 500))
+
+    elif trans_type == 'Rejected Bill Payment':
+        pence = 0
+        description = "REJECTED BILL PAYMENT TO {}".format(rng.choice(PEOPLE))
+
+    elif trans_type == 'Interest':
+        pence = rng.randint(1, 500)
+        description = "INTEREST PAID AFTER TAX 0.00 DEDUCTED"
+
+    else:
+        pence = -rng.randint(50, 300)
+        description = "NON-STERLING PURCHASE FEE"
+
+    return description, pence
+
+
+def generate_statement(path, lines, seed=0, end=datetime.date(2015, 6, 30)):
+    """Writes a statement with roughly the given number of lines (four
+    per record) to path and returns the number of records. The same
+    seed always gives the same statement. Like real santander
+    statements the newest record comes first and ends on end, and
+    each balance is the one after that records amount, so the
+    statement is written backwards from the closing balance and
+    never has to be held in memory"""
+
+    rng = random.Random(seed)
+    records = lines // 4
+    trans_type = _Chooser(rng, [name for name, _ in TRANS_MIX],
+                          [weight for _, weight in TRANS_MIX])
+    merchant = _Chooser(rng, MERCHANTS, [1.0 / rank ** ZIPF_EXPONENT
+                                         for rank in xrange(1, len(MERCHANTS) + 1)])
+
+    # spread the records over about STATEMENT_YEARS
+    per_day = max(3.0, records / (STATEMENT_YEARS * 365.0))
+    start = end - datetime.timedelta(days=int(records / per_day))
+
+    record_str = ("Date:\xa0{}\r\n"
+                  "Description:\xa0{}\r\n"
+                  "Amount:\xa0{}\xa0\t\r\n"
+                  "Balance:\xa0{}\xa0")
+
+    date = end
+    balance = CLOSING_BALANCE
+    with open(path, 'wb') as statement:
+        statement.write("From:\xa0{}\xa0to\xa0{}\r\n\t\t\t\t\t\t\t\r\n"
+                        "Account:\xa0XXXX XXXX XXXX XXXX".format(
+                            start.strftime("%d/%m/%Y"), end.strftime("%d/%m/%Y")))
+
+        for _ in xrange(records):
+            name = merchant().format(rng.randint(100, 9999))
+            description, pence = _record(rng, trans_type(), name, date)
+
+            statement.write(RECORD_SEPARATOR)
+            statement.write(record_str.format(date.strftime("%d/%m/%Y"), description,
+                                              _pence(pence), _pence(balance)))
+
+            # going back in time, so undo this record
+            balance -= pence
+            if rng.random() < 1.0 / per_day:
+                date -= datetime.timedelta(days=1)
+
+    return records
+
+
+def legacy_match(description):
+    """How a record was classified before: a linear startswith scan
+    over the map and a re.match on the raw VERBOSE pattern string"""
+
+    for trans_type in Santander._trans_patterns:
+        if description.startswith(trans_type.upper()):
+            return re.match(Santander._trans_patterns[trans_type],
+                            description, re.I|re.VERBOSE)
+
+
+def compiled_match(description):
+    """How a record is classified now: one combined prefix regex
+    and the class level compiled pattern"""
+
+    match = Santander._trans_type_regex.match(description)
+    if match is None:
+        return None
+    trans_type = Santander._trans_type_groups[match.lastgroup]
+    return Santander._trans_regex_map[trans_type].match(description)
+
+
+def _peak_rss():
+    """the most memory this process has used so far, in kilobytes on
+    linux (bytes on a mac)"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_stage(func, args):
+    """runs func(*args) and returns the seconds it took, the peak RSS
+    and how many more containers the garbage collector is tracking"""
+
+    gc.collect()
+    containers = len(gc.get_objects())
+
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+
+    retained = len(gc.get_objects()) - containers
+    del result
+    return elapsed, _peak_rss(), retained
+
+
+def measure(name, records, func, *args):
+    """Runs func(*args) in a forked child and returns a dict of how it
+    went. The peak RSS is the childs, so it is the high water mark of
+    this stage (on top of what the benchmark already had when it
+    forked) rather than of the whole run. python 2 has no tracemalloc
+    and the garbage collector only tracks containers (lists, dicts,
+    records...) not strings or floats, so containers_retained is how
+    many more of those the result is holding on to"""
+
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child, must never get back into the benchmark
+        status = 1
+        try:
+            os.close(reader)
+            with os.fdopen(writer, 'wb') as out:
+                json.dump(_run_stage(func, args), out)
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    os.close(writer)
+    with os.fdopen(reader, 'rb') as results:
+        output = results.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0 or not output:
+        raise RuntimeError("{} failed in its child process".format(name))
+
+    elapsed, peak, retained = json.loads(output)
+    return {"name" : name,
+            "records" : records,
+            "seconds" : elapsed,
+            "records_per_sec" : records / elapsed if elapsed else None,
+            "peak_rss_kb" : peak,
+            "containers_retained" : retained}
+
+
+def _count(iterable):
+    """consumes an iterable and returns how long it was"""
+
+    count = 0
+    for _ in iterable:
+        count += 1
+    return count
+
+
+def _aggregate(table, categoriser):
+    """runs every aggregation over table"""
+
+    return (analytics.place_totals(table),
+            analytics.category_totals(table, categoriser),
+            analytics.period_totals(table, 'month'),
+            timeseries.daily_series(table),
+            timeseries.running_balance(table))
+
+
+def _load_database(path, statement_path):
+    """loads the statement into a new database at path"""
+
+    with TransactionStore(path) as store:
+        return store.insert(Santander.iter_statement(statement_path))
+
+
+def run_benchmarks(lines, seed=0, workers=1):
+    """Generates a statement of lines lines and times everything on
+    it. Returns the results as a dict ready to be dumped as JSON"""
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'statement.txt')
+    results = []
+
+    try:
+        start = time.time()
+        records = generate_statement(path, lines, seed)
+        generated = time.time() - start
+
+        # dispatch only, on the descriptions from the statement
+        descriptions = [record.get_description() for record in
+                        islice(Santander.iter_statement(path), 100000)]
+        for matcher in (legacy_match, compiled_match):
+            results.append(measure("dispatch_" + matcher.__name__, len(descriptions),
+                                   map, matcher, descriptions))
+
+        results.append(measure("iter_statement", records, _count,
+                               Santander.iter_statement(path)))
+        results.append(measure("parse_statement", records,
+                               Santander.parse_statement, path))
+        if workers != 1:
+            results.append(measure("parse_statement_parallel", records,
+                                   Santander.parse_statement_table, path, "all", True,
+                                   workers))
+
+        statement = Santander.parse_statement(path)
+        results.append(measure("table_from_records", records,
+                               TransactionTable.from_records, statement))
+        table = TransactionTable.from_records(statement)
+        del statement
+
+        results.append(measure("aggregations", records, _aggregate, table, Categoriser()))
+        results.append(measure("database_load", records, _load_database,
+                               os.path.join(directory, 'money.db'), path))
+
+    finally:
+        shutil.rmtree(directory)
+
+    return {"python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "time" : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "lines" : lines,
+            "records" : records,
+            "seed" : seed,
+            "workers" : workers,
+            "generate_seconds" : generated,
+            "results" : results}
+
+
+def parse_args():
+    """parse command line arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--lines',
+            default=1000000,
+            help='number of lines in the synthetic statement',
+            type=int)
+    parser.add_argument('--seed',
+            default=0,
+            help='seed for the synthetic statement, same seed same statement',
+            type=int)
+    parser.add_argument('-j', '--workers',
+            default=1,
+            help='also time a parallel parse with this many workers',
+            type=int)
+    parser.add_argument('-o', '--output',
+            help='write the JSON results here rather than printing them',
+            type=str)
+
+    return parser.parse_args()
+
+
+def main():
+    """main entry point"""
+
+    args = parse_args()
+    results = run_benchmarks(args.lines, args.seed, args.workers)
+
+    if args.output:
+        with open(args.output, 'wb') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+"""On disk cache of parsed statements. Parsing is all regex work
+so once a statement has been parsed its TransactionTable is saved
+as a numpy .npz file and loaded from there next time, as long as
+neither the statement nor the parser has changed"""
+
+import os
+import hashlib
+import zipfile
+import tempfile
+
+import numpy as np
+
+from money import (Santander, TransactionTable, PARSER_VERSION, file_digest,
+                   detect_parser)
+
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'money')
+
+# strings in a table are stored joined up by this
+STRING_SEPARATOR = '\0'
+
+
+def parser_signature(parser=Santander):
+    """Hash of everything that changes what the parser produces,
+    the parser version and class, its trans regex map and type codes
+    and the place rules. Anything cached under a different signature
+    is ignored"""
+
+    sha = hashlib.sha1(str(PARSER_VERSION))
+    sha.update(parser.__name__)
+    for trans_type in sorted(parser._trans_regex_map):
+        sha.update(trans_type)
+        sha.update(parser._trans_regex_map[trans_type].pattern)
+    for code in sorted(getattr(parser, 'typemap', ())):
+        sha.update(code)
+        sha.update(parser.typemap[code])
+    for pattern, name in parser._place_normaliser.rules:
+        sha.update(pattern)
+        sha.update(name)
+    return sha.hexdigest()
+
+
+def _write_atomic(path, write):
+    """calls write with a file object for a temporary file next to
+    path, then renames it to path so nothing ever sees half a file
+    (several workers can share the cache)"""
+
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            write(temp_file)
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+class StatementCache(object):
+    """Cache of parsed statements in directory. Entries are keyed by
+    the statements content hash and the parser signature. To save
+    hashing big statements every time the hash is remembered along
+    with the files size and mtime, and only worked out again if
+    either changes"""
+
+    def __init__(self, directory=CACHE_DIR, parser=None):
+        """constructor, creates directory if it doesnt exist. If
+        parser is None the parser for each statement is found with
+        money.detect_parser"""
+
+        self._directory = directory
+        self._parser = parser
+        self._signatures = {}
+
+        for subdirectory in ('index', 'tables'):
+            path = os.path.join(directory, subdirectory)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # another worker got there first
+                    if not os.path.isdir(path):
+                        raise
+
+    def _digest(self, path):
+        """returns the content hash of the statement at path"""
+
+        stat = os.stat(path)
+        key = hashlib.sha1(os.path.realpath(path)).hexdigest()
+        index_path = os.path.join(self._directory, 'index', key)
+        stamp = "{} {!r}".format(stat.st_size, stat.st_mtime)
+
+        try:
+            with open(index_path, 'rb') as index:
+                old_stamp, digest = index.read().rsplit(' ', 1)
+            if old_stamp == stamp:
+                return digest
+        except (IOError, ValueError):
+            pass
+
+        digest = file_digest(path)
+        _write_atomic(index_path, lambda index: index.write(stamp + ' ' + digest))
+        return digest
+
+    def _parser_for(self, path):
+        """returns the parser for the statement at path and its
+        signature"""
+
+        parser = self._parser or detect_parser(path)
+        if parser not in self._signatures:
+            self._signatures[parser] = parser_signature(parser)
+        return parser, self._signatures[parser]
+
+    def _table_path(self, path, signature):
+        """where the table for the statement at path is kept"""
+
+        name = "{}-{}.npz".format(self._digest(path), signature)
+        return os.path.join(self._directory, 'tables', name)
+
+    def get(self, path):
+        """returns the cached TransactionTable for the statement at
+        path or None if it isnt cached"""
+
+        _, signature = self._parser_for(path)
+        try:
+            cached = np.load(self._table_path(path, signature))
+        except (IOError, ValueError, zipfile.BadZipfile):
+            # not there or not readable, either way parse it again
+            return None
+
+        with cached:
+            if str(cached['signature']) != signature:
+                return None
+
+            strings = {}
+            for name in ('descriptions', 'places', 'trans_types'):
+                joined = cached[name].tostring()
+                strings[name] = joined.split(STRING_SEPARATOR) if joined else []
+
+            columns = dict((name, cached[name].tostring())
+                           for name in TransactionTable._arrays)
+
+        return TransactionTable.from_columns(columns, **strings)
+
+    def put(self, path, table):
+        """caches table as the parsed version of the statement at path"""
+
+        arrays = dict((name, np.frombuffer(data, dtype=np.uint8))
+                      for name, data in table.columns().items())
+        for name in ('descriptions', 'places', 'trans_types'):
+            joined = STRING_SEPARATOR.join(getattr(table, name))
+            arrays[name] = np.frombuffer(joined, dtype=np.uint8)
+        _, signature = self._parser_for(path)
+        arrays['signature'] = np.array(signature)
+
+        _write_atomic(self._table_path(path, signature),
+                      lambda table_file: np.savez(table_file, **arrays))
+
+    def load(self, path):
+        """returns the parsed statement at path as a sorted
+        TransactionTable, from the cache if possible otherwise it is
+        parsed and cached for next time"""
+
+        table = self.get(path)
+        if table is None:
+            parser, _ = self._parser_for(path)
+            table = TransactionTable.from_records(parser.parse_statement(path))
+            self.put(path, table)
+        return table
+
+    def clear(self):
+        """throws away everything in the cache"""
+
+        for subdirectory in ('index', 'tables'):
+            path = os.path.join(self._directory, subdirectory)
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
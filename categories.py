@@ -0,0 +1,211 @@
+#!/usr/bin/python
+
+"""Works out what the money was spent on. Places are put into
+categories (groceries, transport, rent...) first by a table of regex
+rules and then, for places no rule knows about, by finding the most
+similar place we already have a category for.
+
+Everything works on unique places, a table with a million records
+and a thousand places only categorises a thousand things"""
+
+import re
+from collections import defaultdict
+
+
+# what anything we cant work out is put down as
+UNCATEGORISED = 'other'
+
+# (regex, category) rules, tried in order against canonical places
+# (see places.py) and the first to match the start wins. Dont use
+# named groups in the regexs, they are used to tell the rules apart
+DEFAULT_RULES = (
+    (r"(TESCO|SAINSBURYS|WAITROSE|ASDA|MORRISONS|ALDI|LIDL|"
+     r"CO-?OP|MARKS AND SPENCER|ICELAND)\b", "groceries"),
+    (r"(TFL|TRAINLINE|NATIONAL RAIL|.*RAILWAY|UBER|"
+     r"SHELL|BP|ESSO|TEXACO)\b", "transport"),
+    (r".*\b(RENT|LETTINGS|ESTATES)\b", "rent"),
+    (r".*\b(GAS|ELECTRIC|WATER|ENERGY|COUNCIL|BT|VIRGIN MEDIA)\b", "bills"),
+    (r"(COSTA|STARBUCKS|PRET|GREGGS|NANDOS|MCDONALDS|"
+     r"DOMINOS|JUST EAT|DELIVEROO)\b", "eating out"),
+    (r".*\b(PUB|BAR|INN|TAVERN|ARMS)\b", "drinking"),
+    (r"(AMAZON|EBAY|PAYPAL|ARGOS|JOHN LEWIS)\b", "shopping"),
+    (r"(NETFLIX|SPOTIFY|STEAM|CINEMA|ODEON|VUE)\b", "entertainment"),
+    (r"(BOOTS|SUPERDRUG|.*PHARMACY)\b", "health"),
+    (r"(SANTANDER|NATWEST|.*ATM)\b", "cash"))
+
+# how alike (0 to 1) a place has to be to an already categorised one
+# before it is put in the same category
+FUZZY_THRESHOLD = 0.5
+
+
+def _grams(place):
+    """the words and character trigrams of place, what places are
+    compared on"""
+
+    padded = ' {} '.format(place)
+    grams = set(padded[i:i + 3] for i in range(len(padded) - 2))
+    grams.update(place.split())
+    return grams
+
+
+class Categoriser(object):
+    """Maps places to categories. Rules are compiled into one regex,
+    places they dont match are compared to the places we know the
+    category of through an index of their words and trigrams, and
+    every answer is remembered"""
+
+    def __init__(self, rules=DEFAULT_RULES, places=None):
+        """constructor, rules is a sequence of (regex, category) see
+        DEFAULT_RULES and places is a dict of place -> category for
+        places whose category is already known"""
+
+        self._rules = tuple(rules)
+        self._categories = {}
+        alternatives = []
+        for index, (pattern, category) in enumerate(self._rules):
+            group = 'r{}'.format(index)
+            self._categories[group] = category
+            alternatives.append('(?P<{}>{})'.format(group, pattern))
+
+        self._regex = re.compile('|'.join(alternatives), re.I) if alternatives else None
+
+        # known places, their grams and the index from gram to them
+        self._known = []
+        self._known_grams = []
+        self._learnt = {}
+        self._index = defaultdict(list)
+
+        # categories from rules or known places, and best guesses with
+        # an index of their grams like the one for known places, so
+        # learning a place only throws away the guesses it could change
+        self._memo = {}
+        self._guesses = {}
+        self._guess_grams = {}
+        self._guess_index = defaultdict(set)
+        # guesses thrown away since changed_guesses was last called
+        self._changed = set()
+
+        for place, category in sorted((places or {}).items()):
+            self.learn(place, category)
+
+    @property
+    def rules(self):
+        """the (regex, category) rules in use"""
+
+        return self._rules
+
+    def learn(self, place, category):
+        """adds place to the places we know the category of, similar
+        places will be put in the same category"""
+
+        grams = _grams(place)
+        number = self._learnt.get(place)
+        if number is not None:
+            self._known[number] = (place, category)
+        else:
+            number = self._learnt[place] = len(self._known)
+            self._known.append((place, category))
+            self._known_grams.append(len(grams))
+            for gram in grams:
+                self._index[gram].append(number)
+
+        self._memo[place] = category
+
+        # only guesses alike enough to place to pick it can change
+        changed = [guessed for guessed, score in self._similar(grams, self._guess_index,
+                                                                self._guess_grams.get)
+                   if score >= FUZZY_THRESHOLD]
+        changed.append(place)
+        for guessed in changed:
+            if self._guesses.pop(guessed, None) is not None:
+                for gram in _grams(guessed):
+                    self._guess_index[gram].discard(guessed)
+                del self._guess_grams[guessed]
+                self._changed.add(guessed)
+
+    def changed_guesses(self):
+        """Returns the set of places whose category was a guess that
+        learning a place since this was last called may have changed,
+        see learn"""
+
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def _rule_category(self, place):
+        """the category of the first rule matching place, or None"""
+
+        match = self._regex.match(place) if self._regex else None
+        if match is None:
+            return None
+        return self._categories[match.lastgroup]
+
+    @staticmethod
+    def _similar(grams, index, sizes):
+        """yields (key, Jaccard similarity) for every key in index (gram
+        -> keys) sharing a gram with grams, sizes(key) is how many
+        grams key has"""
+
+        shared = defaultdict(int)
+        for gram in grams:
+            for key in index.get(gram, ()):
+                shared[key] += 1
+
+        for key, common in shared.iteritems():
+            yield key, float(common) / (len(grams) + sizes(key) - common)
+
+    def _guess(self, grams):
+        """the category of the known place most similar to the place
+        with grams, or UNCATEGORISED"""
+
+        # ties go to the first place alphabetically, not the first
+        # learnt, so the guess doesnt depend on the order places came in
+        best, best_key = UNCATEGORISED, None
+        for number, score in self._similar(grams, self._index, self._known_grams.__getitem__):
+            if score < FUZZY_THRESHOLD:
+                continue
+            known, category = self._known[number]
+            key = (-score, known)
+            if best_key is None or key < best_key:
+                best, best_key = category, key
+        return best
+
+    def categorise(self, place):
+        """returns the category for place"""
+
+        if place is None:
+            return UNCATEGORISED
+
+        try:
+            return self._memo[place]
+        except KeyError:
+            pass
+
+        category = self._rule_category(place)
+        if category is not None:
+            self._memo[place] = category
+            return category
+
+        try:
+            return self._guesses[place]
+        except KeyError:
+            pass
+
+        grams = _grams(place)
+        category = self._guesses[place] = self._guess(grams)
+        self._guess_grams[place] = len(grams)
+        for gram in grams:
+            self._guess_index[gram].add(place)
+        return category
+
+    def categorise_places(self, places):
+        """Returns a list of the categories for places. Places
+        matched by a rule are learnt before anything is guessed, so
+        the answers dont depend on the order of places"""
+
+        for place in places:
+            if place is not None and place not in self._memo:
+                category = self._rule_category(place)
+                if category is not None:
+                    self.learn(place, category)
+
+        return [self.categorise(place) for place in places]
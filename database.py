@@ -1,110 +1,747 @@
+import os
 import sqlite3
-import money4
-#import numpy as np
-#import matplotlib.pyplot as plt
+import json
+import calendar
+import datetime
+from contextlib import contextmanager
+from collections import defaultdict
+from itertools import islice
+from money import (Transaction, TransactionTable, SECONDS_PER_DAY, file_digest,
+                   detect_parser, Quarantine, QuarantinedRecord, STATEMENT_ENCODING)
+from categories import Categoriser, DEFAULT_RULES
+from timeseries import dense_series
 
 
-#conn = sqlite3.connect('/Users/pholland/Database/money.db')
-#c = conn.cursor()
-#santander = money2.statement('/Users/pholland/Downloads/Statements09012746909754.txt')
+DATABASE_PATH = '/Users/pholland/Database/money.db'
 
-def formatDatabase():
+# how many records go in each executemany/transaction
+BATCH_SIZE = 5000
+
+
+def _pence_string(amount):
+    """formats a stored amount the way statements print it"""
+
+    return '' if amount is None else "{:.2f}".format(amount)
+
+
+def _load_fields(text):
+    """reads the fields of a quarantined record back from JSON, as
+    the statement encoded strings the parsers made them from"""
+
+    fields = json.loads(text)
+    if fields is None:
+        return None
+    return dict((str(name), value.encode(STATEMENT_ENCODING)
+                 if isinstance(value, unicode) else value)
+                for name, value in fields.items())
+
+
+def _to_timestamp(date):
+    """turns a datetime or a dd-mm-yyyy string into a UTC unix
+    timestamp like the ones in useful_statement"""
+
+    if isinstance(date, basestring):
+        date = datetime.datetime.strptime(date, "%d-%m-%Y")
+    return calendar.timegm(date.timetuple())
+
+
+class _StoredFingerprints(object):
+    """Stands in for a set of every stored fingerprint as the skip
+    argument of the parsers, but looks each one up in the unique index
+    when it is asked about. An import then costs what the statement
+    has in it rather than everything ever imported"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __contains__(self, fingerprint):
+        return self._conn.execute("""SELECT 1 FROM useful_statement
+                                     WHERE Fingerprint = ?;""",
+                                  (fingerprint,)).fetchone() is not None
+
+
+class TransactionStore(object):
+    """Keeps parsed records in an sqlite database. One connection is
+    opened when the store is created and reused for everything, and
+    records are written in batches with one transaction per batch"""
+
+    _schema = ("""CREATE TABLE IF NOT EXISTS raw_statement
+                  (Date TEXT,
+                   Description TEXT,
+                   Amount TEXT,
+                   Balance TEXT,
+                   Fingerprint TEXT);""",
+               """CREATE TABLE IF NOT EXISTS useful_statement
+                  (Timestamp INTEGER,
+                   Description TEXT,
+                   Place TEXT,
+                   Amount REAL,
+                   Balance REAL,
+                   Type TEXT,
+                   Account TEXT,
+                   Fingerprint TEXT,
+                   Position INTEGER);""",
+               # which statements have been imported and how far we got
+               """CREATE TABLE IF NOT EXISTS imported_files
+                  (Path TEXT PRIMARY KEY,
+                   Size INTEGER,
+                   Mtime REAL,
+                   Digest TEXT,
+                   Offset INTEGER);""",
+               # the users (regex, category) rules, tried in Position
+               # order, and places they have put in a category by hand
+               """CREATE TABLE IF NOT EXISTS category_rules
+                  (Position INTEGER PRIMARY KEY,
+                   Pattern TEXT,
+                   Category TEXT);""",
+               """CREATE TABLE IF NOT EXISTS place_categories
+                  (Place TEXT PRIMARY KEY,
+                   Category TEXT);""",
+               # records that couldnt be parsed, Fields is JSON so
+               # they can be parsed again without the statement
+               """CREATE TABLE IF NOT EXISTS quarantine
+                  (Parser TEXT,
+                   Path TEXT,
+                   Offset INTEGER,
+                   Error TEXT,
+                   Message TEXT,
+                   Fields TEXT,
+                   PRIMARY KEY (Path, Offset));""",
+               # totals kept up to date by insert so they can be
+               # read without going through every transaction, see
+               # summary. Day is days since 1970, Month yyyy-mm
+               """CREATE TABLE IF NOT EXISTS daily_summary
+                  (Day INTEGER PRIMARY KEY,
+                   Incoming REAL,
+                   Outgoing REAL,
+                   Count INTEGER);""",
+               """CREATE TABLE IF NOT EXISTS monthly_summary
+                  (Month TEXT PRIMARY KEY,
+                   Incoming REAL,
+                   Outgoing REAL,
+                   Count INTEGER);""",
+               """CREATE TABLE IF NOT EXISTS place_summary
+                  (Place TEXT PRIMARY KEY,
+                   Incoming REAL,
+                   Outgoing REAL,
+                   Count INTEGER);""",
+               """CREATE TABLE IF NOT EXISTS category_summary
+                  (Category TEXT PRIMARY KEY,
+                   Incoming REAL,
+                   Outgoing REAL,
+                   Count INTEGER);""",
+               # fingerprints stop the same transaction going in twice
+               """CREATE UNIQUE INDEX IF NOT EXISTS raw_fingerprint
+                  ON raw_statement (Fingerprint);""",
+               """CREATE UNIQUE INDEX IF NOT EXISTS useful_fingerprint
+                  ON useful_statement (Fingerprint);""",
+               # what transactions_between searches on
+               """DROP INDEX IF EXISTS useful_timestamp;""",
+               """CREATE INDEX IF NOT EXISTS useful_timestamp_position
+                  ON useful_statement (Timestamp, Position);""",
+               """CREATE INDEX IF NOT EXISTS useful_place
+                  ON useful_statement (Place);""",
+               """CREATE INDEX IF NOT EXISTS useful_type
+                  ON useful_statement (Type);""")
+
+    _tables = ("raw_statement", "useful_statement", "imported_files",
+               "category_rules", "place_categories", "quarantine",
+               "daily_summary", "monthly_summary", "place_summary",
+               "category_summary")
+
+    # what summary can group by -> (table, key column)
+    _summaries = {"day" : ("daily_summary", "Day"),
+                  "month" : ("monthly_summary", "Month"),
+                  "place" : ("place_summary", "Place"),
+                  "category" : ("category_summary", "Category")}
+
+    # how each summary key is worked out from useful_statement, the
+    # category one is worked out from place_summary
+    _summary_keys = (("day", "Timestamp / {}".format(SECONDS_PER_DAY)),
+                     ("month", "strftime('%Y-%m', Timestamp, 'unixepoch')"),
+                     ("place", "Place"))
+
+    def __init__(self, path=DATABASE_PATH):
+        """constructor, opens (or creates) the database at path"""
+
+        # isolation_level None means sqlite3 wont start transactions
+        # behind our back, we BEGIN and COMMIT them ourselves
+        self._conn = sqlite3.connect(path, isolation_level=None)
+
+        # write ahead log with NORMAL sync is much quicker for bulk
+        # loads and still safe if we crash
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+
+        # the categoriser the category summary is kept with and the
+        # category each place is counted under, made when first needed
+        # by _recategorise
+        self._categoriser = None
+        self._counted = None
+
+        self.create_tables()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """closes the connection"""
+
+        self._conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Context manager that wraps everything in it in one
+        transaction, rolled back if anything goes wrong"""
+
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN;")
+        try:
+            yield cursor
+        except:
+            cursor.execute("ROLLBACK;")
+            # categories counted in it are gone too
+            self._counted = None
+            raise
+        else:
+            cursor.execute("COMMIT;")
+        finally:
+            cursor.close()
+
+    def create_tables(self):
+        """creates any of the tables that dont exist yet"""
+
+        with self.transaction() as cursor:
+            summarised = cursor.execute("""SELECT 1 FROM sqlite_master
+                                           WHERE type = 'table'
+                                           AND name = 'daily_summary';""").fetchone()
+            # the schema indexes columns older databases dont have
+            self._migrate(cursor)
+            for command in self._schema:
+                cursor.execute(command)
+            if not summarised:
+                # from before there were summaries, catch them up
+                self._rebuild_summaries(cursor)
+
+    def _migrate(self, cursor):
+        """adds the columns that tables made by older versions (or
+        formatDatabase) are missing, in the order the schema has them"""
+
+        columns = self._columns(cursor, "raw_statement")
+        if columns and "Fingerprint" not in columns:
+            cursor.execute("ALTER TABLE raw_statement ADD COLUMN Fingerprint TEXT;")
+            rows = cursor.execute("""SELECT rowid, Date, Description, Amount, Balance
+                                     FROM raw_statement
+                                     ORDER BY rowid;""").fetchall()
+            self._backfill_fingerprints(cursor, "raw_statement", rows)
+
+        columns = self._columns(cursor, "useful_statement")
+        if columns and "Fingerprint" not in columns:
+            cursor.execute("ALTER TABLE useful_statement ADD COLUMN Fingerprint TEXT;")
+            # laid out like the statements print them, so importing
+            # one of them again should find its records already there
+            rows = [(rowid, datetime.datetime.utcfromtimestamp(timestamp).strftime("%d/%m/%Y"),
+                     description, _pence_string(amount), _pence_string(balance))
+                    for rowid, timestamp, description, amount, balance in
+                    cursor.execute("""SELECT rowid, Timestamp, Description, Amount, Balance
+                                      FROM useful_statement
+                                      ORDER BY rowid;""").fetchall()]
+            self._backfill_fingerprints(cursor, "useful_statement", rows)
+        if columns and "Position" not in columns:
+            # from before records kept their place in the day, rowid
+            # breaks the ties for them like it used to
+            cursor.execute("""ALTER TABLE useful_statement
+                              ADD COLUMN Position INTEGER DEFAULT 0;""")
+
+    @staticmethod
+    def _columns(cursor, table):
+        """returns the names of the columns of table, none if it doesnt exist"""
+
+        return [row[1] for row in cursor.execute("PRAGMA table_info({});".format(table))]
+
+    @staticmethod
+    def _backfill_fingerprints(cursor, table, rows):
+        """Fingerprints rows of (rowid, date, description, amount,
+        balance) from before records had fingerprints. Older versions
+        could store the same transaction twice, only the first copy
+        gets the fingerprint and the rest are left NULL, which the
+        unique index allows"""
+
+        seen = set()
+        fingerprints = []
+        for row in rows:
+            fields = [field.encode(STATEMENT_ENCODING) if isinstance(field, unicode)
+                      else '' if field is None else str(field) for field in row[1:]]
+            fingerprint = Transaction.make_fingerprint(*fields)
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                fingerprints.append((fingerprint, row[0]))
+
+        cursor.executemany("UPDATE {} SET Fingerprint = ? WHERE rowid = ?;".format(table),
+                           fingerprints)
+
+    def drop_tables(self):
+        """Caution: This will destroy EVERYTHING"""
+
+        with self.transaction() as cursor:
+            for table in self._tables:
+                cursor.execute("DROP TABLE IF EXISTS {};".format(table))
+
+    def insert(self, records, batch_size=BATCH_SIZE):
+        """Inserts records into both tables, records can be any
+        iterable of Transaction objects (a streaming parser is fine).
+        Records that are already in the database are ignored. Returns
+        how many records were actually inserted"""
+
+        records = iter(records)
+        inserted = 0
+
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+
+            with self.transaction() as cursor:
+                # rowids only go up so the new rows are the ones after this
+                latest = cursor.execute("""SELECT COALESCE(MAX(rowid), 0)
+                                           FROM useful_statement;""").fetchone()[0]
+
+                cursor.executemany('INSERT OR IGNORE INTO raw_statement VALUES(?, ?, ?, ?, ?);',
+                                   [(trans.get_date(),
+                                     trans.get_description(),
+                                     str(trans.get_amount()),
+                                     str(trans.get_balance()),
+                                     trans.get_fingerprint())
+                                    for trans in batch])
+
+                # only count the useful table, raw gets the same rows
+                before = self._conn.total_changes
+                cursor.executemany('INSERT OR IGNORE INTO useful_statement VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                                   [(trans.get_timestamp(),
+                                     trans.get_description(),
+                                     trans.get_place(),
+                                     trans.get_amount(),
+                                     trans.get_balance(),
+                                     trans.get_trans_type(),
+                                     trans.get_account(),
+                                     trans.get_fingerprint(),
+                                     # orders records on the same day
+                                     trans.sort_key()[1])
+                                    for trans in batch])
+                inserted += self._conn.total_changes - before
+
+                # in the same transaction so they cant get out of step
+                self._summarise(cursor, latest)
+
+        return inserted
+
+    def _summarise(self, cursor, after=0):
+        """adds the useful_statement rows with a rowid after after on
+        to the summary tables"""
+
+        for by, key in self._summary_keys:
+            rows = cursor.execute("""SELECT {}, SUM(MAX(Amount, 0)),
+                                            SUM(MAX(-Amount, 0)), COUNT(*)
+                                     FROM useful_statement
+                                     WHERE rowid > ?
+                                     GROUP BY 1;""".format(key), (after,)).fetchall()
+            if by == "place":
+                # while place_summary still has the totals from before
+                self._categorise(cursor, rows)
+            self._add_to_summary(cursor, by, rows)
+
+    def _categorise(self, cursor, place_rows):
+        """Adds place_rows, (place, incoming, outgoing, count) for new
+        transactions, on to the category summary. Only their places
+        are categorised, along with any whose guessed category could
+        have changed when they were learnt (see
+        Categoriser.changed_guesses), which move if it has"""
+
+        if self._counted is None:
+            self._recategorise(cursor)
+        categoriser, counted = self._categoriser, self._counted
+
+        places = [row[0] for row in place_rows]
+        categoriser.categorise_places(places)
+
+        # (category, incoming, outgoing, count) to add on
+        rows = []
+        for place in categoriser.changed_guesses().union(places):
+            category = categoriser.categorise(place)
+            before = counted.get(place, category)
+            counted[place] = category
+            if before != category:
+                total = cursor.execute("""SELECT Incoming, Outgoing, Count
+                                          FROM place_summary
+                                          WHERE Place = ?;""", (place,)).fetchone()
+                rows.append((before,) + tuple(-value for value in total))
+                rows.append((category,) + tuple(total))
+        rows.extend((counted[row[0]],) + tuple(row[1:]) for row in place_rows)
+
+        totals = defaultdict(lambda: [0.0, 0.0, 0])
+        for row in rows:
+            for position, value in enumerate(row[1:]):
+                totals[row[0]][position] += value
+        self._add_to_summary(cursor, "category",
+                             [(category,) + tuple(total) for category, total in totals.items()])
+        # a category whose places have all moved out
+        cursor.execute("DELETE FROM category_summary WHERE Count = 0;")
+
+    def _add_to_summary(self, cursor, by, rows):
+        """adds rows of (key, incoming, outgoing, count) on to the
+        summary by groups by"""
+
+        table, key = self._summaries[by]
+        cursor.executemany("INSERT OR IGNORE INTO {} VALUES(?, 0, 0, 0);".format(table),
+                           [row[:1] for row in rows])
+        cursor.executemany("""UPDATE {}
+                              SET Incoming = Incoming + ?,
+                                  Outgoing = Outgoing + ?,
+                                  Count = Count + ?
+                              WHERE {} = ?;""".format(table, key),
+                           [tuple(row[1:]) + (row[0],) for row in rows])
+
+    def _recategorise(self, cursor):
+        """works the category summary out again from the place one
+        with a new categoriser, the first time a store needs it and
+        whenever the rules change"""
+
+        self._categoriser = self.categoriser()
+        self._counted = {}
+
+        rows = cursor.execute("""SELECT Place, Incoming, Outgoing, Count
+                                 FROM place_summary
+                                 ORDER BY Place;""").fetchall()
+        cursor.execute("DELETE FROM category_summary;")
+        self._categorise(cursor, rows)
+
+    def rebuild_summaries(self):
+        """Works every summary table out again from scratch, only
+        needed if they have somehow got out of step with the
+        transactions"""
+
+        with self.transaction() as cursor:
+            self._rebuild_summaries(cursor)
+
+    def _rebuild_summaries(self, cursor):
+        """empties the summary tables and summarises everything"""
+
+        for table, _ in self._summaries.values():
+            cursor.execute("DELETE FROM {};".format(table))
+        # starts the categories again from the empty place summary
+        self._counted = None
+        self._summarise(cursor)
+
+    def _summary_table(self, by):
+        """returns the (table, key column) of the summary by groups by"""
+
+        if by not in self._summaries:
+            msg = "by should be one of {} not {}"
+            raise ValueError(msg.format(', '.join(sorted(self._summaries)), by))
+        return self._summaries[by]
+
+    def summary(self, by="day"):
+        """Returns a list of (key, incoming, outgoing, count) tuples
+        for every day (days since 1970), month (yyyy-mm), place or
+        category with transactions, straight from the summary tables
+        so no transactions are read. Outgoing is positive"""
+
+        command = """SELECT {1}, Incoming, Outgoing, Count
+                     FROM {0}
+                     ORDER BY {1} ASC;""".format(*self._summary_table(by))
+        return self._conn.execute(command).fetchall()
+
+    def totals(self, by="place"):
+        """Returns a list of (key, total) tuples like
+        analytics.place_totals but from the summary tables, biggest
+        spend (most negative) first"""
+
+        command = """SELECT {1}, Incoming - Outgoing AS Total
+                     FROM {0}
+                     ORDER BY Total ASC, {1} ASC;""".format(*self._summary_table(by))
+        return self._conn.execute(command).fetchall()
+
+    def income_outgoing(self):
+        """returns a dict with the total "incoming" and "outgoing" of
+        every transaction like analytics.income_outgoing, from the
+        monthly summary"""
+
+        incoming, outgoing = self._conn.execute("""SELECT COALESCE(SUM(Incoming), 0),
+                                                          COALESCE(SUM(Outgoing), 0)
+                                                   FROM monthly_summary;""").fetchone()
+        return {"incoming" : incoming, "outgoing" : outgoing}
+
+    def daily_series(self, start=None, end=None):
+        """returns (days, incoming, outgoing) arrays with an entry for
+        every day like timeseries.daily_series, from the daily summary"""
+
+        rows = self.summary("day")
+        return dense_series([row[0] for row in rows], [row[1] for row in rows],
+                            [row[2] for row in rows], start, end)
+
+    def fingerprints(self):
+        """returns a set of the fingerprints of every record stored"""
+
+        cursor = self._conn.execute("SELECT Fingerprint FROM useful_statement;")
+        return set(row[0] for row in cursor)
+
+    def stored_fingerprints(self):
+        """returns something to give the parsers as skip that says
+        whether a fingerprint is stored without reading them all in,
+        unlike fingerprints"""
+
+        return _StoredFingerprints(self._conn)
+
+    def plan_import(self, path):
+        """Works out how much of the statement at path needs reading,
+        see import_statement. Returns None if it hasnt changed since
+        it was last imported, otherwise a (path, size, mtime, digest,
+        offset) tuple where path is absolute and offset is where to
+        start reading, to give finish_import once it has been read"""
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        previous = self._conn.execute("""SELECT Size, Mtime, Digest, Offset
+                                         FROM imported_files
+                                         WHERE Path = ?;""", (path,)).fetchone()
+
+        if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime):
+            # nothing has changed
+            return None
+
+        offset = 0
+        if previous is not None and stat.st_size >= previous[3]:
+            prefix, digest = file_digest(path, previous[3])
+            if prefix == previous[2]:
+                offset = previous[3]
+        else:
+            digest = file_digest(path)
+
+        return path, stat.st_size, stat.st_mtime, digest, offset
+
+    def finish_import(self, plan, quarantine=None):
+        """records that the statement in plan (from plan_import) has
+        been read, along with anything it put in quarantine"""
+
+        path, size, mtime, digest, _ = plan
+        with self.transaction() as cursor:
+            cursor.execute("INSERT OR REPLACE INTO imported_files VALUES(?, ?, ?, ?, ?);",
+                           (path, size, mtime, digest, size))
+            if quarantine is not None:
+                self._quarantine(cursor, quarantine)
+
+    def import_statement(self, path, parser=None, errors="strict"):
+        """Incrementally imports a statement, parser is the record
+        class to parse it with or None to work it out from the file
+        (see money.detect_parser). If errors is "collect" records
+        that cant be parsed are kept in the quarantine table rather
+        than stopping the import, see retry_quarantined. A file that hasnt
+        changed since it was last imported is skipped, one that has
+        only had records added to the end is read from where we got
+        to last time, and anything else is read in full but only
+        records we havent seen before are parsed and inserted.
+        Returns how many records were inserted"""
+
+        plan = self.plan_import(path)
+        if plan is None:
+            return 0
+
+        if parser is None:
+            parser = detect_parser(plan[0])
+        quarantine = Quarantine()
+        records = parser.iter_statement(plan[0], offset=plan[4],
+                                        skip=self.stored_fingerprints(),
+                                        errors=errors, quarantine=quarantine)
+        inserted = self.insert(records)
+        self.finish_import(plan, quarantine)
+        return inserted
+
+    def _quarantine(self, cursor, quarantine):
+        """stores the records in quarantine in the quarantine table"""
+
+        cursor.executemany("INSERT OR REPLACE INTO quarantine VALUES(?, ?, ?, ?, ?, ?);",
+                           [(record.parser, record.path, record.offset,
+                             record.error,
+                             # messages quote the record, non breaking spaces and all
+                             record.message.decode(STATEMENT_ENCODING),
+                             json.dumps(record.fields, encoding=STATEMENT_ENCODING))
+                            for record in quarantine])
+
+    def quarantined(self):
+        """returns a money.Quarantine of every stored record that
+        couldnt be parsed"""
+
+        cursor = self._conn.execute("""SELECT Parser, Path, Offset, Error, Message, Fields
+                                       FROM quarantine
+                                       ORDER BY Path, Offset;""")
+        return Quarantine(QuarantinedRecord(parser, path, offset, error,
+                                            message.encode(STATEMENT_ENCODING),
+                                            _load_fields(fields))
+                          for parser, path, offset, error, message, fields in cursor)
+
+    def retry_quarantined(self):
+        """Parses the quarantined records again, only them and
+        without reading their statements, and inserts the ones that
+        work now. Returns how many were inserted"""
+
+        quarantine = self.quarantined()
+        recovered = quarantine.retry()
+        inserted = self.insert(recovered)
+
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM quarantine;")
+            self._quarantine(cursor, quarantine)
+
+        return inserted
+
+    def daily_totals(self):
+        """returns a list of (timestamp, total) tuples, one for each
+        day that has transactions"""
+
+        command = """SELECT Day * {}, Incoming - Outgoing
+                     FROM daily_summary
+                     ORDER BY Day ASC;""".format(SECONDS_PER_DAY)
+        return self._conn.execute(command).fetchall()
+
+    def transactions_between(self, start=None, end=None, place=None, type=None):
+        """Finds transactions from start to end inclusive, either can
+        be a datetime, a dd-mm-yyyy string or None for no limit, and
+        optionally only ones with the given place and/or type. Returns
+        a cursor so rows (Timestamp, Description, Place, Amount,
+        Balance, Type, Account, Position) are fetched as they are
+        iterated over, in the order they happened. Position orders
+        records on the same day, see money.Transaction.sort_key"""
+
+        conditions = []
+        params = []
+        for column, operator, value in (("Timestamp", ">=", start),
+                                        ("Timestamp", "<=", end),
+                                        ("Place", "=", place),
+                                        ("Type", "=", type)):
+            if value is None:
+                continue
+            if column == "Timestamp":
+                value = _to_timestamp(value)
+            conditions.append("{} {} ?".format(column, operator))
+            params.append(value)
+
+        command = """SELECT Timestamp, Description, Place, Amount,
+                            Balance, Type, Account, Position
+                     FROM useful_statement"""
+        if conditions:
+            command += "\n WHERE " + " AND ".join(conditions)
+        command += "\n ORDER BY Timestamp ASC, Position ASC, rowid ASC;"
+
+        return self._conn.execute(command, params)
+
+    def table_between(self, start=None, end=None, place=None, type=None):
+        """same as transactions_between but returns the rows in a
+        TransactionTable ready for analysis"""
+
+        table = TransactionTable()
+        for row in self.transactions_between(start, end, place, type):
+            timestamp, description, place, amount, balance, trans_type, _, position = row
+            table.append(timestamp // SECONDS_PER_DAY, description, place,
+                         amount, balance, trans_type, position)
+        return table
+
+    def category_rules(self):
+        """returns the stored (regex, category) rules in order, or
+        categories.DEFAULT_RULES if none have been set"""
+
+        rules = self._conn.execute("""SELECT Pattern, Category
+                                      FROM category_rules
+                                      ORDER BY Position ASC;""").fetchall()
+        return [tuple(rule) for rule in rules] or list(DEFAULT_RULES)
+
+    def set_category_rules(self, rules):
+        """replaces the stored rules with rules, a sequence of
+        (regex, category)"""
+
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM category_rules;")
+            cursor.executemany("INSERT INTO category_rules VALUES(?, ?, ?);",
+                               [(position, pattern, category)
+                                for position, (pattern, category) in enumerate(rules)])
+            self._recategorise(cursor)
+
+    def load_category_rules(self, path):
+        """Replaces the stored rules with the ones in the rule file
+        at path. Each line is a category and a regex separated by a
+        comma, lines starting with # are ignored, eg
+
+            groceries,(TESCO|ALDI)\\b
+            rent,.*LETTINGS
+
+        returns how many rules there were"""
+
+        with open(path, 'rb') as rule_file:
+            rules = [(pattern, category.strip())
+                     for category, pattern in
+                     (line.rstrip('\r\n').split(',', 1) for line in rule_file
+                      if line.strip() and not line.startswith('#'))]
+
+        self.set_category_rules(rules)
+        return len(rules)
+
+    def place_categories(self):
+        """returns a dict of place -> category for every place put in
+        a category by hand"""
+
+        cursor = self._conn.execute("SELECT Place, Category FROM place_categories;")
+        return dict(cursor)
+
+    def set_place_category(self, place, category):
+        """puts place in category whatever the rules say, category
+        None forgets about it"""
+
+        with self.transaction() as cursor:
+            if category is None:
+                cursor.execute("DELETE FROM place_categories WHERE Place = ?;", (place,))
+            else:
+                cursor.execute("INSERT OR REPLACE INTO place_categories VALUES(?, ?);",
+                               (place, category))
+            self._recategorise(cursor)
+
+    def categoriser(self):
+        """returns a categories.Categoriser using the stored rules and
+        places"""
+
+        return Categoriser(self.category_rules(), self.place_categories())
+
+
+def formatDatabase(path=DATABASE_PATH):
     safety = raw_input('Caution: This will destroy EVERYTHING \nContinue  Y/N:')
     if safety == 'Y' or safety == 'y': 
-        conn = sqlite3.connect('/Users/pholland/Database/money.db')
-        c = conn.cursor()
-        
-        commands = ["DROP TABLE IF EXISTS raw_statement;", \
-                    "DROP TABLE IF EXISTS useful_statement;", \
-                    "CREATE TABLE raw_statement(Date TEXT, Description TEXT, Amount TEXT, Balance TEXT);", \
-                    "CREATE TABLE useful_statement \
-                     (Timestamp INTEGER, \
-                      Description TEXT,  \
-                      Place TEXT, \
-                      Amount REAL, \
-                      Balance REAL, \
-                      Type TEXT, \
-                      Account TEXT);"]
-                     
-        for command in commands:
-            c.execute(command)
-    
-        conn.commit()
-        c.close
-
-def exportRaw(statementlist):
-    conn = sqlite3.connect('/Users/pholland/Database/money.db')
-    c = conn.cursor()
-    for trans in statementlist:
-        c.execute('INSERT INTO raw_statement VALUES(?, ?, ?, ?);', 
-                  (trans.date, trans.description, trans.amount, trans.balance),)
-    conn.commit()
-    c.close
-
-def exportUseful(statementlist):
-    conn = sqlite3.connect('/Users/pholland/Database/money.db')
-    c = conn.cursor()
-    for trans in statementlist:
-        c.execute('INSERT INTO useful_statement VALUES(?, ?, ?, ?, ?, ?, ?);', \
-                  (trans.timestamp, \
-                   trans.description, \
-                   trans.place, \
-                   trans.amount, \
-                   trans.balance, \
-                   trans.transaction_type,
-                   trans.account),)
-    conn.commit()
-    c.close
-
-def exportAll(statementlist):
-    exportRaw(statementlist)
-    exportUseful(statementlist)
+        with TransactionStore(path) as store:
+            store.drop_tables()
+            store.create_tables()
+
+def exportAll(statementlist, path=DATABASE_PATH):
+    with TransactionStore(path) as store:
+        return store.insert(statementlist)
         
 #formatDatabase()
 #exportAll()
-#conn.commit()
-#
-#fig = plt.figure()
-#graph = fig.add_subplot(111)
-
-def getdata():
-    conn = sqlite3.connect('/Users/pholland/Database/money.db')
-    c = conn.cursor()
-    command = """SELECT Timestamp, SUM(Amount) 
-                 FROM useful_statement  
-                 GROUP BY Timestamp
-                 ORDER BY Timestamp ASC;"""    
-    c.execute(command)
-    foo = c.fetchall()
-    conn.commit()
-    c.close
-    return foo
-
-#data = getdata()
-#i = 0
-#X = []
-#Y = []
-#while i < len(data)-1:
-#    if data[i+1][0] - data[i][0] > 24*60*60:
-#        data.insert(i+1, (data[i][0] + 24*60*60, 0))
-#    i += 1
-# 
-#for time, amount in data:
-#    X.append(time)
-#    Y.append(amount)    
-#
-#
-#graph.plot(np.asarray(X),np.asarray(np.abs(Y)))
-#graph.set_xlabel("Timestamp")
-#graph.set_ylabel("Amount")
-#graph.grid(True)
-#graph.set_ylim(0,250)
-#plt.show()
+
+def getdata(path=DATABASE_PATH):
+    """returns the (days, incoming, outgoing) arrays for every day
+    in the database, see TransactionStore.daily_series"""
+
+    with TransactionStore(path) as store:
+        return store.daily_series()
+
+#from timeseries import plot_spend
+#with TransactionStore() as store:
+#    plot_spend(store.table_between())
 
 
 #formatDatabase()
-#sant = money4.fromSantander('/Users/pholland/Documents/workspace/money/Statements/Statements09012746909754 (1).txt')
-#nat = money4.fromNatwest('/Users/pholland/Downloads/HOLLANDPSV07-20130531.csv')
+#sant = money.Santander.iter_statement('/Users/pholland/Documents/workspace/money/Statements/Statements09012746909754 (1).txt')
+#nat = money.fromNatwest('/Users/pholland/Downloads/HOLLANDPSV07-20130531.csv')
 #exportAll(nat)
 #exportAll(sant)
 
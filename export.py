@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+"""Writes parsed statements out for other tools to use, as CSV, JSON
+Lines or a compact binary columnar format. The writers take any
+iterator of records (or a TransactionTable) and write it in batches,
+so a streaming parser can be exported without the whole statement
+ever being in memory.
+
+The columnar format is a header followed by row groups, one per
+batch. Each row group is a TransactionTable: its arrays as raw bytes
+and its strings joined up, see write_columnar and read_columnar"""
+
+import os
+import sys
+import csv
+import json
+import struct
+from array import array
+from itertools import islice, izip
+
+from money import TransactionTable, TableRow, STATEMENT_ENCODING, EPOCH_ORDINAL
+
+
+# how many records are written at a time
+EXPORT_BATCH_SIZE = 10000
+
+# the columns in every format
+FIELDS = TableRow._fields
+
+# start of a columnar file, the version is the last character
+COLUMNAR_MAGIC = 'MONEYCOL1'
+
+# strings in a row group are joined up by this, like the cache
+STRING_SEPARATOR = '\0'
+
+# file extensions export uses to pick a format
+EXTENSIONS = {'.csv' : 'csv',
+              '.jsonl' : 'jsonl',
+              '.json' : 'jsonl',
+              '.col' : 'columnar'}
+
+
+def _rows(records):
+    """yields (TableRow, sequence) for each record, records can be
+    record objects, TableRows or a TransactionTable. sequence orders
+    rows on the same day (see Transaction.sort_key), bare TableRows
+    dont have one so they are numbered in the order they come"""
+
+    if hasattr(records, 'place_codes'):
+        records = izip(records, records.sequence)
+    else:
+        records = ((record, None) for record in records)
+
+    for number, (record, sequence) in enumerate(records):
+        if not isinstance(record, tuple):
+            sequence = record.sort_key()[1]
+            record = TableRow(record._date, record.get_description(), record.get_place(),
+                              record.get_amount(), record.get_balance(),
+                              record.get_trans_type())
+        elif sequence is None:
+            sequence = number
+
+        # tables from the database have unicode strings, everything
+        # else has statement encoded ones
+        if any(isinstance(field, unicode) for field in record):
+            record = TableRow(*[field.encode(STATEMENT_ENCODING)
+                                if isinstance(field, unicode) else field
+                                for field in record])
+        yield record, sequence
+
+
+def _batches(rows, batch_size):
+    """yields lists of up to batch_size rows"""
+
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def write_csv(records, out, batch_size=EXPORT_BATCH_SIZE):
+    """Writes records to the file object out as CSV with a header
+    row, dates as yyyy-mm-dd. Returns how many records were written"""
+
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+
+    written = 0
+    for batch in _batches(_rows(records), batch_size):
+        writer.writerows((row.date.strftime("%Y-%m-%d"),) + row[1:] for row, _ in batch)
+        written += len(batch)
+    return written
+
+
+def write_jsonl(records, out, batch_size=EXPORT_BATCH_SIZE):
+    """Writes records to the file object out as JSON Lines, one
+    object per record with FIELDS as keys and dates as yyyy-mm-dd.
+    Returns how many records were written"""
+
+    written = 0
+    for batch in _batches(_rows(records), batch_size):
+        lines = []
+        for row, _ in batch:
+            row = row._replace(date=row.date.strftime("%Y-%m-%d"))
+            lines.append(json.dumps(row._asdict(), encoding=STATEMENT_ENCODING,
+                                    sort_keys=True))
+        lines.append('')
+        out.write('\n'.join(lines))
+        written += len(batch)
+    return written
+
+
+def _write_block(out, data):
+    """writes a length prefixed block of bytes"""
+
+    out.write(struct.pack('<Q', len(data)))
+    out.write(data)
+
+
+def _write_strings(out, strings):
+    """writes a list of strings as a count and a block of them
+    joined up, the count means a lone empty string isnt lost"""
+
+    out.write(struct.pack('<I', len(strings)))
+    _write_block(out, STRING_SEPARATOR.join(strings))
+
+
+def _read_block(statement):
+    """reads a block written by _write_block"""
+
+    header = statement.read(8)
+    if len(header) < 8:
+        raise EOFError("columnar file ends part way through a row group")
+    length, = struct.unpack('<Q', header)
+    data = statement.read(length)
+    if len(data) < length:
+        raise EOFError("columnar file ends part way through a row group")
+    return data
+
+
+def write_columnar(records, out, batch_size=EXPORT_BATCH_SIZE):
+    """Writes records to the file object out (opened in binary mode)
+    in the columnar format, one row group per batch. Arrays are
+    written in this machines byte order, which goes in the header so
+    read_columnar can swap them if it needs to. Returns how many
+    records were written"""
+
+    out.write(COLUMNAR_MAGIC)
+    out.write('L' if sys.byteorder == 'little' else 'B')
+
+    written = 0
+    for batch in _batches(_rows(records), batch_size):
+        table = TransactionTable()
+        for row, sequence in batch:
+            table.append(row.date.toordinal() - EPOCH_ORDINAL, row.description,
+                         row.place, row.amount, row.balance, row.trans_type,
+                         sequence)
+
+        out.write(struct.pack('<I', len(table)))
+        for name in TransactionTable._arrays:
+            column = getattr(table, name)
+            out.write(struct.pack('<cB', column.typecode, column.itemsize))
+            _write_block(out, column.tostring())
+        for name in ('descriptions', 'places', 'trans_types'):
+            _write_strings(out, getattr(table, name))
+        written += len(batch)
+    return written
+
+
+def read_columnar(path):
+    """Generator that yields a TransactionTable for each row group
+    of the columnar file at path"""
+
+    with open(path, 'rb') as statement:
+        magic = statement.read(len(COLUMNAR_MAGIC) + 1)
+        if magic[:-1] != COLUMNAR_MAGIC:
+            raise ValueError("{} isnt a columnar export".format(path))
+        swap = magic[-1] != ('L' if sys.byteorder == 'little' else 'B')
+
+        while True:
+            header = statement.read(4)
+            if not header:
+                break
+            length, = struct.unpack('<I', header)
+
+            columns = {}
+            for name in TransactionTable._arrays:
+                typecode, itemsize = struct.unpack('<cB', statement.read(2))
+                column = array(typecode)
+                if column.itemsize != itemsize:
+                    msg = "{} was written with {} byte {} arrays, here they are {}"
+                    raise ValueError(msg.format(path, itemsize, name, column.itemsize))
+                column.fromstring(_read_block(statement))
+                if swap:
+                    column.byteswap()
+                columns[name] = column.tostring()
+
+            strings = {}
+            for name in ('descriptions', 'places', 'trans_types'):
+                count, = struct.unpack('<I', statement.read(4))
+                joined = _read_block(statement)
+                strings[name] = joined.split(STRING_SEPARATOR) if count else []
+
+            table = TransactionTable.from_columns(columns, **strings)
+            if len(table) != length:
+                raise ValueError("{} has a broken row group".format(path))
+            yield table
+
+
+def load_columnar(path):
+    """reads the whole columnar file at path into one TransactionTable"""
+
+    return TransactionTable.concatenate(list(read_columnar(path)))
+
+
+WRITERS = {'csv' : write_csv,
+           'jsonl' : write_jsonl,
+           'columnar' : write_columnar}
+
+
+def export(records, path, format=None, batch_size=EXPORT_BATCH_SIZE):
+    """Writes records to the file at path in format (csv, jsonl or
+    columnar), by default worked out from the extension of path.
+    Returns how many records were written"""
+
+    if format is None:
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in EXTENSIONS:
+            msg = "cant tell what format {} should be, give one of {}"
+            raise ValueError(msg.format(path, ', '.join(sorted(WRITERS))))
+        format = EXTENSIONS[extension]
+
+    if format not in WRITERS:
+        msg = "format should be one of {} not {}"
+        raise ValueError(msg.format(', '.join(sorted(WRITERS)), format))
+
+    with open(path, 'wb') as out:
+        return WRITERS[format](records, out, batch_size)
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+
+"""Long running service that watches a drop directory and imports
+any statement put in it into a database.TransactionStore, so new
+statements can be queried seconds after they turn up.
+
+Three kinds of thread share the work:
+
+    watcher   polls the directory and queues files that have stopped
+              changing (same size and mtime on two polls in a row)
+    parsers   a fixed number of them, each takes a file off the queue
+              and parses it in batches with its own read connection
+    writer    the only thread that writes to the database, it commits
+              each batch as it arrives
+
+Both queues are bounded so a burst of big statements cant fill
+memory, parsers wait for the writer and the watcher waits for the
+parsers. stop() (or SIGINT/SIGTERM when run from the command line)
+stops the watcher, lets the parsers finish the batch they are on and
+the writer commit everything it has been given before closing the
+database. A file stopped part way through isnt marked as imported, so
+it is read again next time and the records it already stored are
+skipped by their fingerprints.
+
+Statements are best moved into the directory rather than written in
+it, a file being written slowly is only picked up once it settles"""
+
+import os
+import sys
+import stat
+import Queue
+import signal
+import argparse
+import threading
+from itertools import islice
+
+from money import detect_parser, Quarantine, ERROR_MODES
+from database import TransactionStore, DATABASE_PATH
+
+
+# seconds between looks at the drop directory
+POLL_INTERVAL = 2.0
+
+# threads parsing statements at once
+PARSE_WORKERS = 2
+
+# records in each batch handed to the writer, one commit each
+INGEST_BATCH_SIZE = 500
+
+# batches that can be waiting for the writer
+QUEUE_SIZE = 8
+
+
+class IngestService(object):
+    """Watches directory and imports statements into the database at
+    database_path, see the module docstring. errors is passed on to
+    the parsers, by default bad records are quarantined rather than
+    stopping the import. imported is how many records have been
+    inserted and failures a list of (path, exception) for statements
+    that couldnt be imported"""
+
+    def __init__(self, directory, database_path=DATABASE_PATH, workers=PARSE_WORKERS,
+                 poll_interval=POLL_INTERVAL, batch_size=INGEST_BATCH_SIZE,
+                 queue_size=QUEUE_SIZE, errors="collect"):
+        """constructor, nothing starts until start or run is called"""
+
+        if errors not in ERROR_MODES:
+            msg = "errors should be one of {} not {}"
+            raise ValueError(msg.format(', '.join(ERROR_MODES), errors))
+        if workers < 1:
+            raise ValueError("workers should be at least 1 not {}".format(workers))
+
+        self.directory = directory
+        self.database_path = database_path
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.errors = errors
+
+        self.imported = 0
+        self.failures = []
+
+        self._stopping = threading.Event()
+        self._files = Queue.Queue(workers)
+        self._batches = Queue.Queue(queue_size)
+        self._threads = []
+
+        # path -> (size, mtime) on the last poll and when it was queued
+        self._seen = {}
+        self._queued = {}
+        # paths queued or being imported, only the writer removes them
+        self._busy = set()
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """returns {path: (size, mtime)} for the files in the directory,
+        hidden files are left out so editors temporary files are too"""
+
+        found = {}
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                # gone since listdir
+                continue
+            if stat.S_ISREG(info.st_mode):
+                found[path] = (info.st_size, info.st_mtime)
+        return found
+
+    def poll(self):
+        """Looks at the directory once and queues every file that has
+        settled and changed since it was last queued, waiting if the
+        parsers are behind. Returns how many files were queued"""
+
+        found = self._scan()
+        queued = 0
+
+        for path, state in sorted(found.items()):
+            with self._lock:
+                wanted = (self._seen.get(path) == state and
+                          self._queued.get(path) != state and
+                          path not in self._busy)
+                if wanted:
+                    self._busy.add(path)
+            if not wanted:
+                continue
+
+            if not self._put_file(path):
+                with self._lock:
+                    self._busy.discard(path)
+                break
+            self._queued[path] = state
+            queued += 1
+
+        self._seen = found
+        self._queued = dict((path, state) for path, state in self._queued.items()
+                            if path in found)
+        return queued
+
+    def _put_file(self, path):
+        """queues path for the parsers, waiting while they are busy.
+        Returns False without queuing it if the service is stopping"""
+
+        while not self._stopping.is_set():
+            try:
+                self._files.put(path, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _watch(self):
+        """watcher thread, polls until the service stops"""
+
+        while not self._stopping.is_set():
+            try:
+                self.poll()
+            except OSError as error:
+                # the directory might be back next time
+                self._batches.put(('failed', self.directory, error))
+            self._stopping.wait(self.poll_interval)
+
+    def _parse(self):
+        """parser thread, imports queued files until the service stops"""
+
+        # only ever read through, the writer has the only one that writes
+        store = TransactionStore(self.database_path)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    path = self._files.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                try:
+                    self._parse_file(store, path)
+                except Exception as error:
+                    # one bad statement shouldnt stop the service
+                    self._batches.put(('failed', path, error))
+        finally:
+            store.close()
+
+    def _parse_file(self, store, path):
+        """parses path in batches for the writer, finishing with a
+        done message unless the service stops part way through"""
+
+        plan = store.plan_import(path)
+        if plan is None:
+            self._batches.put(('done', path, None, None))
+            return
+
+        quarantine = Quarantine()
+        records = detect_parser(path).iter_statement(plan[0], offset=plan[4],
+                                                     skip=store.stored_fingerprints(),
+                                                     errors=self.errors,
+                                                     quarantine=quarantine)
+        while True:
+            batch = list(islice(records, self.batch_size))
+            if not batch:
+                break
+            self._batches.put(('records', path, batch))
+            if self._stopping.is_set():
+                return
+
+        self._batches.put(('done', path, plan, quarantine))
+
+    def _write(self):
+        """writer thread, stores whatever the parsers send it until it
+        gets None"""
+
+        store = TransactionStore(self.database_path)
+        failed = set()
+        try:
+            while True:
+                message = self._batches.get()
+                if message is None:
+                    break
+                kind, path = message[:2]
+
+                try:
+                    if kind == 'failed':
+                        raise message[2]
+                    if path in failed:
+                        pass
+                    elif kind == 'records':
+                        self.imported += store.insert(message[2], self.batch_size)
+                    elif message[2] is not None:
+                        store.finish_import(message[2], message[3])
+                except Exception as error:
+                    failed.add(path)
+                    self.failures.append((path, error))
+                    sys.stderr.write("couldnt import {}: {}\n".format(path, error))
+
+                if kind != 'records':
+                    failed.discard(path)
+                    with self._lock:
+                        self._busy.discard(path)
+        finally:
+            store.close()
+
+    def start(self):
+        """starts the writer, the parsers and the watcher"""
+
+        # make sure the tables are there before the parsers read them
+        TransactionStore(self.database_path).close()
+
+        targets = [self._write] + [self._parse] * self.workers + [self._watch]
+        for target in targets:
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """asks the service to stop, see join"""
+
+        self._stopping.set()
+
+    def join(self):
+        """waits for the watcher and parsers to stop and then for the
+        writer to store everything they sent it"""
+
+        writer, others = self._threads[0], self._threads[1:]
+        for thread in others:
+            thread.join()
+        self._batches.put(None)
+        writer.join()
+        self._threads = []
+
+    def run(self):
+        """starts the service and waits until stop is called, from a
+        signal handler say, then stops it"""
+
+        self.start()
+        try:
+            while not self._stopping.is_set():
+                # a timeout so signals get handled on python 2
+                self._stopping.wait(1.0)
+        finally:
+            self.stop()
+            self.join()
+
+
+def parse_args():
+    """parse command line arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory',
+            help='the drop directory to watch for statements',
+            type=str)
+    parser.add_argument('-d', '--database',
+            default=DATABASE_PATH,
+            help='the database to import into',
+            type=str)
+    parser.add_argument('-j', '--workers',
+            default=PARSE_WORKERS,
+            help='number of statements to parse at once',
+            type=int)
+    parser.add_argument('--interval',
+            default=POLL_INTERVAL,
+            help='seconds between looks at the directory',
+            type=float)
+    parser.add_argument('--errors',
+            default="collect",
+            choices=ERROR_MODES,
+            help='stop at a bad record or quarantine it and carry on')
+
+    return parser.parse_args()
+
+
+def main():
+    """main entry point"""
+
+    args = parse_args()
+    service = IngestService(args.directory, args.database, workers=args.workers,
+                            poll_interval=args.interval, errors=args.errors)
+
+    def shutdown(signum, frame):
+        service.stop()
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    service.run()
+    sys.stderr.write("imported {} records, {} statements failed\n".format(
+        service.imported, len(service.failures)))
+    return 1 if service.failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
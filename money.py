@@ -8,12 +8,59 @@ and trys to give a more logical breakdown of what
 has been spent"""
 
 
+import os
 import re
 import datetime
 import time
 import sys
 import csv
 import argparse
+import hashlib
+import heapq
+import multiprocessing
+import mmap
+import threading
+import analytics
+from places import PlaceNormaliser
+from categories import Categoriser
+from array import array
+from collections import OrderedDict, namedtuple
+
+
+# statement records are seperated by this, one of the reasons
+# the santander format is so ugly
+RECORD_SEPARATOR = '\r\n\t\t\t\t\t\t\r\n'
+
+# date, description, amount and balance
+RECORD_LINES = 4
+
+# santander statements are latin-1 which is where all the non
+# breaking spaces come from. Fields are kept as latin-1 byte strings
+STATEMENT_ENCODING = 'latin-1'
+NBSP = u'\xa0'.encode(STATEMENT_ENCODING)
+
+# how much of the statement is read in one go when streaming
+CHUNK_SIZE = 64 * 1024
+
+# how much of a file is hashed at a time
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# bump this whenever a change to the parser changes what it produces,
+# it throws away anything cached by an older version
+PARSER_VERSION = 1
+
+# how many distinct date strings DateParser remembers
+DATE_CACHE_SIZE = 1024
+
+# dates are often stored as days since this
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+# what the errors argument of the parsers can be, "strict" raises on
+# the first record that cant be parsed and "collect" puts it in a
+# Quarantine and carries on
+ERROR_MODES = ("strict", "collect")
 
 
 ### Exception Classes
@@ -30,11 +77,538 @@ class RecordError(Exception):
     pass
 
 
+# what a bad record can raise, anything else is a real bug
+PARSE_ERRORS = (RecordError, BadFile, ValueError, TypeError)
+
+
+### Quarantine
+
+# a record that couldnt be parsed. fields are the keyword arguments
+# for the parser class to build the record again, or None if the
+# record itself is broken and there is nothing to try again with
+QuarantinedRecord = namedtuple('QuarantinedRecord',
+                               'parser path offset error message fields')
+
+
+class Quarantine(object):
+    """Somewhere for the parsers to put records they cant parse when
+    errors="collect", so one odd record doesnt throw away the rest
+    of a big statement. The raw fields are kept so after the parser
+    is fixed only these records need parsing again, see retry"""
+
+    def __init__(self, records=()):
+        """constructor, records is any QuarantinedRecords to start with"""
+
+        self.records = list(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def add(self, parser, path, offset, error, fields=None):
+        """quarantines the record at offset in path that parser
+        raised error for"""
+
+        self.records.append(QuarantinedRecord(parser.__name__, path, offset,
+                                              type(error).__name__,
+                                              str(error), fields))
+
+    def extend(self, other):
+        """adds everything in another quarantine to this one"""
+
+        self.records.extend(other.records)
+
+    def counts(self):
+        """returns a dict of error type -> how many records had it"""
+
+        counts = {}
+        for record in self.records:
+            counts[record.error] = counts.get(record.error, 0) + 1
+        return counts
+
+    def retry(self):
+        """Tries parsing the quarantined records again, from their
+        fields so the statements arent read. Returns a list of the
+        records that parse now, the rest stay in the quarantine"""
+
+        recovered = []
+        remaining = []
+        for record in self.records:
+            if record.fields is None:
+                # broken in the file, no parser fix will help
+                remaining.append(record)
+                continue
+
+            parser = _parser_named(record.parser)
+            try:
+                recovered.append(parser(position=record.offset, **record.fields))
+            except PARSE_ERRORS as error:
+                remaining.append(record._replace(error=type(error).__name__,
+                                                 message=str(error)))
+
+        self.records = remaining
+        return recovered
+
+
+### Helper Functions
+
+def _split_records(statement, separator, chunk_size=CHUNK_SIZE, limit=None):
+    """Generator that reads a file object chunk_size bytes at a time
+    and yields (offset, text) for the text between each separator,
+    offset being how far into the read it started. Separators that
+    are split across two chunks are still found because the
+    unsearched tail of the buffer is carried over to the next read.
+    If limit is given no more than limit bytes are read"""
+
+    buf = ''
+    # how far into the read buf starts
+    buf_offset = 0
+    while True:
+        size = chunk_size
+        if limit is not None:
+            size = min(size, limit - buf_offset - len(buf))
+            if size <= 0:
+                break
+
+        chunk = statement.read(size)
+        if not chunk:
+            break
+
+        # only search the new data plus enough of the old
+        # to catch a separator straddling the boundary
+        search_from = max(0, len(buf) - len(separator) + 1)
+        buf += chunk
+        start = 0
+        end = buf.find(separator, search_from)
+        while end != -1:
+            yield buf_offset + start, buf[start:end]
+            start = end + len(separator)
+            end = buf.find(separator, start)
+        buf = buf[start:]
+        buf_offset += start
+
+    # whatever is left is the last record
+    if buf:
+        yield buf_offset, buf
+
+
+def _record_fields(buf, start, stop):
+    """Pulls the fields out of the record between start and stop in
+    buf, which can be a str or an mmap. Only that record is copied
+    out of buf. Returns a dict of field name to value or None if it
+    isnt a four line record (the statement header for instance)
+
+    eg "Date:\xa007/02/2013\r\nDescription:\xa0BILL PAYMENT TO..."
+    gives {'date' : '07/02/2013', 'description' : 'BILL PAYMENT TO...'}
+    """
+
+    # slicing the record once and splitting it is quicker than
+    # finding each field in buf, method calls cost more than copying
+    # a couple of hundred bytes
+    lines = buf[start:stop].split('\r\n')
+    if len(lines) != RECORD_LINES:
+        return None
+
+    fields = {}
+    for line in lines:
+        # everything after the first colon, descriptions can have them
+        name, _, value = line.partition(':')
+        fields[name.strip(NBSP).lower()] = value.strip(NBSP)
+
+    # we expect to have date, amount, balance and description
+    # in all records.
+    for fld in ("date" ,"amount", "balance", "description"):
+        if fld not in fields:
+            # our statement must be broken
+            msg = "Is the statement broken/currupt\n"
+            msg += "trying to parse:\n{}"
+            raise BadFile(msg.format(buf[start:stop]))
+
+    return fields
+
+
+def _checked_fields(buf, start, stop, errors):
+    """_record_fields but if errors is "collect" a broken record
+    gives the BadFile exception instead of raising it"""
+
+    try:
+        return _record_fields(buf, start, stop)
+    except BadFile as error:
+        if errors != "collect":
+            raise
+        return error
+
+
+def _mapped_records(buf, start, end, separator=RECORD_SEPARATOR, errors="strict"):
+    """Generator that yields (offset, fields) for each record in buf
+    (usually an mmap of the statement) between start and end. The
+    separators are found in place so the statement is never read
+    into one big string, see _record_fields. If errors is "collect"
+    fields is the exception for records that are broken"""
+
+    position = start
+    while position < end:
+        stop = buf.find(separator, position, end)
+        if stop == -1:
+            stop = end
+
+        fields = _checked_fields(buf, position, stop, errors)
+        if fields is not None:
+            yield position, fields
+        position = stop + len(separator)
+
+
+def _read_records(statement, offset, end=None, chunk_size=CHUNK_SIZE, errors="strict"):
+    """Generator that does the same as _mapped_records for file
+    objects that cant be mapped, statement should already be at
+    offset"""
+
+    limit = None if end is None else end - offset
+    for position, record in _split_records(statement, RECORD_SEPARATOR,
+                                           chunk_size, limit):
+        fields = _checked_fields(record, 0, len(record), errors)
+        if fields is not None:
+            yield offset + position, fields
+
+
+def _check_errors(errors, quarantine):
+    """makes sure errors is a mode we know and that there is
+    somewhere to put records in "collect" mode"""
+
+    if errors not in ERROR_MODES:
+        msg = "errors should be one of {} not {!r}"
+        raise ValueError(msg.format(', '.join(ERROR_MODES), errors))
+    if errors == "collect" and quarantine is None:
+        raise ValueError('errors="collect" needs a quarantine to put records in')
+
+
+def file_digest(path, upto=None):
+    """Hashes a file in chunks. If upto is given returns a tuple
+    of the sha1 hex digest of the first upto bytes and of the whole
+    file, so checking an old import and hashing the new one only
+    reads the file once. Otherwise just returns the whole files
+    digest"""
+
+    prefix = None
+    sha = hashlib.sha1()
+    read = 0
+
+    with open(path, 'rb') as statement:
+        while True:
+            size = HASH_CHUNK_SIZE
+            if upto is not None and prefix is None:
+                size = min(size, upto - read)
+                if size == 0:
+                    prefix = sha.hexdigest()
+                    continue
+
+            chunk = statement.read(size)
+            if not chunk:
+                break
+            sha.update(chunk)
+            read += len(chunk)
+
+    if upto is None:
+        return sha.hexdigest()
+    return prefix, sha.hexdigest()
+
+
+def _date_bounds(date_range):
+    """turns a date_range of two dd-mm-yyyy strings into a tuple of
+    datetimes"""
+
+    date_format = "%d-%m-%Y"
+    return (datetime.datetime.strptime(date_range[0], date_format),
+            datetime.datetime.strptime(date_range[1], date_format))
+
+
+def _find_boundaries(path, separator, parts):
+    """Splits a file into roughly parts equal byte ranges that each
+    start at a separator, so no record is cut in half. Uses mmap so
+    finding them doesnt read the file. Returns a list of (start, end)
+    tuples covering the whole file"""
+
+    size = os.path.getsize(path)
+    if size == 0:
+        return [(0, 0)]
+
+    with open(path, 'rb') as statement:
+        mapped = mmap.mmap(statement.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            boundaries = [0]
+            for part in xrange(1, parts):
+                found = mapped.find(separator, max(size * part // parts,
+                                                   boundaries[-1] + 1))
+                if found == -1:
+                    break
+                boundaries.append(found)
+        finally:
+            mapped.close()
+
+    boundaries.append(size)
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+def _pool_map(func, jobs, workers=None):
+    """map that runs func over jobs in a process pool, workers
+    processes at a time (one per cpu by default). func has to be
+    at the top level of a module so it can be pickled. Runs here
+    when there is only one job or one worker"""
+
+    if workers == 1 or len(jobs) <= 1:
+        # not worth starting processes for
+        return map(func, jobs)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _sort_records(records):
+    """sorts a list of records into the order they happened, see
+    Transaction.sort_key"""
+
+    records.sort(key=Transaction.sort_key)
+
+
+# an amount of money as it is in a statement, pounds and pence
+MONEY_REGEX = re.compile(r'([+-]?)(\d*)(?:\.(\d{1,2}))?$')
+
+
+def parse_pence(amount_string):
+    """Turns an amount like "-200.01" into a whole number of pence,
+    exactly, so balances can be checked without float rounding.
+    Raises ValueError if it isnt an amount of money"""
+
+    match = MONEY_REGEX.match(amount_string)
+    if match is None or not (match.group(2) or match.group(3)):
+        raise ValueError("{!r} isnt an amount of money".format(amount_string))
+
+    sign, pounds, pence = match.groups()
+    value = int(pounds or 0) * 100 + int((pence or '0').ljust(2, '0'))
+    return -value if sign == '-' else value
+
+
+def _compile_prefix_matcher(trans_types):
+    """Builds a single regex that matches any of the transaction
+    type names (upper cased) at the start of a description. Each
+    type gets its own named group so match.lastgroup tells us which
+    one matched. Returns the compiled regex and a dict mapping group
+    names back to the transaction type"""
+
+    groups = {}
+    alternatives = []
+    # longest first so a type never loses out to a shorter prefix
+    for index, trans_type in enumerate(sorted(trans_types, key=len, reverse=True)):
+        name = 't{}'.format(index)
+        groups[name] = trans_type
+        alternatives.append('(?P<{}>{})'.format(name, re.escape(trans_type.upper())))
+
+    return re.compile('|'.join(alternatives)), groups
+
+
+### Date Parsing
+
+class DateParser(object):
+    """Turns the date strings found in statements into datetime
+    objects. Rather than trying a regex for every layout it looks
+    at the length of the string and where the separators are, and
+    it remembers the most recently used strings because statements
+    use the same few hundred dates over and over. The cache is
+    locked so parsers in different threads can share one"""
+
+    _months = {'JAN' : 1, 'FEB' : 2, 'MAR' : 3, 'APR' : 4,
+               'MAY' : 5, 'JUN' : 6, 'JUL' : 7, 'AUG' : 8,
+               'SEP' : 9, 'OCT' : 10, 'NOV' : 11, 'DEC' : 12}
+
+    def __init__(self, maxsize=DATE_CACHE_SIZE):
+        """constructor, maxsize is how many strings to remember"""
+
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, date_string, year=None):
+        """returns a datetime for date_string or None if it is not
+        a layout we know. year is used for layouts like 21JAN that
+        dont have one, without it they also return None"""
+
+        cache = self._cache
+        with self._lock:
+            try:
+                # popping and putting back moves it to the young end
+                date, has_year = cache.pop(date_string)
+                self.hits += 1
+            except KeyError:
+                date, has_year = self._parse(date_string)
+                self.misses += 1
+                if len(cache) >= self._maxsize:
+                    # throw away the least recently used
+                    cache.popitem(last=False)
+            cache[date_string] = (date, has_year)
+
+        if date is None or has_year:
+            return date
+
+        if year is None:
+            return None
+
+        try:
+            return date.replace(year=year)
+        except ValueError:
+            # 29FEB in a year that isnt a leap year
+            return None
+
+    def _parse(self, date_string):
+        """does the actual work for parse, returns a tuple of the
+        datetime (None if we cant parse it) and whether the string
+        had a year in it. Year-less dates use 2000 as a placeholder
+        because it is a leap year"""
+
+        length = len(date_string)
+        day = month = year = None
+
+        if length in (8, 10) and date_string[2] in '/-' and date_string[5] in '/-':
+            # dd-mm-yy or dd-mm-yyyy eg "01/11/2012"
+            day, month, year = date_string[:2], date_string[3:5], date_string[6:]
+
+        elif length == 10 and date_string[4] in '/-' and date_string[7] in '/-':
+            # yyyy-mm-dd eg "2012-11-01"
+            day, month, year = date_string[8:], date_string[5:7], date_string[:4]
+
+        elif length in (5, 7, 9) and date_string[2:5].isalpha():
+            # ddmmm, ddmmmyy or ddmmmyyyy eg "21JAN" or "01NOV12"
+            day, month, year = date_string[:2], date_string[2:5], date_string[5:]
+
+        elif length in (6, 9, 11) and date_string[2] in '/-' and date_string[3:6].isalpha():
+            # dd-mmm, dd-mmm-yy or dd-mmm-yyyy eg "21-JAN-2013"
+            if length > 6 and date_string[6] not in '/-':
+                return None, False
+            day, month, year = date_string[:2], date_string[3:6], date_string[7:]
+
+        else:
+            return None, False
+
+        if not day.isdigit() or not (year.isdigit() or year == ''):
+            return None, False
+
+        if month.isdigit():
+            month = int(month)
+        else:
+            month = self._months.get(month.upper())
+            if month is None:
+                return None, False
+
+        has_year = year != ''
+        if not has_year:
+            year = 2000
+        elif len(year) == 2:
+            year = 2000 + int(year)
+        else:
+            year = int(year)
+
+        try:
+            return datetime.datetime(year, month, int(day)), has_year
+        except ValueError:
+            # something like 31/02/2013
+            return None, False
+
+
+### Parser Registry
+
+# how much of a statement the sniffers get to look at
+SNIFF_SIZE = 512
+
+# Transaction subclasses that can parse a whole statement, in the
+# order their sniffers are tried
+_parsers = []
+
+
+def register_parser(cls):
+    """Class decorator that adds a Transaction subclass to the
+    parsers detect_parser chooses from. The class needs a sniff
+    staticmethod that takes the first SNIFF_SIZE bytes of a file and
+    says whether it is one of its statements, and iter_statement and
+    parse_statement staticmethods like Santanders"""
+
+    _parsers.append(cls)
+    return cls
+
+
+def parsers():
+    """returns the registered parser classes"""
+
+    return list(_parsers)
+
+
+def _parser_named(name):
+    """returns the registered parser class called name"""
+
+    for parser in _parsers:
+        if parser.__name__ == name:
+            return parser
+    raise KeyError("no parser called {}".format(name))
+
+
+def detect_parser(path):
+    """Works out which registered parser the statement at path is
+    for from its first few bytes, without parsing any of it. Raises
+    BadFile if none of them want it"""
+
+    with open(path, 'rb') as statement:
+        head = statement.read(SNIFF_SIZE)
+
+    for parser in _parsers:
+        if parser.sniff(head):
+            return parser
+
+    raise BadFile("{} doesnt look like any statement I know".format(path))
+
+
+def iter_statement(path, date_range="all", **kwargs):
+    """iter_statement of whichever parser the statement at path is
+    for, kwargs are passed on to it"""
+
+    return detect_parser(path).iter_statement(path, date_range, **kwargs)
+
+
+def parse_statement(path, date_range="all", sort=True, errors="strict"):
+    """parse_statement of whichever parser the statement at path is
+    for, returns a list of record objects (and a Quarantine if errors
+    is "collect")"""
+
+    return detect_parser(path).parse_statement(path, date_range, sort=sort,
+                                               errors=errors)
+
+
 ### Application Classes
 
 class Transaction(object):
     """Base Transaction Class: All bank statement records
     inherret from inherit from here"""
+
+    # no __dict__ per record, there can be millions of them
+    __slots__ = ('_date', '_amount', '_description', '_ordinal',
+                 '_trans_type', '_place', '_balance', '_fingerprint',
+                 '_position')
+
+    # shared by every record so the date and place caches are too
+    _date_parser = DateParser()
+    _place_normaliser = PlaceNormaliser()
+
+    # which bank the record came from, set by the subclasses
+    _account = None
+
+    # whether the bank lists the latest transaction first, if so
+    # records on the same day are in reverse order in the file
+    _newest_first = False
     
     def __init__(self):
         """constructor, initialises everything to None"""
@@ -42,10 +616,12 @@ class Transaction(object):
         self._date = None
         self._amount = None
         self._description = None
-        self._timestamp = None
+        self._ordinal = None
         self._trans_type = None
         self._place = None
         self._balance = None
+        self._fingerprint = None
+        self._position = 0
         
     def __repr__(self):
         return self._description
@@ -63,9 +639,8 @@ class Transaction(object):
         
         # looks to see if we have the regex before trying to match
         if self._trans_type in self._trans_regex_map:
-            match = re.match(self._trans_regex_map[self._trans_type],
-                             self._description, 
-                             re.I|re.VERBOSE) 
+            pattern = self._trans_regex_map[self._trans_type]
+            match = pattern.match(self._description)
                 
             if match is not None:
                 # looks like we have found a match
@@ -77,7 +652,7 @@ class Transaction(object):
             else:
                 # No match? either bug or new transaction pattern: BAIL OUT
                 msg = "Trying to Parse:\n{}\n".format(self._description)
-                msg += "With: {}".format(self._trans_regex_map[self._trans_type])
+                msg += "With: {}".format(pattern.pattern)
                 raise RecordError(msg)
             
     
@@ -93,44 +668,19 @@ class Transaction(object):
             raise TypeError(msg.format(type(date_string)))
         
         date_string = date_string.strip(" \t\xa0")
-        
-       
-       # which date do we have dd-mm-yy, dd-mm-yyyy or even
-       # yyyy-mm-dd
-        date_patterns = (r"""(?P<day>\d{2})[/-]
-                            (?P<month>\d{2})[/-]
-                            (?P<year>\d{2}|\d{4})$""",
-
-                          r"""(?P<year>\d{4})[/-]
-                            (?P<month>\d{2})[/-]
-                            (?P<day>\d{2})$""")
-        
-        for pattern in date_patterns:
-            date = re.match(pattern, date_string, re.VERBOSE)
-
-            if date:
-                # BOOM its either on of the three above
-                d = int(date.groupdict()['day'])
-                m = int(date.groupdict()['month'])
-                y = date.groupdict()['year']
-                if len(y) == 2:
-                    y = '20' + y
-                y = int(y)
-                self._date = datetime.datetime(y, m, d)
-                return 0
-
-        # maybe its dd-mmm eg "21JAN"
-        if re.match(r"^\d{2}\w{3}$", date_string):
-             date = re.match(r"^(?P<day>\d{2})(?P<month>\w{3})$", date_string)
-             d = date.groupdict()['day']
-             m = date.groupdict()['month']
-             # just use the year in the statement
-             y = str(self._date.year)
-             self._date = datetime.strptime(d+m+y, '%d%b%y')
-             return 0
-       
+
+        # dates like 21JAN dont have a year so borrow the statements
+        year = self._date.year if self._date else None
+        date = self._date_parser.parse(date_string, year)
+
+        if date is not None:
+            # BOOM its one of the layouts DateParser knows about
+            self._date = date
+            self._ordinal = date.toordinal()
+            return 0
+
         # nothing works but we still have the date in the statement
-        elif self._date:
+        if self._date:
             return 0
    
         # no date in the statement and a bad description
@@ -145,8 +695,8 @@ class Transaction(object):
         """Sets the name of person or business we have paid.
         firstly we check the type"""
 
-        # TODO maybe we need a seperate place class so we can
-        # fix things like store numbers and weird names
+        # store numbers and weird names are sorted out by
+        # get_place, this keeps what the statement said
 
         if type(place_string) is not str:
             msg = "place_string needs to be str\n"
@@ -165,16 +715,35 @@ class Transaction(object):
         if type(amount_string) is not str:
             msg = "amount_string needs to be str\n"
             msg += "got {} instead"
-            raise TypeError(msg.format(type(date_string)))
+            raise TypeError(msg.format(type(amount_string)))
         
+        # kept in pence, get_amount turns it into pounds
         amount_string = amount_string.strip(" \xa0\tGBP") 
-        self._amount = float(amount_string)
+        self._amount = parse_pence(amount_string)
+
+
+    def set_balance(self, balance_string):
+        """Sets the balance after the transaction, cleaned up
+        the same way as the amount"""
+
+        if type(balance_string) is not str:
+            msg = "balance_string needs to be str\n"
+            msg += "got {} instead"
+            raise TypeError(msg.format(type(balance_string)))
+
+        balance_string = balance_string.strip(" \xa0\tGBP")
+        self._balance = parse_pence(balance_string)
+
 
     def get_place(self):
-        """returns the place"""
+        """returns the place as a canonical places.Place, so
+        "TESCO STORES-2889" and "TESCO UPT 3896" are both TESCO"""
+
+        return self._place_normaliser.normalise(self._place)
 
-        # TODO, will be more useful when there is a seperate
-        # place class
+
+    def get_raw_place(self):
+        """returns the place as it was in the statement"""
 
         return self._place
 
@@ -201,148 +770,318 @@ class Transaction(object):
         """returns the amount a transaction costed"""
 
         # might add pound symbol or something in the future
+        return self._amount / 100.0
+
+
+    def get_balance(self):
+        """returns the balance after the transaction"""
+
+        if self._balance is None:
+            return None
+        return self._balance / 100.0
+
+
+    def get_amount_pence(self):
+        """returns the amount as a whole number of pence"""
+
         return self._amount
 
 
+    def get_balance_pence(self):
+        """returns the balance after the transaction in pence"""
+
+        return self._balance
+
+
+    def get_trans_type(self):
+        """returns the transaction type eg 'Card Payment'"""
+
+        return self._trans_type
+
+
+    def get_account(self):
+        """returns the name of the bank the record came from"""
+
+        return self._account
+
+
+    def get_fingerprint(self):
+        """returns the fingerprint of the record, see make_fingerprint"""
+
+        return self._fingerprint
+
+
+    @staticmethod
+    def make_fingerprint(date, description, amount, balance):
+        """Hashes the fields of a record as they appear in the
+        statement. Two records with the same fingerprint are the same
+        transaction, the balance stops genuine repeats (two coffees in
+        one day) from clashing"""
+
+        fields = [field.strip(" \t\xa0") for field in (date, description, amount, balance)]
+        return hashlib.sha1('|'.join(fields)).hexdigest()
+
+
+    def get_timestamp(self):
+        """returns the date as a unix timestamp, in UTC so there
+        are no daylight saving surprises"""
+
+        return (self._ordinal - EPOCH_ORDINAL) * SECONDS_PER_DAY
+
+
+    def sort_key(self):
+        """Key for sorting records into the order they happened. Dates
+        only go down to the day so ties are broken by where the record
+        was in the file, backwards if the bank puts the newest first,
+        which keeps the running balance in order"""
+
+        if self._newest_first:
+            return self._ordinal, -self._position
+        return self._ordinal, self._position
+
+
+@register_parser
 class Santander(Transaction):
     """Class for creating santander statement record objects"""
 
+    __slots__ = ()
+
+    _account = 'Santander'
+
+    _newest_first = True
+
+    # the trans regex map pretty much powers this whole script
+    # See unit tests to see example of matches
+    _trans_patterns = \
+    {'Bill Payment' : 
+     r"""^bill\ payment                 # Trans Type (link word 'to')
+     \s(via\ faster\ payment\ )?to      # Sometimes via faster payments!
+     \s(?P<place>.+?)                   # Grab who Ive paid
+     [ ,]{0,3}(reference\ \w*)?         # reference 
+     [ ,]{0,3}(mandate\ no\ \d{0,3})?$  # or mandate or both""",
+     
+     'Card Payment' : 
+     r"""^card\ payment\ to       # Trans Type (link word 'to')
+     \s(?P<place>.+?)             # Grab where I spent my money
+     (,\d+\.\d{2}\s\w{3})?        # How much if available
+     (,\ rate\ \d\.\d{0,2}/\w{3})?  # Exchange rate if available 
+     [ ,]{0,2}on\s?(?P<date>\d{2,4}[-/]?\w{2,3}[-/]?\d{2,4})?  # Better Date
+     (\sn[-a-z ]{0,24})?$          # non-sterling could be cut off""",
+
+     'Cash Withdrawal' : 
+     r"""^cash\ withdrawal        # Trans Type (link word 'at')
+     (\sreversal)?                # could be an ATM error
+     \sat\ (?P<place>.+?)         # Where abouts
+     (,\d+\.\d{2}\s\w{3})?        # How much if available
+     (,\ rate\ \d\.\d{0,2}/\w{3})?  # Exchange rate if available 
+     [ ,]{0,3}(on)?
+     \s?(?P<date>\d{2,4}[-/]?\w{2,3}[-/]?\d{2,4})?  # Better Date
+     (\sn[-a-z ]{0,24})?$          # non-sterling could be cut off""",
+   
+     'Withdrawal':
+     r"""^withdrawal\ .+at
+     \s(?P<place>.+)$""",
+
+     'Rejected Bill Payment' : 
+     r"""^rejected\ bill\ payment
+     \s(via\ faster\ payment\ )?to
+     \s(?P<place>.*)$""",
+
+     'Bank Giro Credit' :  
+     r"""^bank\ giro\ credit\ ref 
+     \s(?P<place>.+),\s.*$""",
+
+     'Direct Debit' :
+     r"""^direct\ debit\ payment
+     \sto\s(?P<place>.+?)
+     (\sref\ .+?)?
+     ,\s?mandate\ no\ \d+$""",
+
+     'Faster Payments' :
+     r"""^faster\ payments\ receipt
+     \s(ref.+)?\ from
+     \s(?P<place>.*)$""",
+
+     'Standing Order' :  
+     r"""standing\ order\ 
+     \s(via\ faster\ )?
+     payment\ to
+     \s(?P<place>.*)
+     ,\s?mandate no \d+$""",
+
+     'Credit' : 
+     r"""^credit\ from 
+     \s(?P<place>.*)
+     \son
+     \s(?P<date>\d{2,4}[-/]\w{3}|\d{2}[-/]\d{2,4})?$""",
+     
+     'Cheque' : 
+     r"""^cheque paid in at (?P<place>.*)$"""}
+
+    # compiled once when the class is created rather than per record
+    _trans_regex_map = dict((trans_type, re.compile(pattern, re.I|re.VERBOSE))
+                            for trans_type, pattern in _trans_patterns.items())
+
+    # one regex that finds the transaction type from the start of
+    # the description, eg "CARD PAYMENT TO ..." matches the named
+    # group that _trans_type_groups maps back to 'Card Payment'
+    _trans_type_regex, _trans_type_groups = \
+        _compile_prefix_matcher(_trans_patterns)
+
+
+    @staticmethod
+    def sniff(head):
+        """santander text statements start with the date range they
+        cover, see unit_test.py for examples, failing that look for
+        a record"""
+
+        return (head.lstrip().startswith("From:" + NBSP) or
+                "Date:" + NBSP in head and "Description:" + NBSP in head)
 
-    def __init__(self, description, date, amount, balance):
-        """constructor"""
+
+    def __init__(self, description, date, amount, balance, position=0):
+        """constructor, position is where the record is in the
+        statement and is used to keep same day records in order"""
         
         super(Santander, self).__init__()
         
         self._description = description
-        self._balance = balance
-        self._account = 'Santander'
+        self._position = position
+        self._fingerprint = self.make_fingerprint(date, description, amount, balance)
         self.set_date(date)
         self.set_amount(amount)
-        
-        # the trans regex map pretty much powers this whole script
-        # See unit tests to see example of matches
-
-        self._trans_regex_map = \
-        {'Bill Payment' : 
-         r"""^bill\ payment                 # Trans Type (link word 'to')
-         \s(via\ faster\ payment\ )?to      # Sometimes via faster payments!
-         \s(?P<place>.+?)                   # Grab who Ive paid
-         [ ,]{0,3}(reference\ \w*)?         # reference 
-         [ ,]{0,3}(mandate\ no\ \d{0,3})?$  # or mandate or both""",
-         
-         'Card Payment' : 
-         r"""^card\ payment\ to       # Trans Type (link word 'to')
-         \s(?P<place>.+?)             # Grab where I spent my money
-         (,\d+\.\d{2}\s\w{3})?        # How much if available
-         (,\ rate\ \d\.\d{0,2}/\w{3})?  # Exchange rate if available 
-         [ ,]{0,2}on\s?(?P<date>\d{2,4}[-/]?\w{2,3}[-/]?\d{2,4})?  # Better Date
-         (\sn[-a-z ]{0,24})?$          # non-sterling could be cut off""",
-    
-         'Cash Withdrawal' : 
-         r"""^cash\ withdrawal        # Trans Type (link word 'at')
-         (\sreversal)?                # could be an ATM error
-         \sat\ (?P<place>.+?)         # Where abouts
-         (,\d+\.\d{2}\s\w{3})?        # How much if available
-         (,\ rate\ \d\.\d{0,2}/\w{3})?  # Exchange rate if available 
-         [ ,]{0,3}(on)?
-         \s?(?P<date>\d{2,4}[-/]?\w{2,3}[-/]?\d{2,4})?  # Better Date
-         (\sn[-a-z ]{0,24})?$          # non-sterling could be cut off""",
-   
-         'Withdrawal':
-         r"""^withdrawal\ .+at
-         \s(?P<place>.+)$""",
-
-         'Rejected Bill Payment' : 
-         r"""^rejected\ bill\ payment
-         \s(via\ faster\ payment\ )?to
-         \s(?P<place>.*)$""",
-    
-         'Bank Giro Credit' :  
-         r"""^bank\ giro\ credit\ ref 
-         \s(?P<place>.+),\s.*$""",
-    
-         'Direct Debit' :
-         r"""^direct\ debit\ payment
-         \sto\s(?P<place>.+?)
-         (\sref\ .+?)?
-         ,\s?mandate\ no\ \d+$""",
-    
-         'Faster Payments' :
-         r"""^faster\ payments\ receipt
-         \s(ref.+)?\ from
-         \s(?P<place>.*)$""",
-    
-         'Standing Order' :  
-         r"""standing\ order\ 
-         \s(via\ faster\ )?
-         payment\ to
-         \s(?P<place>.*)
-         ,\s?mandate no \d+$""",
-    
-         'Credit' : 
-         r"""^credit\ from 
-         \s(?P<place>.*)
-         \son
-         \s(?P<date>\d{2,4}[-/]\w{3}|\d{2}[-/]\d{2,4})?$""",
-         
-         'Cheque' : 
-         r"""^cheque paid in at (?P<place>.*)$"""}
-            
+        self.set_balance(balance)
+
         self.set_trans_type()
         self.extract_data()
    
 
     @staticmethod
-    def parse_statement(path, date_range="all"):
+    def iter_statement(path, date_range="all", chunk_size=CHUNK_SIZE,
+                       offset=0, skip=None, end=None, errors="strict",
+                       quarantine=None):
+        """Generator version of parse_statement. Memory maps the
+        statement (or if it cant be mapped reads it in chunks of
+        chunk_size bytes) and yields santander record objects one at a
+        time in the order they appear in the file, so memory use does
+        not grow with the size of the statement. date_range works the
+        same way as it does in parse_statement.
+
+        For incremental imports reading can start at a byte offset
+        (which should be a record boundary) and skip can be a set of
+        fingerprints, records in it are not parsed at all. end stops
+        reading at that byte offset, it should be a boundary too.
+
+        errors is "strict" to raise on the first record that cant be
+        parsed, or "collect" to put it in quarantine (a Quarantine)
+        and carry on"""
+
+        _check_errors(errors, quarantine)
+        if date_range != "all":
+            date_min, date_max = _date_bounds(date_range)
+
+        with open(path, 'rb') as statement:
+            try:
+                mapped = mmap.mmap(statement.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, TypeError, EnvironmentError):
+                # empty files cant be mapped, nor can things that
+                # arent really files so fall back to reading chunks
+                mapped = None
+
+            # statement is in some ugly format see unit_test.py for examples
+            if mapped is not None:
+                records = _mapped_records(mapped, offset,
+                                          len(mapped) if end is None else end,
+                                          errors=errors)
+            else:
+                statement.seek(offset)
+                records = _read_records(statement, offset, end, chunk_size, errors)
+
+            try:
+                for position, field_data_pair in records:
+
+                    if isinstance(field_data_pair, BadFile):
+                        # only happens when collecting errors
+                        quarantine.add(Santander, path, position, field_data_pair)
+                        continue
+
+                    if skip and Santander.make_fingerprint(**field_data_pair) in skip:
+                        # already seen this one, dont bother parsing it
+                        continue
+
+                    try:
+                        record_obj = Santander(position=position, **field_data_pair)
+                    except PARSE_ERRORS as error:
+                        if errors != "collect":
+                            raise
+                        quarantine.add(Santander, path, position, error, field_data_pair)
+                        continue
+
+                    if date_range == "all":
+                        # returns everything if date is all
+                        yield record_obj
+
+                    elif date_min <= record_obj._date <= date_max:
+                        # return only records from within our date range
+                        yield record_obj
+
+            finally:
+                if mapped is not None:
+                    mapped.close()
+
+
+    @staticmethod
+    def parse_statement(path, date_range="all", sort=True, errors="strict"):
         """This parses the statement, creating santander record objects
         using the information in the statement. It returns a sorted list of 
         record objects. If date_range is all then everything is returned, if
         a tuple of dates (in the form dd-mm-yyyy) is given then records from
-        outside this range are not returned"""
-        
-        field_data_pair = {}
-        record_list = []
+        outside this range are not returned. If sort is False the records
+        are left in the order they appear in the statement.
 
-        with open(path, 'r') as statement:
-            # statement is in some ugly format see unit_test.py for examples
-            # this script goes some way to convert dos to unix!!
-            for record in statement.read().split('\r\n\t\t\t\t\t\t\r\n'):
-                
-                if len(record.split('\r\n')) == 4:
-                    for line in record.split('\r\n'):
-                        data = [field.strip('\xa0') for field in line.split(':')]
-                        field_data_pair[data[0].lower()] = data[1]
-                    
-                    condition = True
-                    # we expect to have date, amount, balance and description
-                    # in all records.
-                    for fld in ("date" ,"amount", "balance", "description"):
-                        condition &= fld in field_data_pair
-
-                    if not condition:
-                        # our statement must be broken
-                        msg = "Is the statement broken/currupt\n"
-                        msg += "trying to parse:\n{}"
-                        raise BadFile(msg.format(record))
-                    
-                    record_obj = Santander(**field_data_pair)
-                    
-                    if date_range == "all":
-                        # returns everything if date is all
-                        record_list.append(record_obj)
-
-                    else:
-                        date_format = "%d-%m-%Y"
-                        date_min = datetime.datetime.strptime(date_range[0], date_format)
-                        date_max = datetime.datetime.strptime(date_range[1], date_format)
-                        record_date = record_obj._date
-                        
-                        if record_date >= date_min and record_date <= date_max:
-                            # return only records from within our date range
-                            record_list.append(record_obj)
-        
-        # return a sorted list
-        return sorted(record_list, key=lambda x: x.get_date('%s'))
+        If errors is "collect" records that cant be parsed dont stop
+        the rest, a tuple of the records and a Quarantine of the ones
+        that failed is returned"""
+
+        quarantine = Quarantine()
+        record_list = list(Santander.iter_statement(path, date_range, errors=errors,
+                                                    quarantine=quarantine))
+        if sort:
+            # return a sorted list
+            _sort_records(record_list)
+
+        if errors == "collect":
+            return record_list, quarantine
+        return record_list
+
+
+    @staticmethod
+    def parse_statement_table(path, date_range="all", sort=True, workers=None,
+                              errors="strict"):
+        """Same as parse_statement but the statement is cut into chunks
+        on record boundaries which are parsed in seperate processes,
+        workers of them (None means one per cpu). Records dont travel
+        well between processes so it always returns a TransactionTable
+        (and a Quarantine if errors is "collect")"""
+
+        quarantine = Quarantine()
+        _check_errors(errors, quarantine)
+
+        parts = workers or multiprocessing.cpu_count()
+        jobs = [(path, start, end, date_range, errors)
+                for start, end in _find_boundaries(path, RECORD_SEPARATOR, parts)]
+        tables = []
+        for table, part_quarantine in _pool_map(_parse_range, jobs, workers):
+            tables.append(table)
+            quarantine.extend(part_quarantine)
+
+        table = TransactionTable.concatenate(tables)
+        if sort:
+            table = table.sorted()
+
+        if errors == "collect":
+            return table, quarantine
+        return table
         
 
     def set_trans_type(self):
@@ -368,10 +1107,9 @@ class Santander(Transaction):
         else:
             # once all the badly behaved records are taken into account
             # use the trans regex map for the otheres
-            for trans_types in self._trans_regex_map:
-                if self._description.startswith(trans_types.upper()):
-                    self._trans_type = trans_types
-                    break
+            match = self._trans_type_regex.match(self._description)
+            if match is not None:
+                self._trans_type = self._trans_type_groups[match.lastgroup]
 
         if self._trans_type is None:
             # either bug or new transaction type
@@ -380,12 +1118,18 @@ class Santander(Transaction):
             raise RecordError(msg)
             
 
-#### Im not sure im going to implement Natwest transactions ####
-
+@register_parser
 class Natwest(Transaction):
-    
-    account = 'Natwest'
-    
+    """Class for creating natwest statement record objects, from the
+    CSV files natwest online banking downloads"""
+
+    __slots__ = ()
+
+    _account = 'Natwest'
+
+    # the columns we need from the header row of the CSV
+    _columns = ('Date', 'Type', 'Description', 'Value', 'Balance')
+
     typemap = {'DPC' : 'Bank Giro Credit',
                'POS' : 'Card Payment', 
                'C/L' : 'Cash Withdrawel',
@@ -395,89 +1139,531 @@ class Natwest(Transaction):
     
     trans_regex_map = \
         {'Cash Withdrawel' : r"'(?P<place>.*?) (?P<date>\d{2}\w{3})",
-         'Card Payment' :  r"(?P<date>\d{2}\w{3}\d{2}) , (?P<place>.*?)( , cash back (?P<cashback>\d+.\d+)|$)",  
+         'Card Payment' :  r"'?(\d{4} )?(?P<date>\d{2}\w{3}\d{2}) , (?P<place>.*?)( , cash back (?P<cashback>\d+.\d+)|$)",  
          'Bank Giro Credit' :  r"'(?P<place>.*?)( , FP (?P<date>[0-3]?[0-9]/[0-1][0-9]/[0-9][0-9])|$)", 
          'Direct Debit' :  r"'(?P<place>.*)",
          'Online Banking' : r"\d{4} , (?P<place>.*?) e FP (?P<date>\d{2}/\d{2}/\d{2})",
          'Interest': r"'(?P<date>\d{2}\w{3}) (?P<place>.*?)$"}
 
-        
-    def __init__(self, date, description, amount, balance, transaction_type):
-        Transaction.__init__(self, date, description, amount, balance)
-        self.transaction_type = self.typemap[transaction_type]
-        # FIXME use super
+    # compiled once when the class is created rather than per record,
+    # not VERBOSE like santanders as the spaces in these matter
+    _trans_regex_map = dict((trans_type, re.compile(pattern, re.I))
+                            for trans_type, pattern in trans_regex_map.items())
+
+
+    @staticmethod
+    def sniff(head):
+        """natwest CSV statements start with a header row naming the
+        columns, sometimes after a blank line"""
+
+        lines = head.lstrip().split('\n', 1)
+        names = [name.strip() for name in lines[0].split(',')]
+        return all(column in names for column in Natwest._columns)
+
+
+    def __init__(self, date, description, amount, balance, trans_code, position=0):
+        """constructor, trans_code is natwests code for the type of
+        transaction (see typemap) and position is where the record is
+        in the statement"""
+
+        super(Natwest, self).__init__()
+
+        self._description = description
+        self._position = position
+        self._fingerprint = self.make_fingerprint(date, description, amount, balance)
+        self.set_date(date)
+        self.set_amount(amount)
+        self.set_balance(balance)
+
+        self.set_trans_type(trans_code)
+        self.extract_data()
+
+
+    @staticmethod
+    def iter_statement(path, date_range="all", offset=0, skip=None,
+                       errors="strict", quarantine=None):
+        """Generator that streams natwest record objects from the
+        CSV statement at path one row at a time, in the order they
+        appear in the file. date_range works the same way as it does
+        in parse_statement. offset, skip, errors and quarantine work
+        like they do for Santander.iter_statement, offset should be
+        the start of a row"""
+
+        _check_errors(errors, quarantine)
+        if date_range != "all":
+            date_min, date_max = _date_bounds(date_range)
+
+        # python 2 csv wants files opened in binary mode
+        with open(path, 'rb') as statement:
+            # the header is read by itself so we can seek past rows
+            # that have already been imported without losing it
+            header = []
+            while not header:
+                line = statement.readline()
+                if not line:
+                    return
+                header = next(csv.reader([line]), [])
+
+            names = [name.strip() for name in header]
+            try:
+                columns = [names.index(column) for column in Natwest._columns]
+            except ValueError:
+                msg = "{} is missing one of the columns {}"
+                raise BadFile(msg.format(path, ', '.join(Natwest._columns)))
+            date, trans_code, description, amount, balance = columns
+            width = max(columns)
+
+            if offset > statement.tell():
+                statement.seek(offset)
+
+            # read a line at a time rather than through the files
+            # read ahead so tell is where each row starts, which is
+            # the records position like it is for santander
+            reader = csv.reader(iter(statement.readline, ''))
+            while True:
+                position = statement.tell()
+                row = next(reader, None)
+                if row is None:
+                    break
+                if len(row) <= width:
+                    # blank lines and the like
+                    continue
+
+                if skip and Natwest.make_fingerprint(row[date], row[description],
+                                                     row[amount], row[balance]) in skip:
+                    continue
+
+                fields = {'date' : row[date],
+                          'description' : row[description],
+                          'amount' : row[amount],
+                          'balance' : row[balance],
+                          'trans_code' : row[trans_code].strip()}
+                try:
+                    record_obj = Natwest(position=position, **fields)
+                except PARSE_ERRORS as error:
+                    if errors != "collect":
+                        raise
+                    quarantine.add(Natwest, path, position, error, fields)
+                    continue
+
+                if date_range == "all" or date_min <= record_obj._date <= date_max:
+                    yield record_obj
+
+
+    @staticmethod
+    def parse_statement(path, date_range="all", sort=True, errors="strict"):
+        """Same as Santander.parse_statement but for natwest CSV
+        statements, returns a list of record objects (and a
+        Quarantine if errors is "collect")"""
+
+        quarantine = Quarantine()
+        record_list = list(Natwest.iter_statement(path, date_range, errors=errors,
+                                                  quarantine=quarantine))
+
+        if sort:
+            _sort_records(record_list)
+
+        if errors == "collect":
+            return record_list, quarantine
+        return record_list
+
+
+    def set_trans_type(self, trans_code):
+        """Sets the transaction type from natwests code for it, codes
+        we dont know about are used as they are and as we wont have a
+        regex for them the place is the whole description"""
+
+        self._trans_type = self.typemap.get(trans_code, trans_code)
+
+        if self._trans_type not in self._trans_regex_map:
+            self.set_place(self._description.lstrip("'").strip())
+
 
 def fromNatwest(path):
-    csvfile  = open(path, "rb")
-    reader = csv.reader(csvfile)
-    column_no = 0
-    raw = {}
-    objlist = []
-    for transaction in reader:
-        if transaction == []: continue
-        if column_no == 0:
-            fieldnames = transaction
-        else:
-            for index, detail in enumerate(transaction[0:-2]):
-                key = fieldnames[index].strip()
-                raw.update({key : detail})
-        
-            foo = Natwest(raw['Date'],
-                          raw['Description'],
-                          raw['Value'],
-                          raw['Balance'],
-                          raw['Type'])
-        
-            foo.extract_data()
-            objlist.append(foo)
-        
-        column_no += 1
-            
-    csvfile.close()
-    return objlist
+    """returns a list of natwest record objects for the statement
+    at path, in the order they are in the file"""
 
-###### Analysis Starts Here ######
+    return list(Natwest.iter_statement(path))
 
 
-def rolling_totals(list_of_records):
-    """Finds the sum of all unique places for a given
-    list of record objects"""
+def _decorate(statement, index):
+    """pairs each record in statement with its sort key and the
+    index of its statement, so heapq can merge them without ever
+    comparing two records"""
 
-    totals = {}
-    for record in list_of_records:
-        #        if record._place.startswith("TESCO"):
+    for record in statement:
+        yield record.sort_key(), index, record
 
-        #    record._place = "TESCO"
 
-        if record._place not in totals:
-            totals[record._place] = record.get_amount()
+def merge_statements(statements):
+    """K-way merges statements that are already sorted (lists or
+    iterators of records, eg from parse_statement) into one sorted
+    iterator of records. Cheaper than joining them up and sorting
+    again, O(n log k) for k statements"""
 
-        else:
-            totals[record._place] += record.get_amount()
+    decorated = [_decorate(statement, index)
+                 for index, statement in enumerate(statements)]
+    for _, _, record in heapq.merge(*decorated):
+        yield record
 
 
-    list_of_places = []
-    for place, amount in totals.iteritems():
-        list_of_places.append((place, amount))
+def _statement_paths(paths):
+    """yields each path, swapping directories for the statements
+    in them (hidden files are ignored)"""
 
-   
-    for place, amount in sorted(list_of_places,key=lambda x: x[1]):
-        print "{} --- {}".format(place, amount)
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                full_path = os.path.join(path, name)
+                if not name.startswith('.') and os.path.isfile(full_path):
+                    yield full_path
+        else:
+            yield path
 
 
-def invout(list_of_records):
-    """finds both the total incoming and outgoing"""
+def _parse_to_table(job):
+    """Worker for parse_statements, parses one statement into a
+    sorted TransactionTable and returns it with a Quarantine of any
+    records that couldnt be parsed. It has to be at the top level of
+    the module so the process pool can pickle it"""
 
-    results = {"incoming" : 0, "outgoing" : 0}
+    path, date_range, cache_dir, errors = job
 
-    for record in list_of_records:
-        amount = record.get_amount()
-        if amount > 0:
-            results["incoming"] += amount
+    table = None
+    if cache_dir is not None:
+        # circular otherwise, cache needs the record classes
+        from cache import StatementCache
+        statement_cache = StatementCache(cache_dir)
 
+        if errors == "strict":
+            table = statement_cache.load(path)
         else:
-            results["outgoing"] -= amount
+            table = statement_cache.get(path)
+
+    if table is not None:
+        quarantine = Quarantine()
+        if date_range != "all":
+            table = table.between(*_date_bounds(date_range))
+        return table, quarantine
+
+    if errors == "collect":
+        records, quarantine = parse_statement(path, errors="collect")
+    else:
+        records, quarantine = parse_statement(path), Quarantine()
+    table = TransactionTable.from_records(records)
+
+    if cache_dir is not None and not quarantine:
+        # only statements that parsed completely are cached, the
+        # quarantine has to be built again next time otherwise
+        statement_cache.put(path, table)
+
+    if date_range != "all":
+        table = table.between(*_date_bounds(date_range))
+    return table, quarantine
+
+
+def _parse_range(job):
+    """Worker for parallel parse_statement, parses the records
+    between two byte offsets into a TransactionTable in the order
+    they are in the file, returned with a Quarantine of the records
+    that couldnt be parsed"""
+
+    path, start, end, date_range, errors = job
+    quarantine = Quarantine()
+    table = TransactionTable.from_records(
+        Santander.iter_statement(path, date_range, offset=start, end=end,
+                                 errors=errors, quarantine=quarantine))
+    return table, quarantine
+
+
+def parse_statements(paths, date_range="all", workers=None, cache_dir=None,
+                     errors="strict"):
+    """Parses lots of statements at once. paths can be statement
+    files or directories of them, of any kind detect_parser knows
+    about. Each file is parsed in its own process, workers of them at
+    a time (defaults to one per cpu), and comes back as a compact
+    TransactionTable. Returns one TransactionTable with everything
+    merged in date order. If cache_dir is given statements that have
+    been parsed before are loaded from the cache there, see
+    cache.StatementCache. If errors is "collect" a tuple of the table
+    and a Quarantine of every record that couldnt be parsed is
+    returned instead"""
+
+    quarantine = Quarantine()
+    _check_errors(errors, quarantine)
+
+    jobs = [(path, date_range, cache_dir, errors) for path in _statement_paths(paths)]
+    tables = []
+    for table, file_quarantine in _pool_map(_parse_to_table, jobs, workers):
+        tables.append(table)
+        quarantine.extend(file_quarantine)
+
+    table = TransactionTable.merge(tables)
+    if errors == "collect":
+        return table, quarantine
+    return table
+
+
+###### Columnar Storage ######
+
+# what TransactionTable hands back for each row
+TableRow = namedtuple('TableRow',
+                      'date description place amount balance trans_type')
+
+
+class TransactionTable(object):
+    """Stores parsed records as parallel arrays rather than one
+    object per record. Amounts and balances are doubles, dates are
+    days since 1970 and places and transaction types are stored
+    once each with the rows holding an integer code for them. Handy
+    when keeping years of statements in memory, or for sending
+    parsed statements between processes"""
+
+    _arrays = ('amounts', 'balances', 'days', 'sequence',
+               'place_codes', 'type_codes')
 
+    def __init__(self):
+        """constructor, creates an empty table"""
+
+        self.amounts = array('d')
+        self.balances = array('d')
+        # 'l' is 64 bit on the machines we run on, python 2 has no 'q'
+        self.days = array('l')
+        # orders rows within a day, see Transaction.sort_key
+        self.sequence = array('l')
+        self.place_codes = array('i')
+        self.type_codes = array('i')
+        self.descriptions = []
+
+        # code -> value and value -> code for places and types
+        self.places = []
+        self.trans_types = []
+        self._place_index = {}
+        self._type_index = {}
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self.row(index)
+
+    def __getstate__(self):
+        # arrays pickle as lists of python objects, raw bytes
+        # are far smaller and quicker
+        state = self.__dict__.copy()
+        for name in self._arrays:
+            state[name] = (state[name].typecode, state[name].tostring())
+        return state
+
+    def __setstate__(self, state):
+        for name in self._arrays:
+            typecode, data = state[name]
+            state[name] = array(typecode)
+            state[name].fromstring(data)
+        self.__dict__.update(state)
+
+    @classmethod
+    def from_records(cls, records):
+        """builds a table from any iterable of record objects"""
+
+        table = cls()
+        table.extend(records)
+        return table
+
+    @staticmethod
+    def _code(value, values, index):
+        """returns the code for value, giving it a new one if we
+        havent seen it before"""
+
+        code = index.get(value)
+        if code is None:
+            code = index[value] = len(values)
+            values.append(intern(value) if type(value) is str else value)
+        return code
+
+    @classmethod
+    def from_columns(cls, columns, descriptions, places, trans_types):
+        """Builds a table straight from its columns, columns is a dict
+        of array name (see _arrays) to a string of the arrays bytes"""
+
+        table = cls()
+        for name in cls._arrays:
+            getattr(table, name).fromstring(columns[name])
+        table.descriptions = list(descriptions)
+        table.places = list(places)
+        table.trans_types = list(trans_types)
+        table._place_index = dict((place, code) for code, place in enumerate(places))
+        table._type_index = dict((trans_type, code)
+                                 for code, trans_type in enumerate(trans_types))
+        return table
+
+    def columns(self):
+        """the opposite of from_columns, returns a dict of array name
+        to a string of the arrays bytes"""
+
+        return dict((name, getattr(self, name).tostring()) for name in self._arrays)
+
+    @classmethod
+    def _gather(cls, tables, picks):
+        """Builds a new table from picks, a list of (table, row)
+        pairs where table is an index into tables. Done a column at a
+        time, with places and types recoded once per table rather
+        than once per row, so it is much quicker than append_from"""
+
+        gathered = cls()
+
+        place_codes = [[cls._code(place, gathered.places, gathered._place_index)
+                        for place in table.places] for table in tables]
+        type_codes = [[cls._code(trans_type, gathered.trans_types, gathered._type_index)
+                       for trans_type in table.trans_types] for table in tables]
+
+        for name in ('amounts', 'balances', 'days', 'sequence'):
+            columns = [getattr(table, name) for table in tables]
+            getattr(gathered, name).extend(columns[index][row] for index, row in picks)
+
+        codes = [table.place_codes for table in tables]
+        gathered.place_codes.extend(place_codes[index][codes[index][row]]
+                                    for index, row in picks)
+        codes = [table.type_codes for table in tables]
+        gathered.type_codes.extend(type_codes[index][codes[index][row]]
+                                   for index, row in picks)
+
+        descriptions = [table.descriptions for table in tables]
+        gathered.descriptions = [descriptions[index][row] for index, row in picks]
+        return gathered
+
+    @classmethod
+    def merge(cls, tables):
+        """K-way merges tables that are already sorted into a new
+        sorted table, the columnar version of merge_statements"""
+
+        keys = [table._keys(index) for index, table in enumerate(tables)]
+        picks = [(index, row) for _, _, index, row in heapq.merge(*keys)]
+        return cls._gather(tables, picks)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """joins tables together one after the other"""
+
+        picks = [(index, row) for index, table in enumerate(tables)
+                 for row in xrange(len(table))]
+        return cls._gather(tables, picks)
+
+    def sorted(self):
+        """returns a copy of the table sorted by date, rows on the
+        same day are ordered by sequence"""
+
+        days = self.days
+        sequence = self.sequence
+        order = sorted(xrange(len(self)), key=lambda row: (days[row], sequence[row]))
+        return self._gather([self], [(0, row) for row in order])
+
+    def between(self, date_min, date_max):
+        """returns a copy of the table with only the rows from
+        date_min to date_max (datetimes) inclusive"""
+
+        day_min = date_min.toordinal() - EPOCH_ORDINAL
+        day_max = date_max.toordinal() - EPOCH_ORDINAL
+
+        picks = [(0, row) for row, day in enumerate(self.days)
+                 if day_min <= day <= day_max]
+        return self._gather([self], picks)
+
+    def _keys(self, index):
+        """yields the sort key of each row followed by index (the
+        tables place in a merge) and the row number"""
+
+        for row in xrange(len(self)):
+            yield self.days[row], self.sequence[row], index, row
+
+    def append(self, date, description, place, amount, balance, trans_type,
+               sequence=None):
+        """adds a row, date can be a datetime or days since 1970.
+        sequence orders rows on the same day, by default rows are in
+        the order they were added"""
+
+        if not isinstance(date, (int, long)):
+            date = date.toordinal() - EPOCH_ORDINAL
+        if sequence is None:
+            sequence = len(self)
+
+        self.days.append(date)
+        self.sequence.append(sequence)
+        self.descriptions.append(description)
+        self.place_codes.append(self._code(place, self.places, self._place_index))
+        self.amounts.append(amount)
+        self.balances.append(balance)
+        self.type_codes.append(self._code(trans_type, self.trans_types,
+                                          self._type_index))
+
+    def append_record(self, record):
+        """adds a row from a record object"""
+
+        self.append(record._ordinal - EPOCH_ORDINAL,
+                    record.get_description(),
+                    record.get_place(),
+                    record.get_amount(),
+                    record.get_balance(),
+                    record.get_trans_type(),
+                    record.sort_key()[1])
+
+    def append_from(self, table, index):
+        """adds row index of another table"""
+
+        self.append(table.days[index],
+                    table.descriptions[index],
+                    table.places[table.place_codes[index]],
+                    table.amounts[index],
+                    table.balances[index],
+                    table.trans_types[table.type_codes[index]],
+                    table.sequence[index])
+
+    def extend(self, records):
+        """adds every record in an iterable of record objects"""
+
+        for record in records:
+            self.append_record(record)
+
+    def get_date(self, index):
+        """returns the date of a row as a datetime"""
+
+        return datetime.datetime.fromordinal(self.days[index] + EPOCH_ORDINAL)
+
+    def row(self, index):
+        """returns a single row as a TableRow"""
+
+        return TableRow(self.get_date(index),
+                        self.descriptions[index],
+                        self.places[self.place_codes[index]],
+                        self.amounts[index],
+                        self.balances[index],
+                        self.trans_types[self.type_codes[index]])
+
+
+###### Analysis Starts Here ######
+
+
+def _as_table(records):
+    """the analysis works on TransactionTables, this builds one
+    from an iterable of records unless we already have one"""
+
+    # duck typed because when run as a script this module is __main__
+    # and tables made by database.py are money.TransactionTables
+    if hasattr(records, 'place_codes'):
+        return records
+    return TransactionTable.from_records(records)
+
+
+def _print_totals(totals):
+    """prints (name, total) tuples one per line"""
+
+    for name, amount in totals:
+        print "{} --- {}".format(name, amount)
+
+
+def _print_invout(results):
+    """prints the dict of totals from analytics.income_outgoing"""
 
     msg = "For that period you earnt £{incoming}\n"
     msg += "but you spent £{outgoing}"
@@ -485,38 +1671,197 @@ def invout(list_of_records):
     print msg.format(**results)
 
 
+def rolling_totals(list_of_records):
+    """Finds the sum of all unique places for a given
+    list of record objects or TransactionTable"""
+
+    _print_totals(analytics.place_totals(_as_table(list_of_records)))
+
+
+def category_totals(list_of_records, categoriser=None):
+    """Finds the sum for each category of spending for a given
+    list of record objects or TransactionTable"""
+
+    if categoriser is None:
+        categoriser = Categoriser()
+
+    _print_totals(analytics.category_totals(_as_table(list_of_records), categoriser))
+
+
+def invout(list_of_records):
+    """finds both the total incoming and outgoing"""
+
+    _print_invout(analytics.income_outgoing(_as_table(list_of_records)))
+
+
 
 def parse_args():
     """parse command line arguments"""
     
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--statement', 
-            help='file path to santander text based statement', 
-            required=True,
-            type=str)
+            help=('file path to a santander text or natwest CSV '
+                  'statement, or a directory of them. Can be given more '
+                  'than once'),
+            type=str,
+            nargs='+')
     parser.add_argument('-d', '--date-range',
             default='all',
-            help='the date range you want to analyse', 
+            help='the date range you want to analyse (dd-mm-yyyy dd-mm-yyyy)',
             type=str,
             nargs=2)
+    parser.add_argument('--database',
+            help=('sqlite database to analyse, any statement given is '
+                  'imported into it first'),
+            type=str)
+    parser.add_argument('-j', '--workers',
+            help='how many statements to parse at once, default one per cpu',
+            type=int)
+    parser.add_argument('--cache-dir',
+            default=os.path.join(os.path.expanduser('~'), '.cache', 'money'),
+            help='where parsed statements are cached',
+            type=str)
+    parser.add_argument('--no-cache',
+            action='store_true',
+            help='always parse statements from scratch')
+    parser.add_argument('--errors',
+            choices=ERROR_MODES,
+            default='strict',
+            help=('"strict" stops at the first record that cant be parsed, '
+                  '"collect" quarantines it and carries on'))
+    parser.add_argument('--retry-quarantined',
+            action='store_true',
+            help='try parsing the records quarantined in the database again')
+    parser.add_argument('--export',
+            help=('write the parsed statements to this file, the format '
+                  'comes from the extension (.csv, .jsonl or .col) '
+                  'unless --export-format is given'),
+            type=str)
+    parser.add_argument('--export-format',
+            choices=('csv', 'jsonl', 'columnar'),
+            help='format for --export')
+    parser.add_argument('--profile',
+            action='store_true',
+            help=('time every stage of parsing and print where the time '
+                  'went, statements are parsed here without the cache'))
+    parser.add_argument('--rules',
+            help=('file of category rules to store in the database, one '
+                  '"category,regex" per line'),
+            type=str)
+    parser.add_argument('--rebuild-summaries',
+            action='store_true',
+            help=('work out the totals kept in the database again from '
+                  'every transaction'))
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.statement is None and args.database is None:
+        parser.error('a statement or a database is needed')
+    if args.rules and args.database is None:
+        parser.error('--rules needs a database to store them in')
+    if args.retry_quarantined and args.database is None:
+        parser.error('--retry-quarantined needs a database')
+
+    return args
 
 
 def main():
     """main entry point"""
 
     parser = parse_args()
-    file_path = parser.statement
-    
-    date_range = parser.date_range
 
-    statement = Santander.parse_statement(file_path, date_range)
+    if parser.profile:
+        # circular otherwise, profiler instruments this module
+        from profiler import profiling
+        import money
+
+        # when run as a script this module is __main__, and
+        # database.py has its own copy called money
+        modules = [sys.modules[__name__]]
+        if money is not modules[0]:
+            modules.append(money)
+
+        with profiling(modules=modules) as profile:
+            result = analyse(parser)
+        sys.stderr.write(profile.format() + '\n')
+        return result
+
+    return analyse(parser)
 
-    rolling_totals(statement)
+
+def analyse(parser):
+    """parses or imports the statements asked for on the command
+    line, parser is the parsed arguments, and prints the analysis"""
+
+    file_paths = parser.statement or []
+    
+    date_range = parser.date_range
+    categoriser = Categoriser()
+    # (place totals, category totals, income and outgoing)
+    totals = None
+
+    if parser.database:
+        # circular otherwise, database needs the record classes
+        from database import TransactionStore
+
+        with TransactionStore(parser.database) as store:
+            if parser.rules:
+                store.load_category_rules(parser.rules)
+            categoriser = store.categoriser()
+
+            if parser.rebuild_summaries:
+                store.rebuild_summaries()
+            if parser.retry_quarantined:
+                store.retry_quarantined()
+
+            for file_path in _statement_paths(file_paths):
+                store.import_statement(file_path, errors=parser.errors)
+            quarantine = store.quarantined()
+
+            if date_range == "all" and not parser.export:
+                # the summary tables have every total already
+                totals = (store.totals("place"), store.totals("category"),
+                          store.income_outgoing())
+            else:
+                if date_range == "all":
+                    date_range = (None, None)
+                # straight from the indexes, no need to parse anything
+                statement = store.table_between(*date_range)
+
+    else:
+        cache_dir = None if parser.no_cache else parser.cache_dir
+        workers = parser.workers
+        if parser.profile:
+            # the cache would skip the parsing and other processes
+            # wouldnt be profiled
+            cache_dir, workers = None, 1
+
+        statement = parse_statements(file_paths, date_range, workers, cache_dir,
+                                     errors=parser.errors)
+        quarantine = Quarantine()
+        if parser.errors == "collect":
+            statement, quarantine = statement
+
+    if parser.export:
+        # circular otherwise, export needs TransactionTable
+        from export import export
+        export(statement, parser.export, parser.export_format)
+
+    if totals is None:
+        table = _as_table(statement)
+        totals = (analytics.place_totals(table),
+                  analytics.category_totals(table, categoriser),
+                  analytics.income_outgoing(table))
+    places, categories, results = totals
+
+    _print_totals(places)
+    print
+    _print_totals(categories)
     print
-    invout(statement)
+    _print_invout(results)
     print
+
+    for error, count in sorted(quarantine.counts().items()):
+        sys.stderr.write("{} records quarantined with {}\n".format(count, error))
     
     return 0
 
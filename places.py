@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+"""Turns the place names pulled out of statements into canonical
+ones, so "TESCO STORES-2889" and "TESCO UPT 3896" both count as
+TESCO. Every raw name is only worked out once, after that it is a
+dict lookup"""
+
+import re
+
+
+# (regex, canonical name) rules, tried in order and the first to
+# match the start of the cleaned up place wins. Dont use named
+# groups in the regexs, they are used to tell the rules apart
+DEFAULT_RULES = (
+    # "TESCO STORES-2889", "TESCO UPT 3896" but not the tesco bank ATMs
+    (r"TESCO (STORES?|UPT|EXPRESS|METRO|EXTRA|SUPERSTORE)\b", "TESCO"),
+    # "SAINSBURY'S S/MKT", "SAINSBURYS SACAT"
+    (r"J?\s?SAINSBURY'?S?\b", "SAINSBURYS"),
+    # "AMAZON EU", "AMAZON.CO.UK", "AMAZON MKTPLACE PMTS"
+    (r"AMAZON\b", "AMAZON"),
+    # "MARKS&SPENCER PLC", "M&S SIMPLY FOOD"
+    (r"(MARKS ?(AND|&) ?SPENCER|M ?(AND|&) ?S)\b", "MARKS AND SPENCER"),
+    # "WAITROSE 123", "WAITROSE LTD"
+    (r"WAITROSE\b", "WAITROSE"),
+    # "TFL.GOV.UK/CP", "TFL TRAVEL CH"
+    (r"TFL\b", "TFL"),
+    # "PAYPAL *EBAY"
+    (r"PAYPAL\b", "PAYPAL"))
+
+# store numbers on the end like "-2889", " 3896" or " #0421"
+STORE_NUMBER = re.compile(r"(?<=\S)[\s-]*#?\d{3,}$")
+
+# runs of whitespace are squashed to one space
+WHITESPACE = re.compile(r"\s+")
+
+
+class Place(str):
+    """A canonical place name. There is only ever one Place object
+    per name so comparing and hashing them is as cheap as it gets"""
+
+    __slots__ = ()
+
+    _interned = {}
+
+    def __new__(cls, name):
+        place = cls._interned.get(name)
+        if place is None:
+            place = cls._interned[name] = str.__new__(cls, name)
+        return place
+
+
+class PlaceNormaliser(object):
+    """Normalises raw place names using a table of rules. The rules
+    are compiled into one regex and every raw name is remembered,
+    so each distinct name only goes through the rules once"""
+
+    def __init__(self, rules=DEFAULT_RULES):
+        """constructor, rules is a sequence of (regex, canonical
+        name) see DEFAULT_RULES"""
+
+        self._rules = tuple(rules)
+        self._canonical = {}
+        alternatives = []
+        for index, (pattern, name) in enumerate(self._rules):
+            group = 'r{}'.format(index)
+            self._canonical[group] = Place(name)
+            alternatives.append('(?P<{}>{})'.format(group, pattern))
+
+        self._regex = re.compile('|'.join(alternatives), re.I) if alternatives else None
+        self._memo = {}
+
+    @property
+    def rules(self):
+        """the (regex, canonical name) rules in use"""
+
+        return self._rules
+
+    def _clean(self, raw):
+        """tidies up a raw name, upper case, single spaces and no
+        store number on the end"""
+
+        place = raw.replace('&amp;', '&').upper()
+        place = WHITESPACE.sub(' ', place).strip()
+        return STORE_NUMBER.sub('', place)
+
+    def normalise(self, raw):
+        """returns the canonical Place for the raw place name"""
+
+        try:
+            return self._memo[raw]
+        except KeyError:
+            pass
+
+        if raw is None:
+            return None
+
+        place = self._clean(raw)
+        match = self._regex.match(place) if self._regex else None
+        if match is not None:
+            place = self._canonical[match.lastgroup]
+        else:
+            place = Place(place)
+
+        self._memo[raw] = place
+        return place
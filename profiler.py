@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+"""Opt in instrumentation for the parsers. Inside a profiling() block
+every stage of parsing reports how long it took to a callback: the
+record split (which is where the reading happens too), each record
+class's constructor and set_ methods, extract_data for each
+transaction type, every pattern in the trans regex maps and the final
+sort. Nothing is touched outside the block so there is no cost when
+it isnt being used.
+
+    with profiling() as profile:
+        Santander.parse_statement(path)
+    print profile.format()
+
+Stages nest, a records time includes its set_date and so on"""
+
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+# methods of the parser classes that are timed
+RECORD_STAGES = ('set_date', 'set_amount', 'set_balance', 'set_trans_type', 'extract_data')
+
+# module level generators that split statements into records
+SPLIT_STAGES = ('_mapped_records', '_read_records')
+
+
+class Profile(object):
+    """Callback for profiling that keeps a count and a total time for
+    every (stage, key) it is told about"""
+
+    def __init__(self):
+        """constructor, starts with nothing counted"""
+
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+
+    def __call__(self, stage, key, seconds, count):
+        """records count calls of stage for key taking seconds"""
+
+        self.counts[stage, key] += count
+        self.seconds[stage, key] += seconds
+
+    def report(self):
+        """returns a list of (stage, key, count, seconds, mean
+        microseconds) tuples, slowest first"""
+
+        rows = []
+        for stage_key, seconds in self.seconds.items():
+            count = self.counts[stage_key]
+            mean = seconds / count * 1e6 if count else 0.0
+            rows.append(stage_key + (count, seconds, mean))
+        rows.sort(key=lambda row: row[3], reverse=True)
+        return rows
+
+    def format(self):
+        """returns the report as a table for printing"""
+
+        lines = ["{:<16} {:<32} {:>10} {:>10} {:>10}".format(
+            "stage", "key", "count", "seconds", "mean us")]
+        for stage, key, count, seconds, mean in self.report():
+            lines.append("{:<16} {:<32} {:>10} {:>10.4f} {:>10.2f}".format(
+                stage, key or '', count, seconds, mean))
+        return '\n'.join(lines)
+
+
+class _TimedPattern(object):
+    """Stands in for a compiled regex in a trans regex map and times
+    every match"""
+
+    def __init__(self, regex, callback, key):
+        self._regex = regex
+        self._callback = callback
+        self._key = key
+        self.pattern = regex.pattern
+
+    def match(self, string):
+        start = time.time()
+        result = self._regex.match(string)
+        self._callback('match', self._key, time.time() - start, 1)
+        return result
+
+
+def _timed_method(method, callback, stage, key_attribute=None):
+    """wraps a record method so it reports to callback, keyed by the
+    records key_attribute after the call (eg its trans type)"""
+
+    def timed(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            key = getattr(self, key_attribute) if key_attribute else type(self).__name__
+            callback(stage, key, time.time() - start, 1)
+    return timed
+
+
+def _timed_generator(function, callback, stage):
+    """wraps a generator function so the time spent getting each item
+    out of it is reported to callback"""
+
+    def timed(*args, **kwargs):
+        iterator = function(*args, **kwargs)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                callback(stage, None, time.time() - start, 0)
+                return
+            callback(stage, None, time.time() - start, 1)
+            yield item
+    return timed
+
+
+def _timed_function(function, callback, stage):
+    """wraps a plain function so each call is reported to callback"""
+
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            callback(stage, None, time.time() - start, 1)
+    return timed
+
+
+@contextmanager
+def profiling(callback=None, modules=None):
+    """Context manager that instruments the parsers until the block
+    ends. callback is called as callback(stage, key, seconds, count)
+    for everything timed, by default a new Profile which is what the
+    block gets. modules are the money modules to instrument, only
+    needed when it is running as __main__ and so is imported twice"""
+
+    if modules is None:
+        import money
+        modules = [money]
+    if callback is None:
+        callback = Profile()
+
+    # (owner, name, old value or None if it wasnt there) to put back
+    patched = []
+
+    def patch(owner, name, value):
+        patched.append((owner, name, owner.__dict__.get(name)))
+        setattr(owner, name, value)
+
+    try:
+        parsers = []
+        for module in modules:
+            for name in SPLIT_STAGES:
+                patch(module, name, _timed_generator(getattr(module, name), callback, 'split'))
+            patch(module, '_sort_records',
+                  _timed_function(module._sort_records, callback, 'sort'))
+            parsers.extend(module.parsers())
+
+        for parser in parsers:
+            patch(parser, '__init__',
+                  _timed_method(parser.__dict__['__init__'], callback, 'record'))
+            for name in RECORD_STAGES:
+                key = '_trans_type' if name in ('set_trans_type', 'extract_data') else None
+                method = getattr(parser, name).im_func
+                patch(parser, name, _timed_method(method, callback, name, key))
+
+            patterns = dict((trans_type, _TimedPattern(regex, callback,
+                                                       parser.__name__ + ' ' + trans_type))
+                            for trans_type, regex in parser._trans_regex_map.items())
+            patch(parser, '_trans_regex_map', patterns)
+
+        yield callback
+
+    finally:
+        for owner, name, value in reversed(patched):
+            if value is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, value)
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+"""Checks statements add up. Every record has the balance after it,
+so each one should be the balance before it plus its amount. Going
+through the records in the order they are in the statement (one pass,
+so it can be done while they are parsed) anything that breaks the
+chain is flagged as one of
+
+    gap        records are missing, pence is the total of them
+    duplicate  the same record is in the statement twice
+    reorder    two records are the wrong way round
+
+and checking a list of statements also finds which of them overlap
+and any gaps between them. Money is checked in whole pence so there
+is no float rounding, see money.parse_pence.
+
+    reconciler = Reconciler(path, Santander._newest_first)
+    store.insert(reconciled(Santander.iter_statement(path), reconciler))
+    print reconciler.issues"""
+
+import sys
+import argparse
+from collections import namedtuple, defaultdict
+
+from money import detect_parser, _statement_paths
+
+
+# a problem with the running balance. record is the one it was found
+# at and other is the one it clashes with, the record before it for a
+# gap and the one it swapped with for a reorder (None for duplicates,
+# the first copy isnt kept). pence is how much is missing for a gap
+Issue = namedtuple('Issue', 'kind path record other pence')
+
+
+class Reconciler(object):
+    """Checks the running balance of one statement a record at a time,
+    see the module docstring. newest_first is whether the statement
+    lists the latest transaction first (the parsers _newest_first).
+    Problems found so far are in issues, count is how many records
+    have been checked and fingerprints the set of their fingerprints"""
+
+    def __init__(self, path=None, newest_first=False):
+        """constructor, path is only used to say where issues are"""
+
+        self.path = path
+        self.newest_first = newest_first
+        self.issues = []
+        self.count = 0
+        self.fingerprints = set()
+
+        # the first and last record in the statement
+        self.first = None
+        self.last = None
+
+        # the last record that fitted and the one after it that didnt,
+        # which cant be called a gap until we see the next record
+        self._previous = None
+        self._pending = None
+
+    def _follows(self, before, after):
+        """whether after comes straight after before in the statement"""
+
+        if self.newest_first:
+            before, after = after, before
+        return before.get_balance_pence() + after.get_amount_pence() == after.get_balance_pence()
+
+    def _missing(self, before, after):
+        """pence unaccounted for between before and after in the statement"""
+
+        if self.newest_first:
+            before, after = after, before
+        return after.get_balance_pence() - after.get_amount_pence() - before.get_balance_pence()
+
+    def _flag(self, kind, record, other, pence=0):
+        self.issues.append(Issue(kind, self.path, record, other, pence))
+
+    def _flush(self):
+        """flags the record that didnt fit as a gap, there is nothing
+        after it that could make it a reorder"""
+
+        if self._pending is not None:
+            self._flag('gap', self._pending, self._previous,
+                       self._missing(self._previous, self._pending))
+            self._previous, self._pending = self._pending, None
+
+    def check(self, record):
+        """checks the next record in the statement"""
+
+        fingerprint = record.get_fingerprint()
+        if fingerprint in self.fingerprints:
+            self._flag('duplicate', record, None)
+            return
+
+        self.fingerprints.add(fingerprint)
+        self.count += 1
+        if self.first is None:
+            self.first = record
+        self.last = record
+
+        if record.get_balance_pence() is None:
+            # nothing to check it against, start again after it
+            self._flush()
+            self._previous = None
+            return
+
+        previous, pending = self._previous, self._pending
+        if previous is None:
+            self._previous = record
+            return
+
+        if pending is not None:
+            self._pending = None
+            if self._follows(previous, record) and self._follows(record, pending):
+                # pending should have been after record
+                self._flag('reorder', pending, record)
+                self._previous = pending
+                return
+
+            self._flag('gap', pending, previous, self._missing(previous, pending))
+            previous = pending
+
+        if self._follows(previous, record):
+            self._previous = record
+        else:
+            self._previous, self._pending = previous, record
+
+    def finish(self):
+        """call once every record has been checked, flags a gap at
+        the last record if it didnt fit. Returns the issues"""
+
+        self._flush()
+        return self.issues
+
+    def opening(self):
+        """returns the earliest record in the statement"""
+
+        return self.last if self.newest_first else self.first
+
+    def closing(self):
+        """returns the latest record in the statement"""
+
+        return self.first if self.newest_first else self.last
+
+    def opening_balance_pence(self):
+        """returns the balance before the statement starts in pence"""
+
+        opening = self.opening()
+        return opening.get_balance_pence() - opening.get_amount_pence()
+
+
+def reconciled(records, reconciler):
+    """Generator that passes records straight through, checking each
+    one with reconciler on the way, so a streaming parse can be
+    reconciled as it goes"""
+
+    for record in records:
+        reconciler.check(record)
+        yield record
+    reconciler.finish()
+
+
+def reconcile_statements(paths):
+    """Reconciles every statement in paths (directories are searched)
+    and works out how they fit together. Returns (issues, overlaps)
+    where overlaps is a list of (path, path, how many records they
+    share). Statements that dont overlap are checked for a gap
+    between the end of one and the start of the next"""
+
+    reconcilers = []
+    owners = {}
+    shared = defaultdict(int)
+
+    for path in _statement_paths(paths):
+        parser = detect_parser(path)
+        reconciler = Reconciler(path, parser._newest_first)
+        for record in reconciled(parser.iter_statement(path), reconciler):
+            pass
+        if not reconciler.count:
+            continue
+        reconcilers.append(reconciler)
+
+        for fingerprint in reconciler.fingerprints:
+            if fingerprint in owners:
+                shared[owners[fingerprint], path] += 1
+            else:
+                owners[fingerprint] = path
+
+    issues = [issue for reconciler in reconcilers for issue in reconciler.issues]
+    overlapping = set(shared)
+
+    # statements for the same account in the order they happened
+    by_account = defaultdict(list)
+    for reconciler in reconcilers:
+        by_account[reconciler.first.get_account()].append(reconciler)
+    for statements in by_account.values():
+        statements.sort(key=lambda reconciler: reconciler.opening().sort_key())
+        for before, after in zip(statements, statements[1:]):
+            if ((before.path, after.path) in overlapping or
+                (after.path, before.path) in overlapping):
+                continue
+            closing = before.closing()
+            missing = after.opening_balance_pence() - closing.get_balance_pence()
+            if missing:
+                issues.append(Issue('gap', after.path, after.opening(), closing, missing))
+
+    overlaps = [(first, second, count) for (first, second), count in sorted(shared.items())]
+    return issues, overlaps
+
+
+def parse_args():
+    """parse command line arguments"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('statement',
+            help='statements (or directories of them) to check',
+            type=str,
+            nargs='+')
+
+    return parser.parse_args()
+
+
+def main():
+    """main entry point"""
+
+    args = parse_args()
+    issues, overlaps = reconcile_statements(args.statement)
+
+    for issue in issues:
+        msg = "{} in {} at {} {}".format(issue.kind, issue.path,
+                                         issue.record.get_date(), issue.record)
+        if issue.pence:
+            msg += ", {:.2f} missing".format(issue.pence / 100.0)
+        print msg
+    for first, second, count in overlaps:
+        print "{} and {} overlap by {} records".format(first, second, count)
+
+    return 1 if issues else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
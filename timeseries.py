@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+"""Dense time series of a money.TransactionTable for charting. Every
+day (or week or month) from the start to the end gets an entry, even
+ones with no transactions, so the arrays can be plotted straight
+away. Days are whole days since 1970 rather than timestamps so there
+is no daylight saving to trip over, and gaps are filled by bincount
+rather than by inserting into lists"""
+
+import numpy as np
+
+from analytics import _column, _period_index
+
+
+def _day_number(day):
+    """turns a date, datetime64 or days since 1970 into days since 1970"""
+
+    if isinstance(day, (int, long, np.integer)):
+        return int(day)
+    return int(np.datetime64(day, 'D').astype(np.int64))
+
+
+def _day_range(days, start, end):
+    """works out the first and last day of a series, from start and
+    end if they are given otherwise from days"""
+
+    first = _day_number(start) if start is not None else (days.min() if len(days) else None)
+    last = _day_number(end) if end is not None else (days.max() if len(days) else None)
+    if first is None or last is None or last < first:
+        return None
+    return int(first), int(last)
+
+
+def dense_series(days, incoming, outgoing, start=None, end=None):
+    """Spreads incoming and outgoing values for days (days since
+    1970, any order, repeats are added up) over every day from start
+    to end inclusive like daily_series. Returns (days, incoming,
+    outgoing) with days as datetime64"""
+
+    days = np.asarray(days, dtype=np.int64)
+    span = _day_range(days, start, end)
+    if span is None:
+        return np.zeros(0, dtype='datetime64[D]'), np.zeros(0), np.zeros(0)
+    first, last = span
+
+    inside = (days >= first) & (days <= last)
+    offset = days[inside] - first
+    length = last - first + 1
+
+    incoming = np.bincount(offset, weights=np.asarray(incoming, np.float64)[inside],
+                           minlength=length)
+    outgoing = np.bincount(offset, weights=np.asarray(outgoing, np.float64)[inside],
+                           minlength=length)
+
+    dates = np.arange(first, last + 1).astype('datetime64[D]')
+    return dates, incoming, outgoing
+
+
+def daily_series(table, start=None, end=None):
+    """Returns a tuple of numpy arrays (days, incoming, outgoing) with
+    an entry for every day from start to end inclusive (by default
+    the first and last days in table). days are datetime64, outgoing
+    is positive and records outside the range are left out"""
+
+    amounts = _column(table.amounts)
+    return dense_series(_column(table.days), np.maximum(amounts, 0),
+                        np.maximum(-amounts, 0), start, end)
+
+
+def period_series(table, period='day', start=None, end=None):
+    """Same as daily_series but for day, week or month periods.
+    Returns (starts, incoming, outgoing) where starts are the first
+    day of each period, every period from start to end is there"""
+
+    dates, incoming, outgoing = daily_series(table, start, end)
+
+    # every day is there so every period is too
+    starts, group = np.unique(_period_index(dates.astype(np.int64), period),
+                              return_inverse=True)
+    return (starts.astype('datetime64[D]'),
+            np.bincount(group, weights=incoming),
+            np.bincount(group, weights=outgoing))
+
+
+def running_balance(table, start=None, end=None):
+    """Returns a tuple of numpy arrays (days, balances) with the
+    balance at the end of every day from start to end. Days without
+    transactions keep the balance of the day before, days before the
+    first transaction get the balance before it"""
+
+    days = _column(table.days)
+    span = _day_range(days, start, end)
+    if span is None:
+        return np.zeros(0, dtype='datetime64[D]'), np.zeros(0)
+    first, last = span
+    length = last - first + 1
+    dates = np.arange(first, last + 1).astype('datetime64[D]')
+
+    if not len(days):
+        return dates, np.full(length, np.nan)
+
+    # into the order they happened, sequence breaks same day ties
+    order = np.lexsort((_column(table.sequence), days))
+    days = days[order]
+    balances = _column(table.balances)[order]
+    opening = balances[0] - _column(table.amounts)[order[0]]
+
+    # the last record of each day closes it
+    closing = np.ones(len(days), dtype=bool)
+    closing[:-1] = days[1:] != days[:-1]
+    days = days[closing]
+    balances = balances[closing]
+
+    # the days record closing the day before the series starts and
+    # each day of the series, -1 if there isnt one yet
+    latest = np.searchsorted(days, np.arange(first, last + 1), side='right') - 1
+    series = np.where(latest >= 0, balances[np.maximum(latest, 0)], opening)
+    return dates, series
+
+
+def rolling_mean(values, window):
+    """Mean of the last window values at each point, the first few
+    are the mean of however many values there are so far"""
+
+    if window < 1:
+        raise ValueError("window should be at least 1 not {}".format(window))
+
+    values = np.asarray(values, dtype=np.float64)
+    sums = np.cumsum(np.concatenate(([0.0], values)))
+    counts = np.minimum(np.arange(1, len(values) + 1), window)
+    ends = np.arange(1, len(values) + 1)
+    return (sums[ends] - sums[ends - counts]) / counts
+
+
+def plot_spend(table, period='day', window=7):
+    """Plots the outgoing for each period in table with a rolling
+    mean over window periods, and the running balance. Needs
+    matplotlib"""
+
+    # only needed here so the rest works without it
+    import matplotlib.pyplot as plt
+
+    starts, _, outgoing = period_series(table, period)
+    days, balances = running_balance(table)
+
+    figure, (spend_graph, balance_graph) = plt.subplots(2, 1, sharex=True)
+    spend_graph.bar(starts.astype('O'), outgoing)
+    spend_graph.plot(starts.astype('O'), rolling_mean(outgoing, window), color='red')
+    spend_graph.set_ylabel("Spent per {}".format(period))
+    spend_graph.grid(True)
+
+    balance_graph.plot(days.astype('O'), balances)
+    balance_graph.set_ylabel("Balance")
+    balance_graph.grid(True)
+
+    plt.show()
+    return figure
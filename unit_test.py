@@ -3,7 +3,13 @@
 """Unit test for bank statement analyser"""
 
 import unittest2
+import os
+import tempfile
+import shutil
+import re
+import money
 from money import *
+from places import Place, PlaceNormaliser
 import __builtin__ as builtins
 from mock import mock_open, patch
 
@@ -35,6 +41,34 @@ class Test_Everything(unittest2.TestCase):
 
         return test_str.format(**defaults)
 
+
+    def write_statement(self, descriptions, **kwargs):
+        """Writes a santander statement containing a record for
+        each description to a temporary file and returns the path.
+        kwargs are passed on to generate_santander_record"""
+
+        test_string = ("From:\xa001/11/2012\xa0to\xa005/11/2013\r\n\t\t\t\t\t\t\t\r\n"
+                       "Account:\xa0XXXX XXXX XXXX XXXX\r\n\t\t\t\t\t\t\r\n")
+
+        records = [self.generate_santander_record(description=desc, **kwargs)
+                   for desc in descriptions]
+        test_string += '\r\n\t\t\t\t\t\t\r\n'.join(records)
+
+        handle, path = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(handle, 'wb') as statement:
+            statement.write(test_string)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def write_file(self, text):
+        """writes text to a temporary file and returns the path"""
+
+        handle, path = tempfile.mkstemp()
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(text)
+        self.addCleanup(os.remove, path)
+        return path
+
    
         
     def test_date_layouts(self):
@@ -171,6 +205,1143 @@ class Test_Everything(unittest2.TestCase):
                                         record.trans_regex_map[record.transaction_type]))
 
 
+    def test_iter_statement_chunks(self):
+        """Records split across read boundaries should come out of
+        iter_statement the same as they would from parse_statement"""
+
+        tcases = ("BILL PAYMENT TO MISS CM SMITH",
+                  "CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014",
+                  "BANK GIRO CREDIT REF YOUR MOTHER, 483834dfg")
+        path = self.write_statement(tcases)
+
+        expected = [r.get_description()
+                    for r in Santander.parse_statement(path, sort=False)]
+
+        self.assertEqual(expected, list(tcases))
+
+        # real files are mapped, only things that cant be are read in
+        # chunks so give iter_statement one of those
+        import io
+        with open(path, 'rb') as statement:
+            read_data = statement.read()
+        reads = []
+        class Unmappable(io.BytesIO):
+            def read(self, size=-1):
+                reads.append(size)
+                return io.BytesIO.read(self, size)
+
+        for chunk_size in (1, 7, 64, 1024):
+            del reads[:]
+            with patch.object(builtins, 'open', lambda *args: Unmappable(read_data)):
+                records = list(Santander.iter_statement(path, chunk_size=chunk_size))
+            self.assertEqual([r.get_description() for r in records], list(tcases))
+            self.assertEqual(max(reads), chunk_size)
+
+        # the card payment carries its own date from the description
+        date_range = ("01-01-2013", "31-12-2013")
+        self.assertEqual(len(list(Santander.iter_statement(path, date_range))), 2)
+        date_range = ("01-01-2014", "31-12-2014")
+        self.assertEqual(len(list(Santander.iter_statement(path, date_range))), 1)
+
+
+    def test_trans_type_dispatch(self):
+        """The combined prefix regex should pick the same transaction
+        type the old startswith scan did"""
+
+        tcases = {"BILL PAYMENT TO MISS CM SMITH" : "Bill Payment",
+                  "REJECTED BILL PAYMENT TO MISS CM SMITH" : "Rejected Bill Payment",
+                  "CASH WITHDRAWAL REVERSAL AT TESCO" : "Cash Withdrawal",
+                  "WITHDRAWAL FROM ATM AT TESCO" : "Withdrawal",
+                  "CREDIT FROM ACME LTD ON 01-11" : "Credit",
+                  "BANK GIRO CREDIT REF YOUR MOTHER, 483834dfg" : "Bank Giro Credit"}
+
+        path = self.write_statement(sorted(tcases))
+        for record in Santander.iter_statement(path):
+            self.assertEqual(record._trans_type, tcases[record.get_description()])
+
+        self.assertRaises(RecordError, list,
+                          Santander.iter_statement(self.write_statement(["NEW THING"])))
+
+
+    def test_date_parser(self):
+        """DateParser should understand every layout we see in
+        statements, including the year-less ones, and cache them"""
+
+        parser = DateParser(maxsize=2)
+        expected = datetime.datetime(2012, 11, 1)
+
+        for tcase in ("01/11/2012", "01/11/12", "01-11-2012", "2012-11-01",
+                      "01NOV12", "01nov2012", "01-NOV-12", "01/Nov/2012"):
+            self.assertEqual(parser.parse(tcase), expected, tcase)
+
+        self.assertEqual(parser.parse("01NOV", 2012), expected)
+        self.assertEqual(parser.parse("01-NOV", 2012), expected)
+        self.assertEqual(parser.parse("01NOV"), None)
+        self.assertEqual(parser.parse("29FEB", 2013), None)
+
+        for tcase in ("01-11", "31/02/2013", "01XYZ12", "", "ON"):
+            self.assertEqual(parser.parse(tcase), None, tcase)
+
+        # only the last two strings are remembered
+        misses = parser.misses
+        parser.parse("ON")
+        parser.parse("")
+        self.assertEqual(parser.misses, misses)
+        parser.parse("01/11/2012")
+        self.assertEqual(parser.misses, misses + 1)
+
+        path = self.write_statement(["CARD PAYMENT TO PETS AT HOME LTD, ON 01NOV12"])
+        record = Santander.parse_statement(path)[0]
+        self.assertEqual(record.get_date(), "01-11-2012")
+
+        # the ingest service parses in threads that share one cache
+        import sys
+        import threading
+        parser = DateParser(maxsize=64)
+        dates = ["{:02d}/{:02d}/2013".format(day, month)
+                 for month in range(1, 13) for day in range(1, 29)]
+        errors = []
+        def parse_all():
+            try:
+                for _ in range(5):
+                    for date_string in dates:
+                        parser.parse(date_string)
+            except Exception as error:
+                errors.append(error)
+
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=parse_all) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(parser._cache), 64)
+        self.assertEqual(parser.hits + parser.misses, 4 * 5 * len(dates))
+
+
+    def test_transaction_table(self):
+        """Records should go into a TransactionTable and come back
+        out the same, with places and types stored once"""
+
+        tcases = ("CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014",
+                  "CARD PAYMENT TO PETS AT HOME LTD, ON 24-11-2014",
+                  "BILL PAYMENT TO MISS CM SMITH")
+        records = Santander.parse_statement(self.write_statement(tcases), sort=False)
+
+        # slots mean no per record dict
+        self.assertFalse(hasattr(records[0], '__dict__'))
+
+        table = TransactionTable.from_records(records)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.places, ["PETS AT HOME LTD", "MISS CM SMITH"])
+        self.assertEqual(list(table.place_codes), [0, 0, 1])
+        self.assertEqual(table.trans_types, ["Card Payment", "Bill Payment"])
+
+        for record, row in zip(records, table):
+            self.assertEqual(row.date, record._date)
+            self.assertEqual(row.description, record.get_description())
+            self.assertEqual(row.place, record.get_place())
+            self.assertEqual(row.amount, -200.01)
+            self.assertEqual(row.balance, 418.67)
+            self.assertEqual(row.trans_type, record.get_trans_type())
+
+
+    def test_analytics(self):
+        """The numpy aggregations should agree with adding things up
+        by hand"""
+
+        import analytics
+
+        tcases = ("CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014",
+                  "CARD PAYMENT TO PETS AT HOME LTD, ON 24-11-2014",
+                  "BILL PAYMENT TO MISS CM SMITH")
+        table = TransactionTable.from_records(
+            Santander.iter_statement(self.write_statement(tcases)))
+        table.append(datetime.datetime(2014, 11, 28), "CREDIT FROM ACME LTD ON 28-11",
+                     "ACME LTD", 1000.0, 1418.67, "Credit")
+
+        # columns are read with whatever size the arrays items are
+        for name in TransactionTable._arrays:
+            values = getattr(table, name)
+            column = analytics._column(values)
+            self.assertEqual(column.itemsize, values.itemsize)
+            self.assertEqual(list(column), list(values))
+
+        totals = analytics.place_totals(table)
+        self.assertEqual([place for place, _ in totals],
+                         ["PETS AT HOME LTD", "MISS CM SMITH", "ACME LTD"])
+        self.assertAlmostEqual(totals[0][1], -400.02)
+
+        self.assertAlmostEqual(analytics.income_outgoing(table)["incoming"], 1000.0)
+        self.assertAlmostEqual(analytics.income_outgoing(table)["outgoing"], 600.03)
+
+        starts, incoming, outgoing = analytics.period_totals(table, 'week')
+        self.assertEqual([str(start) for start in starts],
+                         ["2013-02-04", "2014-11-17", "2014-11-24"])
+        self.assertEqual(list(incoming), [0, 0, 1000.0])
+        self.assertAlmostEqual(outgoing[1], 200.01)
+        self.assertAlmostEqual(outgoing[2], 200.01)
+
+        starts, incoming, outgoing = analytics.period_totals(table, 'month')
+        self.assertEqual([str(start) for start in starts],
+                         ["2013-02-01", "2014-11-01"])
+        self.assertRaises(ValueError, analytics.period_totals, table, 'year')
+
+
+    def test_transaction_store(self):
+        """Records streamed into the store should all come out again,
+        however the batches fall"""
+
+        from database import TransactionStore
+
+        tcases = ("CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014",
+                  "CARD PAYMENT TO PETS AT HOME LTD, ON 24-11-2014",
+                  "BILL PAYMENT TO MISS CM SMITH")
+        path = self.write_statement(tcases)
+
+        with TransactionStore(':memory:') as store:
+            inserted = store.insert(Santander.iter_statement(path), batch_size=2)
+            self.assertEqual(inserted, 3)
+
+            rows = store._conn.execute("SELECT * FROM useful_statement;").fetchall()
+            self.assertEqual(len(rows), 3)
+            self.assertEqual(rows[0][1:7], (tcases[0], "PETS AT HOME LTD", -200.01,
+                                           418.67, "Card Payment", "Santander"))
+            self.assertEqual(rows[0][0], 1416700800)
+
+            # a failed batch shouldnt leave anything behind, this one
+            # fails after its raw_statement rows have gone in
+            class NoAccount(Santander):
+                __slots__ = ()
+                def get_account(self):
+                    raise RuntimeError("which bank?")
+
+            broken = Santander.parse_statement(self.write_statement(
+                ["BILL PAYMENT TO MR BLOBBY"], date="01/12/2014", balance="1.00"))
+            for record in broken:
+                record.__class__ = NoAccount
+            self.assertRaises(RuntimeError, store.insert, broken)
+
+            for table in ("raw_statement", "useful_statement"):
+                count = store._conn.execute("SELECT COUNT(*) FROM {};".format(table))
+                self.assertEqual(count.fetchone()[0], 3)
+            self.assertEqual(len(store.daily_totals()), 3)
+
+
+    def test_incremental_import(self):
+        """Importing the same statement twice, or one that overlaps
+        with one already imported, should only add the new records"""
+
+        from database import TransactionStore
+
+        tcases = ["BILL PAYMENT TO MISS CM SMITH",
+                  "CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014"]
+        path = self.write_statement(tcases)
+
+        with TransactionStore(':memory:') as store:
+            self.assertEqual(store.import_statement(path), 2)
+            self.assertEqual(store.import_statement(path), 0)
+
+            # same records in a different file are ignored
+            overlap = self.write_statement(tcases + ["BILL PAYMENT TO MR BLOBBY"])
+            self.assertEqual(store.import_statement(overlap), 1)
+
+            # appending to an imported file only reads the new part
+            with open(path, 'ab') as statement:
+                statement.write('\r\n\t\t\t\t\t\t\r\n')
+                statement.write(self.generate_santander_record(
+                    description="BILL PAYMENT TO MRS DOUBTFIRE", balance="1.00"))
+            os.utime(path, (0, 0))
+            self.assertEqual(store.import_statement(path), 1)
+
+            places = store._conn.execute("SELECT Place FROM useful_statement;").fetchall()
+            self.assertEqual(sorted(place for place, in places),
+                             ["MISS CM SMITH", "MR BLOBBY", "MRS DOUBTFIRE",
+                              "PETS AT HOME LTD"])
+            self.assertEqual(store._conn.execute(
+                "SELECT COUNT(*) FROM raw_statement;").fetchone()[0], 4)
+
+            offset = store._conn.execute("SELECT Offset FROM imported_files WHERE Path = ?;",
+                                         (os.path.abspath(path),)).fetchone()[0]
+            self.assertEqual(offset, os.path.getsize(path))
+
+            # imports look fingerprints up rather than loading them all
+            stored = store.stored_fingerprints()
+            self.assertIn(next(iter(store.fingerprints())), stored)
+            self.assertNotIn("not a fingerprint", stored)
+            with patch.object(store, 'fingerprints',
+                              side_effect=AssertionError("loaded every fingerprint")):
+                self.assertEqual(store.import_statement(
+                    self.write_statement(tcases + ["BILL PAYMENT TO MR BENN"])), 1)
+
+
+    def test_transactions_between(self):
+        """Date window queries on the store should only return what
+        is inside the window, and use the indexes to do it"""
+
+        from database import TransactionStore
+
+        tcases = ("CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014",
+                  "CARD PAYMENT TO PETS AT HOME LTD, ON 24-11-2014",
+                  "BILL PAYMENT TO MISS CM SMITH")
+
+        with TransactionStore(':memory:') as store:
+            store.import_statement(self.write_statement(tcases))
+
+            rows = list(store.transactions_between("24-11-2014", "31-12-2014"))
+            self.assertEqual([row[1] for row in rows], [tcases[1]])
+
+            rows = list(store.transactions_between(end=datetime.datetime(2014, 11, 24)))
+            self.assertEqual([row[1] for row in rows], [tcases[2], tcases[0], tcases[1]])
+
+            rows = list(store.transactions_between(place="MISS CM SMITH"))
+            self.assertEqual([row[1] for row in rows], [tcases[2]])
+            rows = list(store.transactions_between("01-01-2014", None, type="Bill Payment"))
+            self.assertEqual(rows, [])
+
+            table = store.table_between("23-11-2014", "24-11-2014")
+            self.assertEqual(len(table), 2)
+            self.assertEqual(table.get_date(0), datetime.datetime(2014, 11, 23))
+
+            plan = store._conn.execute("""EXPLAIN QUERY PLAN
+                                          SELECT * FROM useful_statement
+                                          WHERE Timestamp >= 0;""").fetchall()
+            self.assertIn("useful_timestamp", str(plan))
+
+        # same day records should come back in the order they happened
+        # not the (newest first) order they were in the statement
+        import sqlite3
+        import benchmark
+        import timeseries
+        path = self.write_file("")
+        benchmark.generate_statement(path, 4000, seed=4)
+        parsed = TransactionTable.from_records(Santander.parse_statement(path))
+        with TransactionStore(':memory:') as store:
+            store.import_statement(path)
+            stored = store.table_between()
+        for expected, found in zip(timeseries.running_balance(parsed),
+                                   timeseries.running_balance(stored)):
+            self.assertTrue((expected == found).all())
+
+        # databases made by the old formatDatabase get fingerprints
+        # and positions, copies of a row only keep one fingerprint and
+        # a stored record is still recognised when imported again
+        records = Santander.parse_statement(path)
+        old = records[0]
+        stored = (old.get_timestamp(), old.get_description(), old.get_place(),
+                  old.get_amount(), old.get_balance(), old.get_trans_type(), 'Santander')
+        database_path = self.write_file("")
+        connection = sqlite3.connect(database_path)
+        connection.execute("""CREATE TABLE raw_statement
+                              (Date TEXT, Description TEXT, Amount TEXT, Balance TEXT);""")
+        connection.execute("""CREATE TABLE useful_statement
+                              (Timestamp INTEGER, Description TEXT, Place TEXT,
+                               Amount REAL, Balance REAL, Type TEXT, Account TEXT);""")
+        for row in (stored, (0, 'OLD', 'OLD', 1.0, 1.0, 'Mystery', 'Santander'),
+                    (0, 'OLD', 'OLD', 1.0, 1.0, 'Mystery', 'Santander')):
+            connection.execute("INSERT INTO raw_statement VALUES(?, ?, ?, ?);",
+                               ('01/01/1970', row[1], str(row[3]), str(row[4])))
+            connection.execute("INSERT INTO useful_statement VALUES(?, ?, ?, ?, ?, ?, ?);", row)
+        connection.commit()
+        connection.close()
+        with TransactionStore(database_path) as store:
+            self.assertEqual(store.transactions_between().fetchone()[-1], 0)
+            for table in ("raw_statement", "useful_statement"):
+                fingerprints = [row[0] for row in store._conn.execute(
+                    "SELECT Fingerprint FROM {} ORDER BY rowid;".format(table))]
+                self.assertIsNotNone(fingerprints[1])
+                self.assertIsNone(fingerprints[2])
+            self.assertIn(old.get_fingerprint(), store.stored_fingerprints())
+            self.assertEqual(store.insert(records), 999)
+            self.assertEqual(len(store.table_between()), 1002)
+            self.assertEqual(store.summary("month")[0][-1], 2)
+
+
+    def test_sort_and_merge(self):
+        """Same day records should come out oldest first (the reverse
+        of the statement) and merging sorted statements should give
+        the same as sorting them all together"""
+
+        first = self.write_statement(["BILL PAYMENT TO LATEST",
+                                      "BILL PAYMENT TO MIDDLE",
+                                      "CARD PAYMENT TO EARLIEST, ON 01-01-2013"])
+        second = self.write_statement(["BILL PAYMENT TO OTHER",
+                                       "CARD PAYMENT TO LATER, ON 01-01-2014"],
+                                      date="06/02/2013")
+
+        statement = Santander.parse_statement(first)
+        self.assertEqual([r.get_place() for r in statement],
+                         ["EARLIEST", "MIDDLE", "LATEST"])
+
+        # timestamps with different numbers of digits sorted as strings
+        # used to come out in the wrong order
+        self.assertTrue(statement[0].sort_key() < statement[1].sort_key())
+        self.assertEqual(statement[0].get_timestamp(), 1356998400)
+
+        merged = merge_statements([statement, Santander.parse_statement(second)])
+        self.assertEqual([r.get_place() for r in merged],
+                         ["EARLIEST", "OTHER", "MIDDLE", "LATEST", "LATER"])
+
+
+    def test_parse_statements(self):
+        """Parsing several statements in worker processes should give
+        the same as parsing them here and merging"""
+
+        import pickle
+        import shutil
+
+        first = self.write_statement(["BILL PAYMENT TO LATEST",
+                                      "CARD PAYMENT TO EARLIEST, ON 01-01-2013"])
+        second = self.write_statement(["BILL PAYMENT TO OTHER"], date="06/02/2013")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        shutil.copy(second, directory)
+
+        expected = [record.get_place() for record in merge_statements(
+            [Santander.parse_statement(first), Santander.parse_statement(second)])]
+
+        for workers in (1, 2):
+            table = parse_statements([first, directory], workers=workers)
+            self.assertEqual([row.place for row in table], expected)
+
+        copy = pickle.loads(pickle.dumps(table, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(list(copy), list(table))
+
+
+    def test_parallel_parse_statement(self):
+        """Cutting a statement into chunks and parsing them in
+        seperate processes should give the same as parsing it whole"""
+
+        tcases = ["BILL PAYMENT TO PERSON {}".format(n) for n in xrange(20)]
+        tcases.append("CARD PAYMENT TO EARLIEST, ON 01-01-2013")
+        path = self.write_statement(tcases)
+
+        expected = [record.get_place() for record in Santander.parse_statement(path)]
+        unsorted = [record.get_place()
+                    for record in Santander.parse_statement(path, sort=False)]
+
+        for workers in (1, 2, 3, 7, 50):
+            table = Santander.parse_statement_table(path, workers=workers)
+            self.assertIsInstance(table, TransactionTable)
+            self.assertEqual([row.place for row in table], expected)
+
+            table = Santander.parse_statement_table(path, sort=False, workers=workers)
+            self.assertEqual([row.place for row in table], unsorted)
+
+
+    def test_mapped_reader(self):
+        """The mmap reader and the fallback chunked reader should pull
+        out the same fields, colons in descriptions and all"""
+
+        tcases = ("BILL PAYMENT TO MR SMITH: RENT",
+                  "CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014")
+        path = self.write_statement(tcases)
+
+        mapped = [(r._position, r.get_place()) for r in Santander.iter_statement(path)]
+        self.assertEqual([place for _, place in mapped], ["MR SMITH: RENT", "PETS AT HOME LTD"])
+
+        # mocked files cant be mapped so they get read, in one go as
+        # mock_open ignores the size, see test_split_records for chunks
+        with open(path, 'rb') as statement:
+            read_data = statement.read()
+        with patch.object(builtins, 'open', mock_open(read_data=read_data)):
+            chunked = [(r._position, r.get_place()) for r in Santander.iter_statement('ignore')]
+        self.assertEqual(chunked, mapped)
+
+        # just the header, then nothing at all (which cant be mapped)
+        empty = self.write_statement([])
+        self.assertEqual(list(Santander.iter_statement(empty)), [])
+        open(empty, 'wb').close()
+        self.assertEqual(list(Santander.iter_statement(empty)), [])
+
+        broken = self.write_statement(["BILL PAYMENT TO MR SMITH"])
+        with open(broken, 'rb') as statement:
+            read_data = statement.read().replace("Balance:", "Balonce:")
+        with open(broken, 'wb') as statement:
+            statement.write(read_data)
+        self.assertRaises(BadFile, list, Santander.iter_statement(broken))
+
+
+    def test_split_records(self):
+        """The fallback reader should find every record whatever size
+        the chunks are, including separators split between two reads,
+        and stop at its limit"""
+
+        from StringIO import StringIO
+
+        text = open(self.write_statement(["BILL PAYMENT TO MR SMITH: RENT",
+                                          "CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014",
+                                          "BILL PAYMENT TO MISS CM SMITH"]), 'rb').read()
+
+        def split(text):
+            offset, records = 0, []
+            for record in text.split(RECORD_SEPARATOR):
+                records.append((offset, record))
+                offset += len(record) + len(RECORD_SEPARATOR)
+            return records
+
+        # every size up to the separators length splits one somewhere
+        chunk_sizes = range(1, len(RECORD_SEPARATOR) + 3) + [64, 4096]
+        first = text.index(RECORD_SEPARATOR + "Date:") + len(RECORD_SEPARATOR)
+        mapped = list(money._mapped_records(text, first, len(text)))
+        self.assertEqual(len(mapped), 3)
+
+        for chunk_size in chunk_sizes:
+            records = list(money._split_records(StringIO(text), RECORD_SEPARATOR, chunk_size))
+            self.assertEqual(records, split(text))
+
+            limit = first + 10
+            records = list(money._split_records(StringIO(text), RECORD_SEPARATOR,
+                                                chunk_size, limit))
+            self.assertEqual(records, split(text[:limit]))
+
+            statement = StringIO(text)
+            statement.seek(first)
+            self.assertEqual(list(money._read_records(statement, first, chunk_size=chunk_size)),
+                             mapped)
+
+
+    def test_statement_cache(self):
+        """A cached statement should load without being parsed, and
+        changing the statement or the parser should invalidate it"""
+
+        import shutil
+        import cache
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        statement_cache = cache.StatementCache(directory)
+
+        path = self.write_statement(["BILL PAYMENT TO MISS CM SMITH",
+                                     "CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014"])
+        self.assertEqual(statement_cache.get(path), None)
+
+        table = statement_cache.load(path)
+        with patch.object(Santander, 'parse_statement', side_effect=AssertionError):
+            cached = statement_cache.load(path)
+        self.assertEqual(list(cached), list(table))
+        self.assertEqual(cached.places, table.places)
+
+        # adding a record changes the content hash
+        with open(path, 'ab') as statement:
+            statement.write('\r\n\t\t\t\t\t\t\r\n')
+            statement.write(self.generate_santander_record(balance="1.00"))
+        os.utime(path, (0, 0))
+        self.assertEqual(statement_cache.get(path), None)
+        self.assertEqual(len(statement_cache.load(path)), 3)
+
+        with patch.object(cache, 'PARSER_VERSION', -1):
+            self.assertEqual(cache.StatementCache(directory).get(path), None)
+
+        table = parse_statements([path], workers=1, cache_dir=directory)
+        self.assertEqual(len(table), 3)
+
+        statement_cache.clear()
+        self.assertEqual(statement_cache.get(path), None)
+
+    def test_place_normaliser(self):
+        """checks store numbers and variants come out as one
+        canonical place and that places are interned"""
+
+        normaliser = PlaceNormaliser()
+        self.assertEqual(normaliser.normalise("TESCO STORES-2889"), "TESCO")
+        self.assertEqual(normaliser.normalise("TESCO UPT 3896"), "TESCO")
+        self.assertEqual(normaliser.normalise("SAINSBURY'S S/MKT"), "SAINSBURYS")
+        self.assertEqual(normaliser.normalise("marks &amp; spencer plc"),
+                         "MARKS AND SPENCER")
+        self.assertEqual(normaliser.normalise("COSTA  COFFEE  #0421"), "COSTA COFFEE")
+        self.assertEqual(normaliser.normalise("TESCO PERSONAL FINANCE"),
+                         "TESCO PERSONAL FINANCE")
+        self.assertEqual(normaliser.normalise(None), None)
+
+        # the same name is the same object
+        self.assertIs(normaliser.normalise("TESCO STORES 1"),
+                      normaliser.normalise("tesco express"))
+        self.assertIs(Place("SHELL"), Place("SHELL"))
+        self.assertIsInstance(normaliser.normalise("SHELL 123"), Place)
+
+        custom = PlaceNormaliser([(r"SHELL\b", "PETROL")])
+        self.assertEqual(custom.normalise("SHELL 123"), "PETROL")
+        self.assertEqual(custom.normalise("TESCO STORES-2889"), "TESCO STORES")
+        self.assertEqual(PlaceNormaliser([]).normalise("BP 12345"), "BP")
+
+        records = [Santander("CARD PAYMENT TO TESCO STORES-2889,3.50 GBP, "
+                             "RATE 1.00/GBP ON 01-01-2015",
+                             "01/01/2015", "-3.50", "100.00"),
+                   Santander("CARD PAYMENT TO TESCO UPT 3896,1.50 GBP, "
+                             "RATE 1.00/GBP ON 02-01-2015",
+                             "02/01/2015", "-1.50", "98.50")]
+        self.assertEqual(records[0].get_raw_place(), "TESCO STORES-2889")
+        self.assertEqual(records[0].get_place(), records[1].get_place())
+        table = TransactionTable.from_records(records)
+        self.assertEqual(table.places, ["TESCO"])
+
+    def test_categoriser(self):
+        """Rules should come first, then places we know about, then
+        the closest place we know about"""
+
+        from categories import Categoriser, UNCATEGORISED
+        import analytics
+
+        categoriser = Categoriser([(r"TESCO\b", "groceries"),
+                                   (r".*LETTINGS", "rent")],
+                                  {"JOES CORNER CAFE": "eating out"})
+        self.assertEqual(categoriser.categorise("TESCO"), "groceries")
+        self.assertEqual(categoriser.categorise("FOXTONS LETTINGS"), "rent")
+        self.assertEqual(categoriser.categorise("JOES CORNER CAFE"), "eating out")
+        self.assertEqual(categoriser.categorise("JOES CORNER CAFE LTD"), "eating out")
+        self.assertEqual(categoriser.categorise("PETS AT HOME"), UNCATEGORISED)
+        self.assertEqual(categoriser.categorise(None), UNCATEGORISED)
+
+        # places matched by rules help guess the rest whatever the order
+        self.assertEqual(categoriser.categorise_places(["KFOXTONS LETTINGS",
+                                                        "FOXTONS LETTINGS",
+                                                        "PETS AT HOME"]),
+                         ["rent", "rent", UNCATEGORISED])
+        self.assertEqual(categoriser.categorise("FOXTONS LETTNGS"), "rent")
+
+        # learning a place only throws away the guesses it could change
+        categoriser.changed_guesses()
+        categoriser.learn("FOXTONS LETTNG", "estate agents")
+        changed = categoriser.changed_guesses()
+        self.assertIn("FOXTONS LETTNGS", changed)
+        self.assertNotIn("PETS AT HOME", changed)
+        self.assertEqual(categoriser.changed_guesses(), set())
+
+        table = TransactionTable()
+        for day, place, amount in ((0, "TESCO", -5.0), (1, "FOXTONS LETTINGS", -500.0),
+                                   (2, "TESCO", -2.5), (3, "PETS AT HOME", -10.0)):
+            table.append(day, place, place, amount, 0.0, "Card Payment")
+        self.assertEqual(analytics.category_totals(table, categoriser),
+                         [("rent", -500.0), (UNCATEGORISED, -10.0), ("groceries", -7.5)])
+        self.assertEqual(analytics.category_totals(TransactionTable(), categoriser), [])
+
+        from database import TransactionStore
+
+        rule_path = self.write_file("# comment\n"
+                                    "groceries,(ALDI|LIDL)\\b\n"
+                                    "rent, .*LETTINGS\n")
+        with TransactionStore(':memory:') as store:
+            self.assertEqual(store.category_rules()[0][1], "groceries")
+            self.assertEqual(store.load_category_rules(rule_path), 2)
+            self.assertEqual(store.category_rules(), [(r"(ALDI|LIDL)\b", "groceries"),
+                                                      (r" .*LETTINGS", "rent")])
+            store.set_place_category("TESCO", "treats")
+            store.set_place_category("ALDI", "treats")
+            store.set_place_category("ALDI", None)
+
+            categoriser = store.categoriser()
+            self.assertEqual(categoriser.categorise("TESCO"), "treats")
+            self.assertEqual(categoriser.categorise("ALDI"), "groceries")
+
+    def test_natwest(self):
+        """Natwest CSV statements should stream into the same kind of
+        records as santander ones, and import into the store"""
+
+        header = "\r\nDate, Type, Description, Value, Balance, Account Name, Account Number\r\n"
+        rows = ("23/05/2013,POS,\"'4659 21MAY13 , TESCO STORES 2456 , LONDON GB\","
+                "-12.50,100.00,'MR X,'123456-12345678,\r\n"
+                "24/05/2013,D/D,'BRITISH GAS,-40.00,60.00,'MR X,'123456-12345678,\r\n"
+                "\r\n"
+                "25/05/2013,C/L,'RBS BANK 24MAY,-20.00,40.00,'MR X,'123456-12345678,\r\n")
+        path = self.write_file(header + rows)
+
+        records = Natwest.parse_statement(path)
+        self.assertEqual([record.get_trans_type() for record in records],
+                         ['Card Payment', 'Direct Debit', 'Cash Withdrawel'])
+        self.assertEqual([record.get_date() for record in records],
+                         ['21-05-2013', '24-05-2013', '24-05-2013'])
+        self.assertEqual(records[0].get_place(), "TESCO")
+        self.assertEqual(records[2].get_raw_place(), "RBS BANK")
+        self.assertEqual(records[1].get_amount(), -40.0)
+        self.assertEqual(records[1].get_account(), "Natwest")
+        self.assertEqual(len(fromNatwest(path)), 3)
+        self.assertEqual(len(Natwest.parse_statement(path, ("22-05-2013", "31-05-2013"))), 2)
+
+        # positions are where each row starts in the file, also when
+        # reading from part way through, and key the quarantine too
+        text = header + rows
+        starts = [text.index(date) for date in ("23/05", "24/05", "25/05")]
+        self.assertEqual([record.sort_key()[1] for record in fromNatwest(path)], starts)
+        self.assertEqual([record.sort_key()[1]
+                          for record in Natwest.iter_statement(path, offset=starts[1])],
+                         starts[1:])
+        broken = text.replace("-40.00", "lots")
+        quarantine = Natwest.parse_statement(self.write_file(broken), errors="collect")[1]
+        self.assertEqual([record.offset for record in quarantine], [starts[1]])
+
+        santander = Santander.parse_statement(self.write_statement(["BILL PAYMENT TO MISS CM SMITH"]))
+        table = TransactionTable.from_records(list(merge_statements([records, santander])))
+        self.assertEqual(len(table), 4)
+
+        from database import TransactionStore
+
+        with TransactionStore(':memory:') as store:
+            self.assertEqual(store.import_statement(path, parser=Natwest), 3)
+
+            with open(path, 'ab') as statement:
+                statement.write("26/05/2013,TFR,'SAVINGS,-5.00,35.00,'MR X,'123456-12345678,\r\n")
+            os.utime(path, (0, 0))
+            self.assertEqual(store.import_statement(path, parser=Natwest), 1)
+
+            row = store.transactions_between(place="SAVINGS").fetchone()
+            self.assertEqual(row[5:7], ("TFR", "Natwest"))
+
+        self.assertRaises(BadFile, list, Natwest.iter_statement(self.write_file("Date,Value\r\n")))
+
+
+    def test_detect_parser(self):
+        """Statements should be sent to the right parser from their
+        first few bytes, so a directory of both can be parsed at once"""
+
+        natwest = ("\r\nDate, Type, Description, Value, Balance, Account Name, Account Number\r\n"
+                   "24/05/2013,D/D,'BRITISH GAS,-40.00,60.00,'MR X,'123456-12345678,\r\n")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, text in (("natwest.csv", natwest),
+                           ("santander.txt", open(self.write_statement(
+                               ["BILL PAYMENT TO MISS CM SMITH"])).read())):
+            with open(os.path.join(directory, name), 'wb') as statement:
+                statement.write(text)
+
+        natwest_path = os.path.join(directory, "natwest.csv")
+        self.assertIs(detect_parser(natwest_path), Natwest)
+        self.assertIs(detect_parser(os.path.join(directory, "santander.txt")), Santander)
+        self.assertIn(Natwest, parsers())
+        self.assertEqual(parse_statement(natwest_path)[0].get_place(), "BRITISH GAS")
+        self.assertRaises(BadFile, detect_parser, self.write_file("hello"))
+
+        for cache_dir in (None, os.path.join(directory, "cache")):
+            table = parse_statements([directory], workers=1, cache_dir=cache_dir)
+            self.assertEqual(sorted(table.places), ["BRITISH GAS", "MISS CM SMITH"])
+
+        from database import TransactionStore
+
+        with TransactionStore(':memory:') as store:
+            self.assertEqual(store.import_statement(natwest_path), 1)
+
+    def test_quarantine(self):
+        """With errors="collect" records that cant be parsed should be
+        quarantined and the rest parsed, and after the parser is fixed
+        only the quarantined records should need parsing again"""
+
+        path = self.write_statement(["BILL PAYMENT TO MISS CM SMITH",
+                                     "MYSTERY THING FROM NOWHERE",
+                                     "CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014"])
+        with open(path, 'ab') as statement:
+            statement.write("\r\n\t\t\t\t\t\t\r\nDate:\xa001/01/2013\r\nFoo:\xa0x\r\n"
+                            "Amount:\xa01.00\r\nBalance:\xa01.00")
+
+        self.assertRaises(RecordError, Santander.parse_statement, path)
+        self.assertRaises(ValueError, Santander.parse_statement, path, errors="ignore")
+        self.assertRaises(ValueError, list, Santander.iter_statement(path, errors="collect"))
+
+        records, quarantine = Santander.parse_statement(path, errors="collect")
+        self.assertEqual(len(records), 2)
+        self.assertEqual(quarantine.counts(), {"RecordError" : 1, "BadFile" : 1})
+        for workers in (1, 2):
+            records, quarantine = Santander.parse_statement_table(path, workers=workers,
+                                                                  errors="collect")
+            self.assertEqual(len(records), 2)
+            self.assertEqual(quarantine.counts(), {"RecordError" : 1, "BadFile" : 1})
+
+        mystery = [record for record in quarantine if record.error == "RecordError"][0]
+        self.assertEqual(mystery.fields["description"], "MYSTERY THING FROM NOWHERE")
+        with open(path, 'rb') as statement:
+            statement.seek(mystery.offset)
+            self.assertEqual(statement.read(5), "Date:")
+
+        table, quarantine = parse_statements([path], workers=1, errors="collect")
+        self.assertEqual((len(table), len(quarantine)), (2, 2))
+
+        patterns = dict(Santander._trans_patterns, Mystery=r"^mystery\ (?P<place>.*)$")
+        regex, groups = money._compile_prefix_matcher(patterns)
+        fixed = patch.multiple(Santander, _trans_type_regex=regex, _trans_type_groups=groups,
+                               _trans_regex_map=dict(Santander._trans_regex_map,
+                                                     Mystery=re.compile(patterns["Mystery"],
+                                                                        re.I|re.VERBOSE)))
+
+        from database import TransactionStore
+
+        with TransactionStore(':memory:') as store:
+            self.assertEqual(store.import_statement(path, errors="collect"), 2)
+            self.assertEqual(store.quarantined().counts(), {"RecordError" : 1, "BadFile" : 1})
+            self.assertEqual([record.fields for record in store.quarantined()],
+                             [record.fields for record in
+                              sorted(quarantine, key=lambda record: record.offset)])
+
+            # stored as plain JSON, reading the database runs nothing
+            import json
+            stored = store._conn.execute("SELECT Fields FROM quarantine ORDER BY Offset;")
+            self.assertEqual(json.loads(stored.fetchone()[0])["description"],
+                             "MYSTERY THING FROM NOWHERE")
+
+            with fixed:
+                self.assertEqual(store.retry_quarantined(), 1)
+            self.assertEqual(store.quarantined().counts(), {"BadFile" : 1})
+            self.assertEqual(store.transactions_between(type="Mystery").fetchone()[2],
+                             "THING FROM NOWHERE")
+
+    def test_timeseries(self):
+        """Series should have an entry for every day, week or month
+        whether or not anything happened on it"""
+
+        import numpy as np
+        import timeseries
+
+        table = TransactionTable()
+        for day, amount, balance, sequence in ((10, -5.0, 95.0, 0), (10, -2.0, 93.0, 1),
+                                               (13, 100.0, 193.0, 2), (45, -3.0, 190.0, 3)):
+            table.append(day, "x", "x", amount, balance, "Card Payment", sequence)
+
+        days, incoming, outgoing = timeseries.daily_series(table)
+        self.assertEqual(len(days), 36)
+        self.assertEqual(str(days[0]), "1970-01-11")
+        self.assertEqual(list(outgoing[:4]), [7.0, 0.0, 0.0, 0.0])
+        self.assertEqual(incoming.sum(), 100.0)
+
+        days, _, outgoing = timeseries.daily_series(table, start=12, end=np.datetime64('1970-01-15'))
+        self.assertEqual((len(days), outgoing.sum()), (3, 0.0))
+
+        starts, incoming, outgoing = timeseries.period_series(table, 'week')
+        self.assertEqual([str(start) for start in starts],
+                         ["1970-01-05", "1970-01-12", "1970-01-19", "1970-01-26",
+                          "1970-02-02", "1970-02-09"])
+        self.assertEqual(list(outgoing), [7.0, 0.0, 0.0, 0.0, 0.0, 3.0])
+        starts, _, _ = timeseries.period_series(table, 'month')
+        self.assertEqual(len(starts), 2)
+        self.assertRaises(ValueError, timeseries.period_series, table, 'year')
+
+        days, balances = timeseries.running_balance(table, start=8)
+        self.assertEqual(list(balances[:7]), [100.0, 100.0, 93.0, 93.0, 93.0, 193.0, 193.0])
+        self.assertEqual(balances[-1], 190.0)
+
+        self.assertEqual(list(timeseries.rolling_mean([2, 4, 6, 8], 2)), [2.0, 3.0, 5.0, 7.0])
+        self.assertEqual(len(timeseries.daily_series(TransactionTable())[0]), 0)
+        self.assertEqual(len(timeseries.period_series(TransactionTable(), 'month')[0]), 0)
+
+    def test_export(self):
+        """Every format should write every record, in batches, from
+        records or tables, and columnar files should read back"""
+
+        import csv
+        import json
+        import export
+
+        tcases = ("CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014",
+                  "BILL PAYMENT TO MISS CM SMITH",
+                  "REJECTED BILL PAYMENT TO ")
+        path = self.write_statement(tcases)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        csv_path = os.path.join(directory, "out.csv")
+        self.assertEqual(export.export(Santander.iter_statement(path), csv_path,
+                                       batch_size=2), 3)
+        with open(csv_path, 'rb') as out:
+            rows = list(csv.reader(out))
+        self.assertEqual(rows[0], list(export.FIELDS))
+        self.assertEqual(rows[1][:3], ["2014-11-23", tcases[0], "PETS AT HOME LTD"])
+        self.assertEqual(len(rows), 4)
+
+        table = TransactionTable.from_records(Santander.parse_statement(path))
+        jsonl_path = os.path.join(directory, "out.txt")
+        self.assertEqual(export.export(table, jsonl_path, 'jsonl', batch_size=2), 3)
+        with open(jsonl_path, 'rb') as out:
+            lines = [json.loads(line) for line in out]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1]["place"], "PETS AT HOME LTD")
+
+        columnar_path = os.path.join(directory, "out.col")
+        unicode_row = TableRow(table.get_date(0), u"CAF\xc9", u"", 1.0, 2.0, u"Card Payment")
+        self.assertEqual(export.export(list(table) + [unicode_row], columnar_path,
+                                       batch_size=2), 4)
+        groups = list(export.read_columnar(columnar_path))
+        self.assertEqual([len(group) for group in groups], [2, 2])
+        loaded = export.load_columnar(columnar_path)
+        self.assertEqual(list(loaded)[:3], list(table))
+        self.assertEqual(loaded.row(3).description, "CAF\xc9")
+        self.assertEqual(loaded.row(3).place, "")
+
+        self.assertRaises(ValueError, export.export, table, os.path.join(directory, "out.xls"))
+        self.assertRaises(ValueError, list, export.read_columnar(csv_path))
+
+        # same day order should survive records crossing row groups
+        import benchmark
+        import timeseries
+        path = self.write_file("")
+        benchmark.generate_statement(path, 4000)
+        table = Santander.parse_statement_table(path, sort=False)
+        days, balances = timeseries.running_balance(table)
+        for records in (Santander.iter_statement(path), table):
+            export.export(records, columnar_path, batch_size=7)
+            loaded = export.load_columnar(columnar_path)
+            self.assertEqual(list(loaded.sequence), list(table.sequence))
+            self.assertEqual(list(loaded.sorted()), list(table.sorted()))
+            loaded_days, loaded_balances = timeseries.running_balance(loaded)
+            self.assertEqual(list(loaded_days), list(days))
+            self.assertEqual(list(loaded_balances), list(balances))
+
+    def test_generate_statement(self):
+        """The benchmark statements should parse completely, be the
+        same for the same seed and have balances that add up"""
+
+        import benchmark
+        from database import TransactionStore
+
+        paths = [self.write_file("") for _ in range(3)]
+        for path, seed in zip(paths, (1, 1, 2)):
+            self.assertEqual(benchmark.generate_statement(path, 4000, seed), 1000)
+        contents = [open(path, 'rb').read() for path in paths]
+        self.assertEqual(contents[0], contents[1])
+        self.assertNotEqual(contents[0], contents[2])
+        self.assertIs(detect_parser(paths[0]), Santander)
+
+        records = Santander.parse_statement(paths[0])
+        self.assertEqual(len(records), 1000)
+        self.assertEqual(len(set(record.get_trans_type() for record in records)),
+                         len(benchmark.TRANS_MIX))
+        self.assertEqual(records[-1].get_balance(), benchmark.CLOSING_BALANCE / 100.0)
+        for before, after in zip(records, records[1:]):
+            self.assertAlmostEqual(before.get_balance() + after.get_amount(),
+                                   after.get_balance())
+
+        with TransactionStore(':memory:') as store:
+            self.assertEqual(store.insert(records), 1000)
+
+        # each stage gets its own peak, a small one after a big one
+        # shouldnt report the big ones
+        big = benchmark.measure("big", 1, lambda: [[]] * (50 * 1024 * 1024 // 8))
+        small = benchmark.measure("small", 1, lambda: [[] for _ in range(10)])
+        self.assertTrue(small["peak_rss_kb"] < big["peak_rss_kb"] - 20 * 1024)
+        self.assertEqual(small["containers_retained"], 11)
+        self.assertRaises(RuntimeError, benchmark.measure, "broken", 1, int, "x")
+
+    def test_profiling(self):
+        """Every stage should be timed inside profiling and nothing
+        should be left instrumented after it"""
+
+        from profiler import profiling, Profile
+
+        path = self.write_statement(["CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014",
+                                     "BILL PAYMENT TO MISS CM SMITH",
+                                     "BILL PAYMENT TO MISS CM SMITH"])
+        originals = (money._mapped_records, money._sort_records, Santander.__dict__['__init__'],
+                     Santander._trans_regex_map, 'set_date' in Santander.__dict__)
+
+        with profiling() as profile:
+            self.assertEqual(len(Santander.parse_statement(path)), 3)
+
+        self.assertEqual(profile.counts['record', 'Santander'], 3)
+        self.assertEqual(profile.counts['split', None], 3)
+        self.assertEqual(profile.counts['sort', None], 1)
+        self.assertEqual(profile.counts['extract_data', 'Bill Payment'], 2)
+        self.assertEqual(profile.counts['set_trans_type', 'Card Payment'], 1)
+        self.assertEqual(profile.counts['match', 'Santander Bill Payment'], 2)
+        self.assertEqual(profile.counts['set_date', 'Santander'], 4)
+        self.assertTrue(profile.seconds['record', 'Santander'] > 0)
+        self.assertEqual(profile.report()[0][:2], ('record', 'Santander'))
+        self.assertIn("Santander Card Payment", profile.format())
+
+        self.assertEqual((money._mapped_records, money._sort_records,
+                          Santander.__dict__['__init__'], Santander._trans_regex_map,
+                          'set_date' in Santander.__dict__), originals)
+
+        events = []
+        with profiling(lambda *event: events.append(event)):
+            list(Natwest.iter_statement(self.write_file(
+                "Date, Type, Description, Value, Balance\r\n"
+                "24/05/2013,D/D,'BRITISH GAS,-40.00,60.00\r\n")))
+        self.assertIn(('match', 'Natwest Direct Debit'), [event[:2] for event in events])
+
+
+    def test_summaries(self):
+        """The summary tables should match working the totals out from
+        the transactions, after every insert, rule change and rebuild,
+        and be caught up for databases from before they existed"""
+
+        import numpy
+        import analytics
+        import benchmark
+        import timeseries
+        from database import TransactionStore
+
+        path = self.write_file("")
+        benchmark.generate_statement(path, 2000, seed=3)
+        records = Santander.parse_statement(path)
+        database_path = self.write_file("")
+
+        def check(store):
+            table = store.table_between()
+            categoriser = store.categoriser()
+            for by, expected in (("place", analytics.place_totals(table)),
+                                 ("category", analytics.category_totals(table, categoriser))):
+                self.assertEqual(sorted(name for name, _ in store.totals(by)),
+                                 sorted(name for name, _ in expected))
+                for (_, total), (_, expected_total) in zip(sorted(store.totals(by)),
+                                                           sorted(expected)):
+                    self.assertAlmostEqual(total, expected_total)
+            for key, value in analytics.income_outgoing(table).items():
+                self.assertAlmostEqual(store.income_outgoing()[key], value)
+
+            days, incoming, outgoing = store.daily_series()
+            expected = timeseries.daily_series(table)
+            self.assertTrue((days == expected[0]).all())
+            self.assertTrue(numpy.allclose(incoming, expected[1]))
+            self.assertTrue(numpy.allclose(outgoing, expected[2]))
+            self.assertEqual(sum(row[3] for row in store.summary("month")), len(table))
+
+        with TransactionStore(database_path) as store:
+            store.insert(records[:200], batch_size=64)
+            check(store)
+            store.insert(records, batch_size=64)
+            check(store)
+
+            store.set_place_category(records[0].get_place(), "treats")
+            self.assertIn("treats", [name for name, _ in store.totals("category")])
+            store.set_category_rules([(".*", "everything")])
+            self.assertEqual(sorted(name for name, _ in store.totals("category")),
+                             ["everything", "treats"])
+            check(store)
+
+            before = store.summary("place")
+            store.rebuild_summaries()
+            self.assertEqual(len(store.summary("place")), len(before))
+            check(store)
+            self.assertRaises(ValueError, store.summary, "year")
+
+            with store.transaction() as cursor:
+                cursor.execute("DROP TABLE daily_summary;")
+                cursor.execute("DELETE FROM monthly_summary;")
+
+        with TransactionStore(database_path) as store:
+            self.assertEqual(sum(row[3] for row in store.summary("day")), len(records))
+            self.assertEqual(sum(row[3] for row in store.summary("place")), len(records))
+
+        # fuzzy matches shouldnt depend on which batch a place came in
+        pubs = [Santander.parse_statement(self.write_statement(
+                    ["CARD PAYMENT TO {}, ON 23-11-2014".format(place)], amount="-10.00"))
+                for place in ("THE RED LION", "THE RED LION PUB")]
+        with TransactionStore(':memory:') as store:
+            # and batches shouldnt make a new categoriser, this store
+            # made its one when it was opened
+            with patch.object(store, 'categoriser', wraps=store.categoriser) as categoriser:
+                for pub in pubs:
+                    store.insert(pub)
+            self.assertFalse(categoriser.called)
+            incremental = store.totals("category")
+            store.rebuild_summaries()
+            self.assertEqual(incremental, store.totals("category"))
+            self.assertEqual(incremental, [("drinking", -20.0)])
+
+        # or on a place that was learnt in a batch that failed
+        with TransactionStore(':memory:') as store:
+            with patch.object(store, '_add_to_summary',
+                              side_effect=[None, None, None, RuntimeError("full")]):
+                self.assertRaises(RuntimeError, store.insert, pubs[1])
+            store.insert(pubs[0])
+            self.assertEqual(store.totals("category"), [("other", -10.0)])
+
+
+    def test_ingest_service(self):
+        """Statements dropped in the directory should be imported once
+        they settle, bad ones recorded as failures, and stopping should
+        leave everything that was parsed committed"""
+
+        import time
+        from ingest import IngestService
+        from database import TransactionStore
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        database_path = os.path.join(directory, '.money.db')
+
+        # files are only queued once they look the same twice
+        statement = self.write_statement(["BILL PAYMENT TO MISS CM SMITH",
+                                          "CARD PAYMENT TO PETS AT HOME LTD, ON 23-11-2014"])
+        shutil.copy(statement, os.path.join(directory, 'santander.txt'))
+        service = IngestService(directory, database_path)
+        self.assertEqual(service.poll(), 0)
+        self.assertEqual(service.poll(), 1)
+        self.assertEqual(service.poll(), 0)
+
+        service = IngestService(directory, database_path, workers=2,
+                                poll_interval=0.01, batch_size=1)
+        service.start()
+        shutil.copy(self.write_statement(["BILL PAYMENT TO MR RM SMITH"], date="08/02/2013"),
+                    os.path.join(directory, 'later.txt'))
+        with open(os.path.join(directory, 'notes.txt'), 'wb') as notes:
+            notes.write("not a statement")
+
+        deadline = time.time() + 10
+        while (service.imported < 3 or not service.failures) and time.time() < deadline:
+            time.sleep(0.01)
+        service.stop()
+        service.join()
+
+        self.assertEqual(service.imported, 3)
+        self.assertEqual([os.path.basename(path) for path, _ in service.failures],
+                         ['notes.txt'])
+        with TransactionStore(database_path) as store:
+            self.assertEqual(len(store.fingerprints()), 3)
+            self.assertEqual(store.import_statement(os.path.join(directory, 'santander.txt')), 0)
+
+
+    def test_reconcile(self):
+        """Amounts should be exact pence, a good statement should
+        reconcile cleanly and gaps, duplicates, reorders and
+        overlapping statements should all be found"""
+
+        import benchmark
+        from reconcile import Reconciler, reconciled, reconcile_statements
+
+        self.assertEqual(parse_pence("-200.01"), -20001)
+        self.assertEqual(parse_pence("418.6"), 41860)
+        self.assertEqual(parse_pence("+.05"), 5)
+        self.assertEqual(parse_pence("12"), 1200)
+        for bad in ("", "-", "1.234", "1,000.00", "12.x"):
+            self.assertRaises(ValueError, parse_pence, bad)
+
+        path = self.write_file("")
+        benchmark.generate_statement(path, 400, seed=5)
+        records = list(Santander.iter_statement(path))
+        self.assertEqual(records[0].get_balance_pence(), benchmark.CLOSING_BALANCE)
+        self.assertEqual(records[0].get_balance(), benchmark.CLOSING_BALANCE / 100.0)
+
+        def issues(records):
+            reconciler = Reconciler(path, Santander._newest_first)
+            self.assertEqual(list(reconciled(records, reconciler)), records)
+            return [(issue.kind, issue.record, issue.other, issue.pence)
+                    for issue in reconciler.issues]
+
+        self.assertEqual(issues(records), [])
+        self.assertEqual(issues(records[:5] + records[6:]),
+                         [('gap', records[6], records[4], records[5].get_amount_pence())])
+        self.assertEqual(issues(records[:4] + records[3:]), [('duplicate', records[3], None, 0)])
+        self.assertEqual(issues(records[:7] + [records[8], records[7]] + records[9:]),
+                         [('reorder', records[8], records[7], 0)])
+        self.assertEqual(issues(records[:-1] + [records[-1], records[-1]]),
+                         [('duplicate', records[-1], None, 0)])
+
+        # split into statements that overlap and ones with a gap
+        parts = open(path, 'rb').read().split(RECORD_SEPARATOR)
+        def statement(start, stop):
+            return self.write_file(RECORD_SEPARATOR.join(parts[:1] + parts[start:stop]))
+
+        newest, middle = statement(1, 40), statement(30, 70)
+        oldest = statement(75, len(parts))
+        found, overlaps = reconcile_statements([newest, middle, oldest])
+        self.assertEqual(overlaps, [(newest, middle, 10)])
+        self.assertEqual([(issue.kind, issue.path, issue.pence) for issue in found],
+                         [('gap', middle, sum(record.get_amount_pence()
+                                              for record in records[69:74]))])
+
+
 if __name__ == '__main__':
     unittest2.main()
 